@@ -0,0 +1,385 @@
+"""Benchmarks for dropafile.
+
+Measures throughput and latency of the static and upload paths of
+:class:`dropafile.DropAFileApplication`, both in-process (through the
+Werkzeug test client) and over HTTPS on the loopback interface.
+Startup is measured with fresh interpreters, using ``-X importtime``
+(Python >= 3.7) to tell the time spent importing `dropafile`.
+
+The HTTPS server runs in a child process, so the peak RSS reported
+for HTTPS benchmarks is that of the server alone. In-process results
+report the peak RSS of the benchmark process, which includes the
+payloads built by the client.
+
+Run it like this::
+
+  $ python benchmarks/bench_dropafile.py --json results.json
+
+Results are printed as a table and, if requested, written as JSON, so
+they can be compared between releases. Requires Python >= 3.7.
+"""
+import argparse
+import base64
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http import client as httplib
+from io import BytesIO
+import werkzeug
+from werkzeug.serving import make_server
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+import dropafile
+from dropafile import (
+    DropAFileApplication, StorePathAllocator, create_ssl_cert,
+    get_ssl_context, get_store_path)
+
+
+PASSWORD = 'benchmark'
+
+
+def auth_headers(password=PASSWORD):
+    # basic auth headers for `password`
+    creds = base64.b64encode(('bench:%s' % password).encode('utf-8'))
+    return {'Authorization': 'Basic %s' % creds.decode('ascii')}
+
+
+def peak_rss_kb():
+    # peak resident set size of this process in KiB
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # pragma: no cover
+        rss = rss // 1024
+    return rss
+
+
+def timed(name, ops, func, nbytes=None, rss=peak_rss_kb):
+    """Run `func` and return a result dict named `name`.
+
+    `func` is expected to perform `ops` operations, transferring
+    `nbytes` bytes in total, if given. `rss` is a callable returning
+    the peak RSS (in KiB) of the process serving the requests.
+    """
+    rss_before = rss()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    rss_after = rss()
+    result = dict(
+        name=name, ops=ops, seconds=round(seconds, 6),
+        ops_per_sec=round(ops / seconds, 2),
+        ms_per_op=round(seconds * 1000.0 / ops, 4),
+        peak_rss_kb=rss_after, rss_growth_kb=rss_after - rss_before)
+    if nbytes is not None:
+        result['mb_per_sec'] = round(nbytes / seconds / 1024.0 / 1024.0, 2)
+    return result
+
+
+def new_app(upload_dir):
+    return DropAFileApplication(password=PASSWORD, upload_dir=upload_dir)
+
+
+def bench_inprocess(upload_dir, requests, upload_size):
+    """Benchmarks using the in-process Werkzeug test client.
+    """
+    app = new_app(upload_dir)
+    client = Client(app, BaseResponse)
+    headers = auth_headers()
+    results = []
+
+    def get_many(path, headers):
+        def func():
+            for x in range(requests):
+                client.get(path, headers=headers)
+        return func
+
+    results.append(timed(
+        'wsgi_static_page', requests, get_many('/', headers)))
+    results.append(timed(
+        'wsgi_static_js', requests, get_many('/dropzone.js', headers)))
+    gzip_headers = dict(headers, **{'Accept-Encoding': 'gzip'})
+    results.append(timed(
+        'wsgi_static_js_gzip', requests,
+        get_many('/dropzone.js', gzip_headers)))
+    etag = client.get('/dropzone.js', headers=headers).headers['ETag']
+    cond_headers = dict(headers, **{'If-None-Match': etag})
+    results.append(timed(
+        'wsgi_static_js_304', requests,
+        get_many('/dropzone.js', cond_headers)))
+    results.append(timed(
+        'wsgi_unauthorized', requests, get_many('/', {})))
+
+    payload = os.urandom(upload_size)
+
+    def upload_large():
+        client.post('/index.html', headers=headers, data={
+            'file': (BytesIO(payload), 'large.bin')})
+
+    results.append(timed(
+        'wsgi_upload_large', 1, upload_large, nbytes=upload_size))
+
+    def upload_small():
+        for x in range(requests):
+            client.post('/index.html', headers=headers, data={
+                'file': (BytesIO(b'x' * 1024), 'small.txt')})
+
+    results.append(timed(
+        'wsgi_upload_small', requests, upload_small,
+        nbytes=1024 * requests))
+    return results
+
+
+def bench_store_path(upload_dir, names):
+    """Benchmark name allocation with `names` colliding filenames.
+    """
+    results = []
+    directory = tempfile.mkdtemp(dir=upload_dir)
+
+    def probe():
+        for x in range(names):
+            get_store_path(directory, 'scan.pdf')
+
+    results.append(timed('get_store_path_colliding', names, probe))
+    directory = tempfile.mkdtemp(dir=upload_dir)
+    allocator = StorePathAllocator(directory)
+
+    def allocate():
+        for x in range(names):
+            allocator.get_store_path('scan.pdf')
+
+    results.append(timed('allocator_colliding', names, allocate))
+    return results
+
+
+def https_request(port, method, path, headers, body=None):
+    # send a request to the loopback server, return status code
+    context = ssl._create_unverified_context()
+    conn = httplib.HTTPSConnection('127.0.0.1', port, context=context)
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        resp.read()
+        return resp.status
+    finally:
+        conn.close()
+
+
+def multipart(filename, content):
+    # get content type and body of a multipart upload of `content`
+    boundary = 'dropafile-benchmark-boundary'
+    body = b''.join([
+        ('--%s\r\n' % boundary).encode('ascii'),
+        ('Content-Disposition: form-data; name="file"; '
+         'filename="%s"\r\n' % filename).encode('ascii'),
+        b'Content-Type: application/octet-stream\r\n\r\n',
+        content,
+        ('\r\n--%s--\r\n' % boundary).encode('ascii')])
+    return 'multipart/form-data; boundary=%s' % boundary, body
+
+
+def serve_https(upload_dir, cert, conn):
+    """Serve the app over HTTPS on loopback, in a child process.
+
+    The port is sent through the pipe `conn`. Afterwards we answer
+    ``'rss'`` with our peak RSS in KiB and stop on ``'stop'``.
+    """
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    sys.stdout = open(os.devnull, 'w')
+    server = make_server(
+        '127.0.0.1', 0, new_app(upload_dir), threaded=True,
+        ssl_context=get_ssl_context(*cert))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    conn.send(server.socket.getsockname()[1])
+    while conn.recv() == 'rss':
+        conn.send(peak_rss_kb())
+    server.shutdown()
+
+
+def split(num, parts):
+    # split `num` into `parts` numbers differing by one at most
+    return [num // parts + (1 if x < num % parts else 0)
+            for x in range(parts)]
+
+
+def bench_https(upload_dir, requests, upload_size, concurrency, cert):
+    """Benchmarks against a threaded Werkzeug server on loopback.
+
+    The server runs in a fresh child process, the RSS reported is
+    that of the server.
+    """
+    context = multiprocessing.get_context('spawn')
+    conn, child_conn = context.Pipe()
+    process = context.Process(
+        target=serve_https, args=(upload_dir, cert, child_conn))
+    process.start()
+    port = conn.recv()
+
+    def server_rss():
+        conn.send('rss')
+        return conn.recv()
+
+    headers = auth_headers()
+    results = []
+    try:
+        def in_threads(func, num):
+            # run `func` `num` times in total, in up to `concurrency` threads
+            def runner():
+                threads = [
+                    threading.Thread(target=func, args=(count, ))
+                    for count in split(num, concurrency) if count]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            return runner
+
+        def get_pages(num):
+            for x in range(num):
+                https_request(port, 'GET', '/', headers)
+
+        results.append(timed(
+            'https_static_page', requests, in_threads(get_pages, requests),
+            rss=server_rss))
+
+        def get_unauthorized(num):
+            for x in range(num):
+                https_request(port, 'GET', '/', {})
+
+        results.append(timed(
+            'https_unauthorized', requests,
+            in_threads(get_unauthorized, requests), rss=server_rss))
+
+        content_type, body = multipart('large.bin', os.urandom(upload_size))
+
+        def upload_large():
+            https_request(port, 'POST', '/index.html', dict(
+                headers, **{'Content-Type': content_type}), body)
+
+        results.append(timed(
+            'https_upload_large', 1, upload_large, nbytes=upload_size,
+            rss=server_rss))
+        content_type, body = multipart('small.txt', b'x' * 1024)
+
+        def upload_small(num):
+            for x in range(num):
+                https_request(port, 'POST', '/index.html', dict(
+                    headers, **{'Content-Type': content_type}), body)
+
+        results.append(timed(
+            'https_upload_small_concurrent', requests,
+            in_threads(upload_small, requests), nbytes=1024 * requests,
+            rss=server_rss))
+    finally:
+        conn.send('stop')
+        process.join()
+    return results
+
+
+def import_time(module):
+    # seconds spent importing `module` in a fresh interpreter
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        stderr=subprocess.STDOUT, universal_newlines=True)
+    for line in output.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1000000.0
+    raise ValueError('no import time found for %s' % module)
+
+
+def bench_startup(runs):
+    results = []
+    seconds = sorted([import_time('dropafile') for num in range(runs)])
+    median = seconds[runs // 2]
+    results.append(dict(
+        name='startup_import', ops=runs, seconds=round(sum(seconds), 6),
+        ops_per_sec=round(1 / median, 2), ms_per_op=round(median * 1000, 4),
+        peak_rss_kb=peak_rss_kb(), rss_growth_kb=0))
+
+    def show_help():
+        code = 'import dropafile; dropafile.run_server(["dropafile", "-h"])'
+        for num in range(runs):
+            subprocess.check_call(
+                [sys.executable, '-c', code], stdout=subprocess.DEVNULL)
+
+    results.append(timed('startup_help', runs, show_help))
+    return results
+
+
+def handle_options(args):
+    parser = argparse.ArgumentParser(description="Benchmark dropafile.")
+    parser.add_argument(
+        '--json', metavar='PATH', help='Write results as JSON to PATH.')
+    parser.add_argument(
+        '--requests', type=int, default=500,
+        help='Number of requests per benchmark. 500 by default.')
+    parser.add_argument(
+        '--upload-size', type=int, default=64, metavar='MB',
+        help='Size of the large upload in MB. 64 by default.')
+    parser.add_argument(
+        '--concurrency', type=int, default=20,
+        help='Number of concurrent clients over HTTPS. 20 by default.')
+    parser.add_argument(
+        '--names', type=int, default=5000,
+        help='Number of colliding filenames to allocate. 5000 by default.')
+    parser.add_argument(
+        '--startup-runs', type=int, default=20, metavar='N',
+        help=('Number of interpreters started to measure startup. '
+              '20 by default.'))
+    parser.add_argument(
+        '--no-https', action='store_true',
+        help='Skip benchmarks over loopback HTTPS.')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = handle_options(sys.argv[1:] if args is None else args)
+    upload_dir = tempfile.mkdtemp()
+    upload_size = options.upload_size * 1024 * 1024
+    # keep request logs and upload notices out of the results
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    devnull = open(os.devnull, 'w')
+    try:
+        with contextlib.redirect_stdout(devnull):
+            results = bench_inprocess(
+                upload_dir, options.requests, upload_size)
+            results += bench_store_path(upload_dir, options.names)
+            results += bench_startup(options.startup_runs)
+            if not options.no_https:
+                cert = create_ssl_cert(
+                    tempfile.mkdtemp(dir=upload_dir), key_type='ec')
+                results += bench_https(
+                    upload_dir, options.requests, upload_size,
+                    options.concurrency, cert)
+    finally:
+        devnull.close()
+        shutil.rmtree(upload_dir)
+    report = dict(
+        dropafile=dropafile.__version__, werkzeug=werkzeug.__version__,
+        python=platform.python_version(), platform=platform.platform(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        results=results)
+    for result in results:
+        print('%-32s %10.2f ops/s %10.4f ms/op %10s MB/s' % (
+            result['name'], result['ops_per_sec'], result['ms_per_op'],
+            result.get('mb_per_sec', '-')))
+    if options.json:
+        with open(options.json, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    return report
+
+
+if __name__ == '__main__':
+    main()
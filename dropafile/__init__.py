@@ -16,20 +16,86 @@
 """dropafile - Drop a file on a webpage.
 """
 import argparse
+import binascii
+import bisect
+import calendar
+import datetime
+import errno
+import getpass
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import logging.handlers
 import os
+import queue
 import random
-import pkg_resources
-import ssl
-import subprocess
+import re
+import shutil
 import sys
 import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug import secure_filename
-from werkzeug.serving import run_simple
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import (
+    BadRequest, HTTPException, InternalServerError, RequestEntityTooLarge)
 from werkzeug.wrappers import Request, Response
+from werkzeug.wsgi import ClosingIterator, wrap_file
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
 
 
-#: Official version
-__version__ = pkg_resources.get_distribution('dropafile').version
+def get_version():
+    """Get the version of the installed `dropafile` distribution.
+
+    Uses :mod:`importlib.metadata` if available (Python >= 3.8) and
+    `pkg_resources` otherwise.
+    """
+    try:
+        from importlib.metadata import version
+    except ImportError:  # pragma: no cover
+        import pkg_resources
+        return pkg_resources.get_distribution('dropafile').version
+    return version('dropafile')
+
+
+def load_crypto():
+    """Get the `cryptography.x509` module, ``None`` if `cryptography`
+    is not installed.
+
+    `cryptography` takes a while to import, so it is imported on first
+    use, not with `dropafile`. Afterwards the modules needed to create
+    certificates are available as module globals.
+    """
+    global x509, hashes, serialization, ec, ed25519, rsa
+    if 'x509' not in globals():
+        try:
+            from cryptography import x509
+            from cryptography.hazmat.primitives import hashes, serialization
+            from cryptography.hazmat.primitives.asymmetric import (
+                ec, ed25519, rsa)
+        except ImportError:  # pragma: no cover
+            x509 = None
+    return x509
+
+
+def __getattr__(name):
+    # compute rarely needed, but expensive module attributes on access.
+    # `__version__` is the official version, `x509` see `load_crypto`.
+    if name == '__version__':
+        globals()[name] = get_version()
+        return globals()[name]
+    if name == 'x509':
+        return load_crypto()
+    raise AttributeError(
+        'module %r has no attribute %r' % (__name__, name))
 
 
 PATH_MAP = {
@@ -43,72 +109,1676 @@ PATH_MAP = {
 STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
 
 
-#: Chars allowed in passwords.
-#: We allow plain ASCII chars and numbers, with some entitites removed,
-#: that can be easily mixed up: letter `l` and number one, for instance.
-ALLOWED_PWD_CHARS = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789abcdefghjkmnpqrstuvwxyz'
+#: A static file loaded into memory.
+#:
+#: `path` is the filesystem path the asset was read from, `data` its
+#: raw content (bytes), `content_length` the length of `data` and
+#: `mtime` the modification time of `path` when it was read. `etag`
+#: is a strong entity tag computed from `data`. `encodings` maps
+#: content-codings (``'gzip'``, ``'br'``) to compressed variants of
+#: `data`.
+StaticAsset = namedtuple(
+    'StaticAsset',
+    ['path', 'data', 'mimetype', 'content_length', 'mtime', 'etag',
+     'encodings'])
+
+
+#: A file stored in the upload directory.
+#:
+#: `path` is where the file was stored, `size` its size in bytes and
+#: `digest` the hex digest of its content (``None`` if hashing is
+#: disabled).
+StoredFile = namedtuple('StoredFile', ['path', 'size', 'digest'])
+
+
+#: A chunk of a file sent in pieces (see
+#: :meth:`DropAFileApplication.store_chunk`).
+#:
+#: `upload_id` identifies the upload, `index` is the number of the
+#: chunk and `total` the number of chunks of the upload. The chunk
+#: belongs at `offset` in the complete file of `file_size` bytes
+#: (``0`` if unknown).
+Chunk = namedtuple(
+    'Chunk', ['upload_id', 'index', 'total', 'offset', 'file_size'])
+
+
+def compress_gzip(data):
+    """Get `data` gzip-compressed.
+
+    In contrast to :mod:`gzip` we do not store a timestamp, so the
+    result depends on `data` only.
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_brotli(data):
+    """Get `data` brotli-compressed.
+    """
+    return brotli.compress(data)
+
+
+#: Content-codings we can serve static files with, in order of
+#: preference. Brotli is only available if the `brotli` package is
+#: installed.
+ENCODINGS = [('gzip', compress_gzip), ]
+if brotli is not None:  # pragma: no cover
+    ENCODINGS.insert(0, ('br', compress_brotli))
+
+
+#: Chars allowed in passwords.
+#: We allow plain ASCII chars and numbers, with some entitites removed,
+#: that can be easily mixed up: letter `l` and number one, for instance.
+ALLOWED_PWD_CHARS = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789abcdefghjkmnpqrstuvwxyz'
+
+
+#: Methods we can hash passwords with, see :func:`hash_password`.
+HASH_METHODS = ('scrypt', 'pbkdf2_sha256')
+
+
+#: What to do with uploads identical to files stored already. See
+#: :class:`DropAFileApplication`.
+DEDUP_MODES = ('link', 'skip')
+
+
+#: Cost parameters of new password hashes.
+SCRYPT_PARAMS = dict(n=2 ** 14, r=8, p=1)
+PBKDF2_ITERATIONS = 600000
+
+
+#: Name of the session cookie, see :meth:`DropAFileApplication.check_session`.
+SESSION_COOKIE = 'dropafile_session'
+
+
+#: Values of session cookies: expiry date and signature.
+RE_SESSION_COOKIE = re.compile('^([0-9]{1,20})\\.([0-9a-f]{64})$')
+
+
+#: Server engines we can run.
+ENGINES = ('wsgi', 'async')
+
+
+#: Formats we can write logs in.
+LOG_FORMATS = ('text', 'json')
+
+
+#: Attributes of log records written in ``json`` format, if set.
+LOG_FIELDS = ('path', 'size', 'digest', 'duration', 'client', 'status')
+
+
+#: The logger we write events (like received files) to.
+logger = logging.getLogger('dropafile')
+
+
+#: Types of keys we can generate for SSL certificates.
+KEY_TYPES = ('rsa', 'ec', 'ed25519')
+
+
+#: Upload ids of chunked uploads we accept (Dropzone sends UUIDs).
+RE_UPLOAD_ID = re.compile('^[A-Za-z0-9-]{1,64}$')
+
+
+#: Maximum number of chunks a chunked upload may consist of.
+MAX_CHUNK_COUNT = 100000
+
+
+#: Seconds after which unfinished chunked uploads are removed.
+CHUNK_MAX_AGE = 3600
+
+
+#: Names of form fields we accept files from: ``file``, ``file[]``,
+#: ``file[0]``, ``file[1]``, ...
+RE_FILE_FIELD = re.compile('^file(\\[[0-9]*\\])?$')
+
+
+#: Filenames with a numeric suffix as created by :func:`get_store_path`.
+RE_NUMBERED_FILENAME = re.compile('^(.+)-([0-9]+)$')
+
+
+#: Sizes as accepted by :func:`parse_size`, like ``100``, ``20K``, ``1.5G``.
+RE_SIZE = re.compile('^([0-9]+(?:\\.[0-9]+)?)\\s*([KMGT]?)B?$', re.I)
+
+
+def handle_options(args):
+    """Handle commandline options.
+
+    Expects the arguments passed to dropafile as a list of
+    arguments. `args` is expected to represent ``sys.argv[1:]``,
+    i.e. the arguments when called, without the programme name.
+
+    Returns parsed options as provided by :mod:`argparse`.
+    """
+    parser = argparse.ArgumentParser(description="Start dropafile app.")
+    parser.add_argument(
+        '--host', required=False, default='localhost',
+        help=(
+            'Host we bind to. An IP address or DNS name. `localhost`'
+            ' by default.'
+            ),
+        )
+    parser.add_argument(
+        '-p', '--port', required=False, default=8443, type=int,
+        help=(
+            'Port we listen at. An integer. 8443 by default.'
+            )
+        )
+    parser.add_argument(
+        '-s', '--secret', required=False, metavar='PASSWORD',
+        help=(
+            'Password to access dropafile. If none is given we generate '
+            'one.'
+            )
+        )
+    parser.add_argument(
+        '--secret-file', required=False, metavar='PATH',
+        help=(
+            'File containing a password hash as printed by '
+            '--hash-secret. Users send the plain password, which is '
+            'checked against the hash.'
+            )
+        )
+    parser.add_argument(
+        '--hash-secret', required=False, action='store_true',
+        help=(
+            'Print a hash of the password given with --secret (or asked '
+            'for) to store in a --secret-file and exit.'
+            )
+        )
+    parser.add_argument(
+        '--session-lifetime', required=False, type=int, metavar='SECONDS',
+        help=(
+            'Issue a session cookie valid for SECONDS after successful '
+            'login. Requests with a valid cookie are not checked for the '
+            'password again. Off by default.'
+            )
+        )
+    parser.add_argument(
+        '--cert', required=False, metavar='CERT_PATH',
+        help=(
+            'Path to an SSL certificate (PEM) to use. Requires --key. If '
+            'none is given, we create a self-signed one.'
+            )
+        )
+    parser.add_argument(
+        '--key', required=False, metavar='KEY_PATH',
+        help='Path to the key (PEM) of the certificate given with --cert.'
+        )
+    parser.add_argument(
+        '--cert-cache', required=False, metavar='DIR',
+        help=(
+            'Directory to keep a created SSL certificate in. A still '
+            'valid certificate found there is reused instead of creating '
+            'a new one.'
+            )
+        )
+    parser.add_argument(
+        '--key-type', required=False, default='rsa', choices=KEY_TYPES,
+        help=(
+            'Type of key to create for self-signed certificates. `ec` '
+            '(ECDSA P-256) and `ed25519` keys are much faster to create '
+            'than `rsa` keys (the default), but Ed25519 is not supported '
+            'by most browsers.'
+            )
+        )
+    parser.add_argument(
+        '--tls-tickets', required=False, default=2, type=int, metavar='N',
+        help=(
+            'Number of TLS 1.3 session tickets sent to clients after a '
+            'full handshake. Clients use them to resume sessions on new '
+            'connections. 2 by default.'
+            )
+        )
+    parser.add_argument(
+        '--cert-pool', required=False, metavar='DIR',
+        help=(
+            'Directory to keep a pool of ready-made SSL certificates in. '
+            'On startup we take one from there and create new ones in '
+            'background, so restarts need not wait for a new key.'
+            )
+        )
+    parser.add_argument(
+        '--cert-pool-size', required=False, default=2, type=int,
+        metavar='N',
+        help='Number of certificates to keep in --cert-pool. 2 by default.'
+        )
+    parser.add_argument(
+        '--health-port', required=False, type=int, metavar='PORT',
+        help=(
+            'While an SSL certificate is created on startup, answer '
+            'plain HTTP requests to 127.0.0.1:PORT with `starting`.'
+            )
+        )
+    concurrency = parser.add_mutually_exclusive_group()
+    concurrency.add_argument(
+        '--threads', required=False, default=1, type=int, metavar='N',
+        help=(
+            'Handle up to N requests concurrently, each in a separate '
+            'thread. 1 (one request at a time) by default.'
+            )
+        )
+    concurrency.add_argument(
+        '--processes', required=False, default=1, type=int, metavar='N',
+        help=(
+            'Handle up to N requests concurrently, each in a separate '
+            'process. 1 (one request at a time) by default. Metrics are '
+            'not served with N > 1, as each process only knows its own. '
+            'Verified passwords are not cached across requests either, '
+            'use --session-lifetime to avoid checking them every time.'
+            )
+        )
+    parser.add_argument(
+        '--digest', required=False, default='sha256', metavar='ALGORITHM',
+        choices=sorted(hashlib.algorithms_guaranteed),
+        help=(
+            'Hash algorithm to compute digests of uploaded files with. '
+            '`sha256` by default.'
+            )
+        )
+    parser.add_argument(
+        '--manifest', required=False, metavar='PATH',
+        help=(
+            'Append digests of uploaded files to PATH (in the format of '
+            '`sha256sum` and friends).'
+            )
+        )
+    parser.add_argument(
+        '--storage', required=False, default='flat', choices=STORAGES.keys(),
+        help=(
+            'Layout of the upload directory. `flat` (the default) stores '
+            'files under their name, `cas` under their digest in '
+            'sharded subdirectories, with an index of names.'
+            )
+        )
+    parser.add_argument(
+        '--object-store', required=False, metavar='URL',
+        help=(
+            'Send uploads to the bucket at URL of an S3 compatible object '
+            'store (like `https://s3.example.com/bucket`) instead of the '
+            'upload directory. Credentials are read from environment '
+            'variables AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY.'
+            )
+        )
+    parser.add_argument(
+        '--dedup', required=False, choices=DEDUP_MODES,
+        help=(
+            'Detect uploads identical to a file in the upload directory. '
+            '`link` stores them as hardlink, `skip` does not store them '
+            'at all. Off by default. Cannot be used with --processes.'
+            )
+        )
+    parser.add_argument(
+        '--fsync', required=False, default='none', choices=FSYNC_MODES,
+        help=(
+            'Sync stored files to disk before answering uploads. `file` '
+            'syncs each file, `batch` the files of concurrent uploads '
+            'together every --fsync-interval ms. `none` (the default) '
+            'leaves it to the OS.'
+            )
+        )
+    parser.add_argument(
+        '--fsync-interval', required=False, default=10, type=int,
+        metavar='MS',
+        help='Interval of batched syncs in milliseconds. 10 by default.'
+        )
+    parser.add_argument(
+        '--write-buffer', required=False, default=WRITE_BUFFER_SIZE,
+        type=parse_size, metavar='SIZE',
+        help=(
+            'Size of buffers used when writing uploaded files. Suffixes '
+            'K, M, G and T are accepted. 64K by default.'
+            )
+        )
+    parser.add_argument(
+        '--preallocate', required=False, action='store_true',
+        help=(
+            'Allocate disk space for uploads before they are written, to '
+            'avoid fragmentation of large files. Only done for files of '
+            'known size: chunks and files sent alone or with their own '
+            'Content-Length.'
+            )
+        )
+    parser.add_argument(
+        '--max-file-size', required=False, type=parse_size, metavar='SIZE',
+        help=(
+            'Maximum size of a single uploaded file in bytes. Suffixes '
+            'K, M, G and T are accepted (`500M`). Unlimited by default.'
+            )
+        )
+    parser.add_argument(
+        '--max-request-size', required=False, type=parse_size,
+        metavar='SIZE',
+        help=(
+            'Maximum size of an upload request in bytes. Suffixes K, M, G '
+            'and T are accepted. Unlimited by default.'
+            )
+        )
+    parser.add_argument(
+        '--log-file', required=False, metavar='PATH',
+        help='Write log to PATH instead of stdout.'
+        )
+    parser.add_argument(
+        '--log-format', required=False, default='text', choices=LOG_FORMATS,
+        help=(
+            'Format of log entries. `text` (the default) or `json` (one '
+            'JSON object per line).'
+            )
+        )
+    parser.add_argument(
+        '--engine', required=False, default='wsgi', choices=ENGINES,
+        help=(
+            'Server engine to use. `wsgi` (the default) runs the Werkzeug '
+            'server, `async` runs an asyncio based server (requires '
+            '`uvicorn`).'
+            )
+        )
+    opts = parser.parse_args(args)
+    if (opts.cert is None) != (opts.key is None):
+        parser.error('--cert and --key must be given together')
+    if opts.cert_pool is not None and (
+            opts.cert is not None or opts.cert_cache is not None):
+        parser.error('--cert-pool excludes --cert and --cert-cache')
+    if opts.secret is not None and opts.secret_file is not None:
+        parser.error('--secret and --secret-file exclude each other')
+    if opts.object_store and (opts.storage != 'flat' or opts.dedup):
+        parser.error('--object-store excludes --storage and --dedup')
+    if opts.engine == 'async' and (opts.threads > 1 or opts.processes > 1):
+        parser.error('--threads and --processes require the wsgi engine')
+    if opts.dedup and opts.processes > 1:
+        # children forked per request would not share new digests
+        parser.error('--dedup excludes --processes')
+    return opts
+
+
+def load_static_asset(filename, mimetype):
+    """Read the file `filename` from `STATIC_DIR` into memory.
+
+    Returns a :data:`StaticAsset` with `mimetype` set. Compressed
+    variants are created for all `ENCODINGS` that actually make the
+    content smaller.
+    """
+    path = os.path.join(STATIC_DIR, filename)
+    with open(path, 'rb') as file_descr:
+        mtime = os.fstat(file_descr.fileno()).st_mtime
+        data = file_descr.read()
+    etag = hashlib.sha256(data).hexdigest()[:32]
+    encodings = dict()
+    for name, compress in ENCODINGS:
+        compressed = compress(data)
+        if len(compressed) < len(data):
+            encodings[name] = compressed
+    return StaticAsset(
+        path, data, mimetype, len(data), mtime, etag, encodings)
+
+
+def parse_size(value):
+    """Get the number of bytes described by `value`.
+
+    `value` is a string like ``'1024'``, ``'20K'`` or ``'1.5G'``.
+    Suffixes are powers of 1024. Raises
+    :class:`argparse.ArgumentTypeError` for invalid sizes.
+    """
+    match = RE_SIZE.match(value.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError('invalid size: %s' % value)
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMGT'.index(unit.upper() or ' '))
+
+
+def get_random_password():
+    """Get a password generated from `ALLOWED_PWD_CHARS`.
+
+    The password entropy should be >= 128 bits. We use `SystemRandom()`,
+    which should provide enough randomness to work properly.
+    """
+    rnd = random.SystemRandom()
+    return ''.join(
+        [rnd.choice(ALLOWED_PWD_CHARS) for x in range(23)])
+
+
+def hash_password(password, method='scrypt', salt=None):
+    """Get a hash of `password` to store instead of the password.
+
+    `method` is one of `HASH_METHODS`. A random salt is used if
+    `salt` (bytes) is not given. The result is a string like
+    ``scrypt$<n>$<r>$<p>$<salt>$<hash>`` or
+    ``pbkdf2_sha256$<iterations>$<salt>$<hash>``, with salt and hash
+    hex-encoded.
+    """
+    if salt is None:
+        salt = os.urandom(16)
+    password = password.encode('utf-8')
+    if method == 'scrypt':
+        params = SCRYPT_PARAMS
+        derived = hashlib.scrypt(password, salt=salt, **params)
+        fields = [method, params['n'], params['r'], params['p']]
+    elif method == 'pbkdf2_sha256':
+        derived = hashlib.pbkdf2_hmac(
+            'sha256', password, salt, PBKDF2_ITERATIONS)
+        fields = [method, PBKDF2_ITERATIONS]
+    else:
+        raise ValueError('Unsupported hash method: %s' % method)
+    fields += [binascii.hexlify(salt).decode('ascii'),
+               binascii.hexlify(derived).decode('ascii')]
+    return '$'.join([str(field) for field in fields])
+
+
+def verify_password(password, password_hash):
+    """Check `password` against `password_hash`.
+
+    `password_hash` must be a hash as created by
+    :func:`hash_password`. Hashes are compared in constant time.
+    Returns ``True`` if the password matches, ``False`` otherwise.
+    Raises :class:`ValueError` if `password_hash` is invalid.
+    """
+    fields = password_hash.split('$')
+    try:
+        salt = binascii.unhexlify(fields[-2])
+        expected = binascii.unhexlify(fields[-1])
+        params = [int(field) for field in fields[1:-2]]
+    except (IndexError, ValueError, TypeError):
+        raise ValueError('Invalid password hash.')
+    password = password.encode('utf-8')
+    if fields[0] == 'scrypt' and len(params) == 3:
+        n, r, p = params
+        derived = hashlib.scrypt(
+            password, salt=salt, n=n, r=r, p=p, dklen=len(expected),
+            maxmem=256 * r * n + 1024 * 1024)
+    elif fields[0] == 'pbkdf2_sha256' and len(params) == 1:
+        derived = hashlib.pbkdf2_hmac(
+            'sha256', password, salt, params[0], len(expected))
+    else:
+        raise ValueError('Invalid password hash.')
+    return hmac.compare_digest(derived, expected)
+
+
+def read_secret_file(path):
+    """Read a password hash from the file `path`.
+
+    Raises :class:`ValueError` if the file does not contain a hash as
+    created by :func:`hash_password`.
+    """
+    with open(path) as file_descr:
+        password_hash = file_descr.read().strip()
+    if password_hash.split('$')[0] not in HASH_METHODS:
+        raise ValueError('No password hash in %s' % path)
+    return password_hash
+
+
+class AuthCache(object):
+    """A bounded set of credentials verified before.
+
+    Keeps at most `maxsize` keys. When full, the least recently used
+    key is dropped. Can be used from several threads.
+
+    The cache lives in the memory of one process. Servers forking a
+    child per request (like with `--processes`) lose every key added
+    in the child, so there the cache never hits. Use signed sessions
+    (`--session-lifetime`) to avoid checking passwords on every
+    request then.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.entries.move_to_end(key)
+            return True
+
+    def add(self, key):
+        """Add `key` to the cache.
+        """
+        with self.lock:
+            self.entries[key] = True
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+def get_store_path(directory, filename):
+    """Get a path where we can safely store a file.
+
+    The file should be stored in `directory` under name `filename`.
+    If `filename` already exists in `directory`, we construct new
+    names by appending '-<NUM>' to the original filename, where
+    ``<NUM>`` is a number counting up.
+
+    The returned path is claimed by creating an empty file there. As
+    this is done atomically, concurrent callers (threads or
+    processes) never get the same path. The file should be replaced
+    by the real one afterwards.
+    """
+    filename = secure_filename(filename)
+    path = os.path.join(directory, filename)
+    num = 1
+    while not claim_path(path):
+        path = os.path.join(directory, '%s-%s' % (filename, num))
+        num += 1
+    return path
+
+
+def claim_path(path):
+    """Atomically create an empty file at `path`.
+
+    Returns ``True`` if we created the file, ``False`` if `path`
+    existed already.
+    """
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+        return False
+    os.close(fd)
+    return True
+
+
+class StorePathAllocator(object):
+    """Allocate paths to store files in `directory`.
+
+    Works like :func:`get_store_path`, but does not probe all numbered
+    variants of a filename. Instead we remember the highest number
+    used for each filename. The index is seeded by scanning
+    `directory` once, when the allocator is created. Afterwards a new
+    path normally costs a single system call.
+
+    Paths are claimed like in :func:`get_store_path`, so concurrent
+    allocators (in other processes, for instance) never hand out the
+    same path. Numbers below the highest one in use are not reused.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        #: maps filenames to the next number to try. Filenames not in
+        #: here are tried without number first.
+        self.next_num = dict()
+        for name in os.listdir(directory):
+            if name.startswith('.'):
+                continue
+            self.seen(name)
+
+    def seen(self, name):
+        """Note that `name` exists in our directory.
+        """
+        self.next_num.setdefault(name, 1)
+        match = RE_NUMBERED_FILENAME.match(name)
+        if match is not None:
+            filename, num = match.group(1), int(match.group(2))
+            self.next_num[filename] = max(
+                self.next_num.get(filename, 1), num + 1)
+
+    def get_store_path(self, filename):
+        """Get a path where we can safely store a file named `filename`.
+
+        The path returned was claimed by creating an empty file.
+        """
+        filename = secure_filename(filename)
+        with self.lock:
+            num = self.next_num.get(filename, None)
+            while True:
+                name = filename
+                if num is not None:
+                    name = '%s-%s' % (filename, num)
+                path = os.path.join(self.directory, name)
+                if claim_path(path):
+                    break
+                num = 1 if num is None else num + 1
+            self.next_num[filename] = 1 if num is None else num + 1
+            return path
+
+
+def get_file_digest(path, hash_name):
+    """Get the hex digest of the file at `path`.
+
+    `hash_name` is the name of a hash algorithm known to
+    :func:`hashlib.new`.
+    """
+    hasher = hashlib.new(hash_name)
+    with open(path, 'rb') as file_descr:
+        for block in iter(lambda: file_descr.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class DigestIndex(object):
+    """An in-memory index of files in `directory` by content digest.
+
+    The index is built once, by hashing all files in `directory`
+    (hidden files excepted) with `hash_name`. Files stored later on
+    should be registered with :meth:`add`. Can be used from several
+    threads, but not from several processes: files added in one
+    process are unknown to the others.
+    """
+
+    def __init__(self, directory, hash_name):
+        self.lock = threading.Lock()
+        self.paths = dict()
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name.startswith('.') or not os.path.isfile(path):
+                continue
+            self.paths.setdefault(get_file_digest(path, hash_name), path)
+
+    def get(self, digest):
+        """Get the path of a file with content digest `digest`.
+
+        Returns ``None`` if there is no such file (anymore).
+        """
+        with self.lock:
+            path = self.paths.get(digest)
+            if path is not None and not os.path.isfile(path):
+                del self.paths[digest]
+                path = None
+        return path
+
+    def add(self, digest, path):
+        """Register the file at `path` with content digest `digest`.
+        """
+        with self.lock:
+            self.paths.setdefault(digest, path)
+
+
+class ConcurrencyLimit(object):
+    """WSGI middleware letting `app` handle at most `limit` requests at
+    a time.
+
+    Meant for multi-threaded servers, which otherwise start a new
+    thread for every request. Further requests wait until one of the
+    running requests is done. A request is done when the server closed
+    its response iterable, so sending the response body counts, too.
+    """
+
+    def __init__(self, app, limit):
+        self.app = app
+        self.limit = limit
+        self.semaphore = threading.BoundedSemaphore(limit)
+
+    def __call__(self, environ, start_response):
+        self.semaphore.acquire()
+        try:
+            app_iter = self.app(environ, start_response)
+        except BaseException:
+            self.semaphore.release()
+            raise
+        return ClosingIterator(app_iter, self.semaphore.release)
+
+
+class Histogram(object):
+    """A histogram of values sorted into `buckets`.
+
+    `buckets` is a sorted sequence of upper bounds. Counters are
+    allocated once, so :meth:`observe` does not allocate anything.
+    Not thread-safe on its own, see :class:`Metrics`.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # the last counter is for values larger than all bounds
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add `value` to the histogram.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name):
+        """Get lines describing the histogram in Prometheus text format.
+
+        `name` is the metric name to use.
+        """
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound, total))
+        lines.append('%s_bucket{le="+Inf"} %d' % (name, self.count))
+        lines.append('%s_sum %s' % (name, repr(self.sum)))
+        lines.append('%s_count %d' % (name, self.count))
+        return lines
+
+
+#: Buckets of histograms measuring seconds.
+SECONDS_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60,
+    300)
+
+#: Buckets of histograms measuring bytes, 1 KiB to 16 GiB.
+BYTES_BUCKETS = tuple([1024 * 4 ** num for num in range(13)])
+
+#: Buckets of histograms measuring throughput in MB/s.
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+
+class Metrics(object):
+    """Histograms describing the requests handled by an application.
+
+    Each entry of `METRICS` is available as a :class:`Histogram` in
+    `histograms`. Use :meth:`observe` to record values, it can be
+    called from several threads. Values are recorded per process:
+    servers forking a process per request (like with `--processes`)
+    lose what was recorded in the child, so :func:`serve` disables
+    the metrics endpoint then.
+
+    If an `ssl_context` is given, TLS handshake counters as returned
+    by :func:`get_tls_stats` are rendered as well.
+    """
+
+    #: Metric names with help texts and histogram buckets.
+    METRICS = (
+        ('dropafile_auth_seconds',
+         'Time spent checking credentials.', SECONDS_BUCKETS),
+        ('dropafile_upload_parse_seconds',
+         'Time spent receiving and parsing upload requests, without '
+         'writing to disk.', SECONDS_BUCKETS),
+        ('dropafile_upload_write_seconds',
+         'Time spent writing uploaded files to disk.', SECONDS_BUCKETS),
+        ('dropafile_fsync_seconds',
+         'Time spent waiting for stored files to be synced to disk.',
+         SECONDS_BUCKETS),
+        ('dropafile_upload_bytes',
+         'Size of upload requests in bytes.', BYTES_BUCKETS),
+        ('dropafile_upload_throughput_mbps',
+         'Throughput of upload requests in MB/s.', THROUGHPUT_BUCKETS),
+        )
+
+    #: TLS metric names with help texts and metric types.
+    TLS_METRICS = (
+        ('dropafile_tls_handshakes', 'handshakes',
+         'Completed TLS handshakes.', 'counter'),
+        ('dropafile_tls_resumed', 'resumed',
+         'TLS handshakes resuming a former session.', 'counter'),
+        ('dropafile_tls_resumption_ratio', 'resumption_ratio',
+         'Share of TLS handshakes resuming a former session.', 'gauge'),
+        )
+
+    def __init__(self, ssl_context=None):
+        self.lock = threading.Lock()
+        self.ssl_context = ssl_context
+        self.histograms = dict(
+            [(name, Histogram(buckets)) for name, _, buckets in self.METRICS])
+
+    def observe(self, name, value):
+        """Record `value` in histogram `name`.
+        """
+        histogram = self.histograms[name]
+        with self.lock:
+            histogram.observe(value)
+
+    def observe_upload(self, size, parse_time, write_time):
+        """Record an upload request of `size` bytes.
+
+        It took `parse_time` seconds to receive and parse the request
+        and `write_time` seconds to write uploaded files.
+        """
+        seconds = parse_time + write_time
+        with self.lock:
+            self.histograms['dropafile_upload_bytes'].observe(size)
+            self.histograms['dropafile_upload_parse_seconds'].observe(
+                parse_time)
+            self.histograms['dropafile_upload_write_seconds'].observe(
+                write_time)
+            if seconds > 0:
+                self.histograms['dropafile_upload_throughput_mbps'].observe(
+                    size / seconds / 1000000.0)
+
+    def render(self):
+        """Get all metrics in Prometheus text format.
+        """
+        lines = []
+        with self.lock:
+            for name, help_text, _ in self.METRICS:
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s histogram' % name)
+                lines.extend(self.histograms[name].render(name))
+        if self.ssl_context is not None:
+            stats = get_tls_stats(self.ssl_context)
+            for name, key, help_text, metric_type in self.TLS_METRICS:
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                lines.append('%s %s' % (name, repr(stats[key])))
+        return '\n'.join(lines) + '\n'
+
+
+class JSONFormatter(logging.Formatter):
+    """Format log records as JSON objects.
+
+    Besides time, level, logger name and message we write all
+    attributes listed in `LOG_FIELDS` set on a record.
+    """
+
+    def format(self, record):
+        data = dict(
+            time=self.formatTime(record), level=record.levelname,
+            logger=record.name, message=record.getMessage())
+        for name in LOG_FIELDS:
+            if hasattr(record, name):
+                data[name] = getattr(record, name)
+        return json.dumps(data, sort_keys=True)
+
+
+class ProcessQueue(object):
+    """A queue passing log records from forked processes to a
+    :class:`logging.handlers.QueueListener`.
+
+    Based on :class:`multiprocessing.SimpleQueue`, which writes items
+    into a pipe right away. Other than with
+    :class:`multiprocessing.Queue` no records get lost, when a process
+    exits with :func:`os._exit` (as forked request handlers do).
+    """
+
+    def __init__(self):
+        import multiprocessing
+        self.queue = multiprocessing.SimpleQueue()
+
+    def put_nowait(self, item):
+        self.queue.put(item)
+
+    def get(self, block=True):
+        return self.queue.get()
+
+
+class ConsoleHandler(logging.StreamHandler):
+    """A logging handler writing to `sys.stdout` or `sys.stderr`.
+
+    `stream_name` is ``'stdout'`` or ``'stderr'``. The stream is
+    looked up when writing, so later replacements of
+    `sys.stdout`/`sys.stderr` are respected.
+    """
+
+    def __init__(self, stream_name='stdout'):
+        logging.Handler.__init__(self)
+        self.stream_name = stream_name
+
+    @property
+    def stream(self):
+        return getattr(sys, self.stream_name)
+
+
+def setup_logging(log_file=None, log_format='text', multiprocess=False):
+    """Let a background thread write log records of `dropafile` and
+    `werkzeug`.
+
+    Loggers only put records into a queue, so writing to a slow
+    terminal or file does not block requests. Records of `dropafile`
+    are written to `log_file` or stdout, in `log_format` (see
+    `LOG_FORMATS`). Records of `werkzeug` (the request log) go to
+    stderr as before.
+
+    If `multiprocess` is ``True``, records are collected from forked
+    processes as well.
+
+    Returns the started :class:`logging.handlers.QueueListener`. Call
+    its `stop()` method to write all pending records and stop.
+    """
+    if multiprocess:
+        records = ProcessQueue()
+    else:
+        records = queue.Queue()
+    if log_file is None:
+        handler = ConsoleHandler('stdout')
+        formatter = logging.Formatter('%(message)s')
+    else:
+        handler = logging.FileHandler(log_file)
+        formatter = logging.Formatter('%(asctime)s %(message)s')
+    if log_format == 'json':
+        formatter = JSONFormatter()
+    handler.setFormatter(formatter)
+    handler.addFilter(logging.Filter('dropafile'))
+    request_log = ConsoleHandler('stderr')
+    request_log.addFilter(logging.Filter('werkzeug'))
+    for log in (logger, logging.getLogger('werkzeug')):
+        for old_handler in log.handlers[:]:
+            if isinstance(old_handler, logging.handlers.QueueHandler):
+                log.removeHandler(old_handler)
+        log.addHandler(logging.handlers.QueueHandler(records))
+        log.setLevel(logging.INFO)
+        log.propagate = False
+    listener = logging.handlers.QueueListener(records, handler, request_log)
+    listener.start()
+    return listener
+
+
+def record_chunk(path, index, end):
+    """Record chunk number `index`, ending at byte offset `end`, in the
+    chunk index file `path`.
+
+    The index file is appended to, so concurrent requests cannot
+    overwrite each others entries. Returns a dict mapping all chunk
+    numbers recorded so far to their end offsets.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        os.write(fd, ('%d %d\n' % (index, end)).encode('ascii'))
+    finally:
+        os.close(fd)
+    with open(path, 'rb') as file_descr:
+        return dict([
+            (int(num), int(end)) for num, end in (
+                line.split() for line in file_descr.read().splitlines())])
+
+
+def discard_chunks(partial_path):
+    """Remove the partial file `partial_path` of a chunked upload and
+    its chunk index, if they exist.
+    """
+    for path in (partial_path, partial_path + '.idx'):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+#: Default size of buffers used when writing uploaded files.
+WRITE_BUFFER_SIZE = 64 * 1024
+
+#: Minimum size of files to preallocate disk space for.
+PREALLOCATE_MIN_SIZE = 1024 * 1024
+
+#: The umask of the process, read once on import, as reading it
+#: means setting it, which is not thread-safe.
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+
+def create_upload_stream(directory, buffer_size=WRITE_BUFFER_SIZE):
+    """Create a hidden temporary file in `directory` to store an
+    upload in.
+
+    Returns an open, writable file object, buffering `buffer_size`
+    bytes. Its `name` is the path of the file created. Its mode
+    honours the :data:`UMASK`, like files saved by
+    :meth:`werkzeug.datastructures.FileStorage.save`, as it is moved
+    into place when complete.
+    """
+    stream = tempfile.NamedTemporaryFile(
+        dir=directory, prefix='.upload-', delete=False,
+        buffering=buffer_size)
+    os.fchmod(stream.fileno(), 0o666 & ~UMASK)
+    return stream
+
+
+def preallocate(fd, size):
+    """Allocate `size` bytes of disk space for the file open as `fd`.
+
+    Files growing write by write may end up fragmented on disk. Sizes
+    below `PREALLOCATE_MIN_SIZE` are ignored, as are systems without
+    :func:`os.posix_fallocate`. Failures (like filesystems refusing it
+    or running out of space) are logged at debug level only, as the
+    upload is then written without preallocation. The file is at least
+    `size` bytes long afterwards, so truncate it to the size written
+    when done.
+
+    Returns ``True`` if space was allocated.
+    """
+    if size < PREALLOCATE_MIN_SIZE or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as err:
+        logger.debug("Preallocating %d bytes failed: %s", size, err)
+        return False
+    return True
+
+
+def copy_stream(source, target, buffer_size=WRITE_BUFFER_SIZE):
+    """Copy the content of file object `source` to `target`.
+
+    Data is passed through one buffer of `buffer_size` bytes, reused
+    for all reads, if `source` supports `readinto`. Otherwise we fall
+    back to :func:`shutil.copyfileobj`.
+    """
+    readinto = getattr(source, 'readinto', None)
+    if readinto is None:
+        shutil.copyfileobj(source, target, buffer_size)
+        return
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    while True:
+        num = readinto(buf)
+        if not num:
+            break
+        target.write(view[:num])
+
+
+class UploadStream(object):
+    """A wrapper around the writable file object `stream`, counting the
+    bytes written and the time spent writing them.
+
+    If `limit` is set, at most `limit` bytes are accepted. Writing
+    more raises :class:`werkzeug.exceptions.RequestEntityTooLarge`.
+
+    If `hash_name` (a name known to :func:`hashlib.new`) is set, a
+    digest of all data written is computed on the fly. Get it with
+    :meth:`hexdigest`.
+
+    All other attributes are taken from `stream`.
+    """
+    def __init__(self, stream, limit=None, hash_name=None):
+        self.stream = stream
+        self.limit = limit
+        self.size = 0
+        self.write_time = 0.0
+        self.hasher = None
+        if hash_name is not None:
+            self.hasher = hashlib.new(hash_name)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.limit is not None and self.size > self.limit:
+            raise RequestEntityTooLarge('Uploaded file too large.')
+        if self.hasher is not None:
+            self.hasher.update(data)
+        start = time.perf_counter()
+        result = self.stream.write(data)
+        self.write_time += time.perf_counter() - start
+        return result
+
+    def hexdigest(self):
+        """Get the hex digest of the data written so far.
+
+        Returns ``None`` if no `hash_name` was given.
+        """
+        if self.hasher is None:
+            return None
+        return self.hasher.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+
+class ChunkStream(UploadStream):
+    """A writer putting the :data:`Chunk` `chunk` right at its offset
+    into the partial file `path` of a chunked upload.
+
+    At most `limit` bytes are accepted. As then the whole upload is
+    too large, writing more removes the partial file and its chunk
+    index before :class:`werkzeug.exceptions.RequestEntityTooLarge` is
+    raised.
+
+    If the partial file is created, `preallocate_size` bytes of disk
+    space are allocated for it (see :func:`preallocate`). `created`
+    tells whether the partial file was created.
+    """
+    def __init__(self, path, chunk, limit=None,
+                 buffer_size=WRITE_BUFFER_SIZE, preallocate_size=0):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o666)
+        self.path = path
+        self.chunk = chunk
+        self.created = not os.fstat(fd).st_size
+        if preallocate_size and self.created:
+            preallocate(fd, preallocate_size)
+        stream = os.fdopen(fd, 'wb', buffer_size)
+        stream.seek(chunk.offset)
+        super(ChunkStream, self).__init__(stream, limit)
+
+    def write(self, data):
+        try:
+            return super(ChunkStream, self).write(data)
+        except RequestEntityTooLarge:
+            self.stream.close()
+            discard_chunks(self.path)
+            raise
+
+
+class UploadRequest(Request):
+    """A request that streams uploaded files into `storage`.
+
+    By default Werkzeug spools uploaded files into memory or into a
+    temporary file, which then has to be copied to its final
+    location. If `storage` is set, we instead write each uploaded file
+    right into a writer got from its :meth:`FlatStorage.open_write`,
+    that can be committed to its final place later on.
+
+    The writers created are kept in `upload_streams`, wrapped in
+    :class:`UploadStream` objects.
+
+    If `max_file_size` is set, parsing an uploaded file larger than
+    that raises :class:`werkzeug.exceptions.RequestEntityTooLarge`. If
+    `hash_name` is set, digests of uploaded files are computed while
+    they are parsed.
+
+    If `open_chunk` is set, it is called with the form fields parsed
+    before an uploaded file (`parsed_fields`). If it returns a writer
+    (like a :class:`ChunkStream`), the file is written there instead.
+    Chunks of chunked uploads are so written right into their partial
+    file. These writers are not kept in `upload_streams`.
+    """
+
+    #: storage to stream uploaded files into. If ``None``, uploads are
+    #: spooled as usual.
+    storage = None
+
+    #: maximum size of a single uploaded file. ``None`` means no limit.
+    max_file_size = None
+
+    #: hash algorithm to compute digests of uploaded files with.
+    hash_name = None
+
+    #: callable getting a writer for uploaded files from the form
+    #: fields sent before them. Returns ``None`` for regular files.
+    open_chunk = None
+
+    def __init__(self, *args, **kw):
+        super(UploadRequest, self).__init__(*args, **kw)
+        self.upload_streams = []
+        self.parsed_fields = MultiDict()
+
+    def make_form_data_parser(self):
+        parser = super(UploadRequest, self).make_form_data_parser()
+        parser.cls = self.record_fields
+        return parser
+
+    def record_fields(self, items=()):
+        """Get a :attr:`parameter_storage_class` instance of `items`,
+        adding each of them to `parsed_fields` on the way.
+
+        The multipart parser of Werkzeug builds the form while parts
+        are parsed, so `parsed_fields` holds all fields sent before a
+        file when :meth:`_get_file_stream` is called for it.
+        """
+        def record():
+            for key, value in items:
+                self.parsed_fields.add(key, value)
+                yield key, value
+        return self.parameter_storage_class(record())
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if self.open_chunk is not None:
+            stream = self.open_chunk(self.parsed_fields)
+            if stream is not None:
+                return stream
+        limit = self.max_file_size
+        if limit is not None and total_content_length is not None and (
+                total_content_length <= limit):
+            # the file cannot be larger than the request
+            limit = None
+        if self.storage is not None:
+            size = content_length or None  # 0 if not sent
+            if self.upload_streams:
+                # the file before is complete
+                self.storage.trim(self.upload_streams[-1])
+            elif size is None and total_content_length is not None:
+                # the first file might be the only one. It cannot be
+                # larger than the request.
+                size = total_content_length
+            stream = self.storage.open_write(filename or '', size)
+            self.upload_streams.append(stream)
+        else:
+            stream = super(UploadRequest, self)._get_file_stream(
+                total_content_length, content_type, filename=filename,
+                content_length=content_length)
+        if limit is not None and content_length is not None and (
+                content_length > limit):
+            raise RequestEntityTooLarge('Uploaded file too large.')
+        stream = UploadStream(stream, limit, self.hash_name)
+        if self.storage is not None:
+            self.upload_streams[-1] = stream
+        return stream
+
+
+#: Policies of syncing stored files to disk, see :class:`Syncer`.
+FSYNC_MODES = ('none', 'file', 'batch')
+
+
+def fsync_path(path):
+    """Flush the file or directory at `path` to disk.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SyncBatch(object):
+    """Paths to be synced together by a :class:`Syncer`.
+
+    `done` is set when all `paths` were handled. Errors are kept in
+    `errors` by path.
+    """
+
+    def __init__(self):
+        self.paths = set()
+        self.done = threading.Event()
+        self.errors = dict()
+
+
+class Syncer(object):
+    """Sync stored files to disk as requested by `mode`, one of
+    `FSYNC_MODES`.
+
+    Storages call :meth:`sync` with the path of a file before they
+    rename it into place and with the path of its directory
+    afterwards. So a file shows up under its final name only when
+    its content is on disk and the name survives a crash once
+    :meth:`sync` returned.
+
+    With ``'none'`` (the default) nothing is synced and the OS writes
+    data to disk when it likes. With ``'file'`` each path is synced
+    right away. With ``'batch'`` paths passed by concurrent uploads are
+    collected and synced by a background thread every `interval`
+    seconds (group commit), each path once per batch. Callers wait
+    until their path was synced in all modes.
+
+    Time spent in :meth:`sync` is recorded in `metrics`, if given.
+    """
+
+    def __init__(self, mode='none', interval=0.01, metrics=None):
+        if mode not in FSYNC_MODES:
+            raise ValueError('Invalid fsync mode: %s' % mode)
+        self.mode = mode
+        self.interval = interval
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.batch = SyncBatch()
+        self.thread = None
+
+    def sync(self, path):
+        """Flush the file or directory at `path` to disk, if requested.
+        """
+        if self.mode == 'none':
+            return
+        start = time.perf_counter()
+        if self.mode == 'file':
+            fsync_path(path)
+        else:
+            self.sync_batched(path)
+        if self.metrics is not None:
+            self.metrics.observe(
+                'dropafile_fsync_seconds', time.perf_counter() - start)
+
+    def sync_batched(self, path):
+        """Add `path` to the current batch and wait until it was synced.
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name='dropafile-fsync')
+                self.thread.daemon = True
+                self.thread.start()
+            batch = self.batch
+            batch.paths.add(path)
+            self.pending.set()
+        batch.done.wait()
+        if path in batch.errors:
+            raise batch.errors[path]
+
+    def run(self):
+        """Sync batches of paths, every `interval` seconds if there are
+        any. Runs forever.
+        """
+        while True:
+            self.pending.wait()
+            time.sleep(self.interval)
+            with self.lock:
+                batch, self.batch = self.batch, SyncBatch()
+                self.pending.clear()
+            for path in batch.paths:
+                try:
+                    fsync_path(path)
+                except OSError as err:
+                    batch.errors[path] = err
+            batch.done.set()
+
+
+class LocalStorage(object):
+    """Base for storages keeping files in the local `directory`.
+
+    Writers are hidden temporary files in `directory`, which are moved
+    in place by :meth:`store` when committed. Files are synced to disk
+    by a :class:`Syncer` before and after they are moved.
+
+    Files are written through buffers of `buffer_size` bytes. If
+    `preallocate` is ``True``, disk space is allocated for writers
+    when the size of the upload is passed to :meth:`open_write` (see
+    :func:`preallocate`).
+    """
+
+    #: size of buffers used when writing files.
+    buffer_size = WRITE_BUFFER_SIZE
+
+    #: whether to preallocate disk space for uploads of known size.
+    preallocate = False
+
+    def open_write(self, filename, size=None):
+        """Get a writable file object to stream an uploaded file named
+        `filename` into.
+
+        `size` is the (maximum) size of the upload, if known. Space
+        allocated beyond the content written can be given back with
+        :meth:`trim`. The writer must be passed to :meth:`commit` or
+        :meth:`abort` afterwards.
+        """
+        writer = create_upload_stream(self.directory, self.buffer_size)
+        if self.preallocate and size is not None:
+            preallocate(writer.fileno(), size)
+        return writer
+
+    def commit(self, writer, target, digest=None):
+        """Store the content written to `writer` at `target`.
+
+        With `preallocate` set, `writer` must be an
+        :class:`UploadStream`, as the file is trimmed first (see
+        :meth:`trim`).
+
+        See :meth:`store` for `target`, `digest` and the result.
+        """
+        self.trim(writer)
+        writer.close()
+        return self.store(target, writer.name, digest)
+
+    def trim(self, writer):
+        """Give back disk space preallocated for `writer` beyond the
+        content written so far.
+
+        With `preallocate` set, `writer` must be an
+        :class:`UploadStream`, as the file is truncated to the number
+        of bytes written.
+        """
+        if self.preallocate:
+            writer.truncate(writer.size)
+
+    def abort(self, writer):
+        """Discard the content written to `writer`.
+        """
+        writer.close()
+        if os.path.exists(writer.name):
+            os.unlink(writer.name)
+
+
+class FlatStorage(LocalStorage):
+    """Store uploaded files in `directory` under their filename.
+
+    Files are named after the (secured) filename sent, with a numeric
+    suffix if a file of that name exists already (see
+    :class:`StorePathAllocator`). This is the default storage.
+
+    Storages are used in two steps: :meth:`allocate` reserves a place
+    for an uploaded file (in the order files were sent) and
+    :meth:`store` puts the content there. Uploads may be streamed into
+    a writer got from :meth:`open_write` instead, which is then passed
+    to :meth:`commit` or :meth:`abort`. `directory` is also used for
+    partial files of chunked uploads.
+
+    Digests are computed with `hash_name` (``None`` disables
+    hashing). If `dedup` (one of `DEDUP_MODES`) is set, files
+    identical to a file in `directory` are hardlinked or skipped,
+    see :class:`DropAFileApplication`. Files are synced to disk with
+    `syncer`, by default a :class:`Syncer` syncing nothing.
+    `buffer_size` and `preallocate` tell how files are written, see
+    :class:`LocalStorage`.
+    """
+
+    def __init__(self, directory, hash_name='sha256', dedup=None,
+                 syncer=None, buffer_size=WRITE_BUFFER_SIZE,
+                 preallocate=False):
+        if dedup is not None:
+            if dedup not in DEDUP_MODES:
+                raise ValueError('Invalid dedup mode: %s' % dedup)
+            if hash_name is None:
+                raise ValueError('Deduplication requires a hash_name')
+        if syncer is None:
+            syncer = Syncer()
+        self.directory = directory
+        self.hash_name = hash_name
+        self.dedup = dedup
+        self.syncer = syncer
+        self.buffer_size = buffer_size
+        self.preallocate = preallocate
+        self.path_allocator = StorePathAllocator(directory)
+        self.digest_index = None
+        if dedup is not None:
+            self.digest_index = DigestIndex(directory, hash_name)
+
+    def allocate(self, filename):
+        """Reserve a place for an uploaded file named `filename`.
+
+        Returns the path claimed.
+        """
+        return self.path_allocator.get_store_path(filename)
+
+    def release(self, target):
+        """Give up `target`, as returned by :meth:`allocate`, if no
+        file was stored there.
+
+        The empty file claiming `target` is removed.
+        """
+        try:
+            if os.path.getsize(target) == 0:
+                os.unlink(target)
+        except OSError:
+            pass
+
+    def store(self, target, source, digest=None):
+        """Store `source` at `target`, as returned by :meth:`allocate`.
+
+        `source` is the path of a file in `directory` or a file object,
+        which is copied into one first. The file is then renamed to
+        `target`, so `target` never holds partial content. `digest` is
+        the digest of the content, if known already. Otherwise it is
+        computed from the stored file.
+
+        Returns a :data:`StoredFile`, which points to an existing file,
+        if the new one was skipped as duplicate.
+        """
+        if not isinstance(source, str):
+            file_descr = create_upload_stream(
+                self.directory, self.buffer_size)
+            try:
+                with file_descr:
+                    copy_stream(source, file_descr, self.buffer_size)
+            except Exception:
+                os.unlink(file_descr.name)
+                raise
+            source = file_descr.name
+        self.syncer.sync(source)
+        os.rename(source, target)
+        stored_file = self.check_duplicate(target, digest)
+        self.syncer.sync(os.path.dirname(target))
+        return stored_file
+
+    def check_duplicate(self, path, digest=None):
+        """Get a :data:`StoredFile` for the file stored at `path`.
+
+        If `dedup` is set and an identical file exists already, the
+        new file is replaced by a hardlink or removed. The hardlink is
+        created under a temporary name and renamed over `path`, so
+        `path` exists all the time.
+        """
+        size = os.path.getsize(path)
+        if self.hash_name is None:
+            return StoredFile(path, size, None)
+        if digest is None:
+            digest = get_file_digest(path, self.hash_name)
+        if self.digest_index is not None:
+            existing = self.digest_index.get(digest)
+            if existing is None:
+                self.digest_index.add(digest, path)
+            elif self.dedup == 'skip':
+                os.unlink(path)
+                return StoredFile(existing, size, digest)
+            else:
+                tmp_path = os.path.join(
+                    os.path.dirname(path), '.link-%s' % binascii.hexlify(
+                        os.urandom(8)).decode('ascii'))
+                os.link(existing, tmp_path)
+                os.replace(tmp_path, path)
+        return StoredFile(path, size, digest)
+
+
+class ContentAddressedStorage(LocalStorage):
+    """Store uploaded files in `directory` by content digest.
+
+    Each distinct content is stored once, as a blob named after its
+    digest (computed with `hash_name`) in ``objects/``. Blobs are
+    sharded into `depth` levels of subdirectories named after
+    two-digit prefixes of the digest, like
+    ``objects/ab/cd/abcd0123...``, to keep directories small.
+
+    Filenames sent, digests, sizes and upload times are appended to an
+    index file (``index.jsonl``, one JSON object per line), which is
+    read back into memory on startup. See :meth:`lookup`.
+
+    Has the same interface as :class:`FlatStorage`. Blobs, their
+    directories and the index are synced to disk with `syncer`.
+    """
+
+    def __init__(self, directory, hash_name='sha256', depth=2, syncer=None,
+                 buffer_size=WRITE_BUFFER_SIZE, preallocate=False):
+        if hash_name is None:
+            raise ValueError('Content addressed storage requires a hash_name')
+        if syncer is None:
+            syncer = Syncer()
+        self.syncer = syncer
+        self.buffer_size = buffer_size
+        self.preallocate = preallocate
+        self.directory = directory
+        self.hash_name = hash_name
+        self.depth = depth
+        self.objects_dir = os.path.join(directory, 'objects')
+        self.index_path = os.path.join(directory, 'index.jsonl')
+        self.lock = threading.Lock()
+        #: maps filenames sent to the list of index entries.
+        self.entries = dict()
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as file_descr:
+                for line in file_descr:
+                    self.add_entry(json.loads(line.decode('utf-8')))
+
+    def add_entry(self, entry):
+        with self.lock:
+            self.entries.setdefault(entry['name'], []).append(entry)
+
+    def lookup(self, filename):
+        """Get the index entries of files uploaded as `filename`.
+
+        Entries are dicts with keys `name`, `digest`, `size` and
+        `time` (seconds since epoch), oldest first.
+        """
+        with self.lock:
+            return list(self.entries.get(filename, []))
+
+    def get_blob_path(self, digest):
+        """Get the path of the blob with content digest `digest`.
+        """
+        shards = [digest[num * 2:num * 2 + 2] for num in range(self.depth)]
+        return os.path.join(self.objects_dir, *(shards + [digest]))
+
+    def allocate(self, filename):
+        """Reserve a place for an uploaded file named `filename`.
+
+        Places of blobs depend on their content, so this is the
+        filename only.
+        """
+        return filename
+
+    def release(self, target):
+        """Give up `target`, as returned by :meth:`allocate`.
+
+        Nothing was reserved, so there is nothing to do.
+        """
+
+    def store(self, target, source, digest=None):
+        """Store `source` as blob and record it as `target` in the
+        index.
 
+        `source` is the path of a file in `directory` or a file object,
+        which is copied into one first. `digest` is the digest of the
+        content, if known already. Blobs existing already are not
+        stored again.
 
-def handle_options(args):
-    """Handle commandline options.
+        Returns a :data:`StoredFile` pointing to the blob.
+        """
+        if not isinstance(source, str):
+            stream = UploadStream(
+                create_upload_stream(self.directory, self.buffer_size),
+                hash_name=self.hash_name)
+            try:
+                copy_stream(source, stream, self.buffer_size)
+            finally:
+                stream.close()
+            source, digest = stream.name, stream.hexdigest()
+        if digest is None:
+            digest = get_file_digest(source, self.hash_name)
+        size = os.path.getsize(source)
+        path = self.get_blob_path(digest)
+        if os.path.exists(path):
+            os.unlink(source)
+        else:
+            blob_dir = os.path.dirname(path)
+            new_dirs = not os.path.isdir(blob_dir)
+            try:
+                os.makedirs(blob_dir)
+            except OSError as err:
+                if err.errno != errno.EEXIST:  # pragma: no cover
+                    raise
+            self.syncer.sync(source)
+            os.rename(source, path)
+            self.syncer.sync(blob_dir)
+            if new_dirs:
+                # make entries of created directories durable
+                for num in range(self.depth + 1):
+                    blob_dir = os.path.dirname(blob_dir)
+                    self.syncer.sync(blob_dir)
+        entry = dict(name=target, digest=digest, size=size, time=time.time())
+        fd = os.open(
+            self.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, (json.dumps(entry, sort_keys=True) + '\n').encode(
+                'utf-8'))
+        finally:
+            os.close(fd)
+        self.syncer.sync(self.index_path)
+        self.add_entry(entry)
+        return StoredFile(path, size, digest)
 
-    Expects the arguments passed to dropafile as a list of
-    arguments. `args` is expected to represent ``sys.argv[1:]``,
-    i.e. the arguments when called, without the programme name.
 
-    Returns parsed options as provided by :mod:`argparse`.
-    """
-    parser = argparse.ArgumentParser(description="Start dropafile app.")
-    parser.add_argument(
-        '--host', required=False, default='localhost',
-        help=(
-            'Host we bind to. An IP address or DNS name. `localhost`'
-            ' by default.'
-            ),
-        )
-    parser.add_argument(
-        '-p', '--port', required=False, default=8443, type=int,
-        help=(
-            'Port we listen at. An integer. 8443 by default.'
-            )
-        )
-    parser.add_argument(
-        '-s', '--secret', required=False, metavar='PASSWORD',
-        help=(
-            'Password to access dropafile. If none is given we generate '
-            'one.'
-            )
-        )
-    opts = parser.parse_args(args)
-    return opts
+#: Available storages by name.
+STORAGES = OrderedDict([
+    ('flat', FlatStorage),
+    ('cas', ContentAddressedStorage),
+    ])
 
 
-def get_random_password():
-    """Get a password generated from `ALLOWED_PWD_CHARS`.
+class UploadIncomplete(InternalServerError):
+    """Raised if only some of the files sent in a request could be
+    stored.
 
-    The password entropy should be >= 128 bits. We use `SystemRandom()`,
-    which should provide enough randomness to work properly.
+    `stored_files` are the :data:`StoredFile` stored nonetheless,
+    `total` is the number of files sent. The response tells how many
+    files were stored and sends their digests (computed with
+    `hash_name`) in `X-Upload-Digest` headers, like successful
+    responses do.
     """
-    rnd = random.SystemRandom()
-    return ''.join(
-        [rnd.choice(ALLOWED_PWD_CHARS) for x in range(23)])
-
 
-def get_store_path(directory, filename):
-    """Get a path where we can safely store a file.
+    def __init__(self, stored_files, total, hash_name=None):
+        super(UploadIncomplete, self).__init__(
+            'Stored %d of %d files.' % (len(stored_files), total))
+        self.stored_files = stored_files
+        self.total = total
+        self.hash_name = hash_name
 
-    The file should be stored in `directory` under name `filename`.
-    If `filename` already exists in `directory`, we construct new
-    names by appending '-<NUM>' to the original filename, where
-    ``<NUM>`` is a number counting up.
-    """
-    filename = secure_filename(filename)
-    path = os.path.join(directory, filename)
-    num = 1
-    while os.path.exists(path):
-        path = os.path.join(directory, '%s-%s' % (filename, num))
-        num += 1
-    return path
+    def get_headers(self, *args, **kw):
+        headers = super(UploadIncomplete, self).get_headers(*args, **kw)
+        for stored_file in self.stored_files:
+            if stored_file.digest is not None:
+                headers.append(('X-Upload-Digest', '%s=%s' % (
+                    self.hash_name, stored_file.digest)))
+        return headers
 
 
 class DropAFileApplication(object):
@@ -118,26 +1788,212 @@ class DropAFileApplication(object):
     protected web interface for file uploads.
 
     `password` is required to access the application's service. If
-    none is provided, we generate one for you.
+    none is provided, we generate one for you. Instead of a password,
+    you can pass a `password_hash` as created by
+    :func:`hash_password`.
 
     `upload_dir` is the directory, where we store files uploaded by
     users. If none is given we create a temporary directory on
     start-up. Please note: the directory is not removed on shutdown.
+
+    The static files listed in `PATH_MAP` are read into memory once,
+    when the application is created. If `reload_static` is ``True``,
+    we check the modification time of each static file when it is
+    requested and re-read it, if it changed. This is handy during
+    development.
+
+    Static files are sent with an `ETag`, a `Last-Modified` date and a
+    `Cache-Control` header allowing browsers to keep them for
+    `max_age` seconds. Conditional requests for unchanged files are
+    answered with ``304 Not Modified``.
+
+    Compressed variants of static files are created on startup and
+    sent to clients that accept them.
+
+    `upload_mode` tells how uploaded files are received. In
+    ``'stream'`` mode (the default) uploads are written directly into
+    `storage` while the request is parsed and committed afterwards. In
+    ``'spool'`` mode, Werkzeug buffers uploads in memory or temporary
+    files before they are copied to `storage`.
+
+    All files sent in form fields named ``file`` (repeated or not) or
+    ``file[<NUM>]`` are stored. If several files are sent in one
+    request, they are moved in place by up to `finalize_workers`
+    threads.
+
+    `max_file_size` and `max_request_size` limit the size of single
+    uploaded files and of whole requests in bytes. Requests exceeding
+    them are answered with ``413 Request Entity Too Large``, if
+    possible before their body is read. Unauthorized requests are
+    answered without reading their body at all.
+
+    Timings and sizes of requests are collected in :attr:`metrics`.
+    They can be fetched from `metrics_path` (authentication required)
+    in Prometheus text format. If the `ssl_context` connections are
+    served with is given, TLS handshake counters are included.
+
+    If `session_lifetime` (seconds) is set, clients logged in with
+    basic auth get a signed session cookie. Until it expires, the
+    cookie is checked instead of the password. The cookies are signed
+    with a random `session_key` created here, so they are valid in
+    processes forked off later, but not after restarts.
+
+    Digests of uploaded files are computed with `hash_name` (any name
+    known to :func:`hashlib.new`, ``None`` to disable hashing) while
+    they are received and sent back in `X-Upload-Digest` headers, one
+    per stored file. If `manifest_path` is set, a line with digest and
+    path of each stored file is appended there, in the format of
+    ``sha256sum`` and friends.
+
+    `storage` names the layout of `upload_dir`, one of `STORAGES`.
+    With ``'flat'`` (the default) files are stored under their
+    filename (see :class:`FlatStorage`), with ``'cas'`` under their
+    digest (see :class:`ContentAddressedStorage`). A storage object
+    (like :class:`dropafile.objectstore.ObjectStorage`) can be passed
+    as well. Its `directory` is then used as `upload_dir`.
+
+    If `dedup` is set, files identical to a file stored in
+    `upload_dir` already are not kept twice. With ``'link'`` they are
+    replaced by a hardlink to the existing file, with ``'skip'`` they
+    are removed and the existing file is reported instead. Files are
+    looked up in a :class:`DigestIndex` built on startup. Content
+    addressed storage always deduplicates, `dedup` applies to flat
+    storage only.
+
+    Uploads are written to temporary files and renamed when complete,
+    so stored files never have partial content. `fsync` (one of
+    `FSYNC_MODES`) tells whether and how they are synced to disk
+    before the upload is answered: ``'none'`` (the default) leaves it
+    to the OS, ``'file'`` syncs each file and ``'batch'`` syncs the
+    files of concurrent uploads together every `fsync_interval`
+    seconds, see :class:`Syncer`. Applies to flat and content
+    addressed storage.
+
+    Files are written through buffers of `write_buffer_size` bytes. If
+    `preallocate` is ``True``, disk space for uploads is allocated
+    before they are written, when their size is known: from the
+    `Content-Length` header of a part, from the total file size sent
+    with chunks or, for the first file of a request, from the
+    `Content-Length` of the request. Space allocated for the first
+    file beyond its size is given back when another file follows (see
+    :func:`preallocate`). Filesystems without native support emulate
+    it by writing to each block, so it is off by default.
     """
 
     #: the password we require (no username neccessary)
     password = None
 
+    #: a hash of the password we require, see :func:`hash_password`.
+    password_hash = None
+
+    #: the :class:`AuthCache` of verified credentials.
+    auth_cache = None
+
+    #: number of seconds session cookies are valid. ``None`` means no
+    #: sessions.
+    session_lifetime = None
+
+    #: maximum number of threads storing files of a single request.
+    finalize_workers = 4
+
     #: a path where we store files uploaded by users.
     upload_dir = None
 
-    def __init__(self, password=None, upload_dir=None):
-        if password is None:
+    #: the storage (like :class:`FlatStorage`) of `upload_dir`.
+    storage = None
+
+    #: whether to re-read static files when they change on disk.
+    reload_static = False
+
+    #: number of seconds browsers may cache static files.
+    max_age = 3600
+
+    #: how to receive uploads, ``'stream'`` or ``'spool'``.
+    upload_mode = 'stream'
+
+    #: maximum size of an uploaded file. ``None`` means no limit.
+    max_file_size = None
+
+    #: maximum size of a request body. ``None`` means no limit.
+    max_request_size = None
+
+    #: path to get :attr:`metrics` from.
+    metrics_path = '/metrics'
+
+    #: minimum size of static files to send from disk instead of
+    #: memory, see :meth:`get_static_response`.
+    sendfile_min_size = 32 * 1024
+
+    #: the :class:`Metrics` recorded for this application.
+    metrics = None
+
+    #: hash algorithm to compute digests of uploaded files with.
+    hash_name = 'sha256'
+
+    #: path of a file to append digests of stored files to.
+    manifest_path = None
+
+    #: size of buffers used when writing uploaded files.
+    write_buffer_size = WRITE_BUFFER_SIZE
+
+    #: whether to preallocate disk space for uploads of known size.
+    preallocate = False
+
+    def __init__(self, password=None, upload_dir=None, reload_static=False,
+                 max_age=3600, upload_mode='stream', max_file_size=None,
+                 max_request_size=None, password_hash=None,
+                 session_lifetime=None, finalize_workers=4,
+                 hash_name='sha256', manifest_path=None, dedup=None,
+                 storage='flat', ssl_context=None, fsync='none',
+                 fsync_interval=0.01, write_buffer_size=WRITE_BUFFER_SIZE,
+                 preallocate=False):
+        if password_hash is not None:
+            if password is not None:
+                raise ValueError('Pass either password or password_hash')
+            if password_hash.split('$')[0] not in HASH_METHODS:
+                raise ValueError('Invalid password hash.')
+        elif password is None:
             password = get_random_password()
         self.password = password
+        self.password_hash = password_hash
+        self.auth_cache = AuthCache()
+        self.session_lifetime = session_lifetime
+        self.session_key = os.urandom(32)
+        self.finalize_workers = finalize_workers
+        self.executor = ThreadPoolExecutor(max_workers=finalize_workers)
+        if not isinstance(storage, str):
+            upload_dir = storage.directory
         if upload_dir is None:
             upload_dir = tempfile.mkdtemp()
         self.upload_dir = upload_dir
+        self.reload_static = reload_static
+        self.max_age = max_age
+        if upload_mode not in ('stream', 'spool'):
+            raise ValueError('Invalid upload mode: %s' % upload_mode)
+        self.upload_mode = upload_mode
+        self.max_file_size = max_file_size
+        self.max_request_size = max_request_size
+        self.metrics = Metrics(ssl_context)
+        if hash_name is not None:
+            hashlib.new(hash_name)  # raises ValueError if unsupported
+        self.hash_name = hash_name
+        self.manifest_path = manifest_path
+        self.write_buffer_size = write_buffer_size
+        self.preallocate = preallocate
+        if isinstance(storage, str):
+            if storage not in STORAGES:
+                raise ValueError('Invalid storage: %s' % storage)
+            storage_kw = dict(
+                hash_name=hash_name,
+                syncer=Syncer(fsync, fsync_interval, metrics=self.metrics),
+                buffer_size=write_buffer_size, preallocate=preallocate)
+            if storage == 'flat':
+                storage_kw['dedup'] = dedup
+            storage = STORAGES[storage](upload_dir, **storage_kw)
+        self.storage = storage
+        self.static_assets = dict(
+            [(path, load_static_asset(filename, mimetype))
+             for path, (filename, mimetype) in PATH_MAP.items()])
 
     def check_auth(self, request):
         """Check basic auth against local password.
@@ -147,13 +2003,67 @@ class DropAFileApplication(object):
 
         `request` must contain basic-auth authorization headers (as
         set by browsers) to succeed.
+
+        Passwords are compared in constant time. Authorization headers
+        verified successfully are remembered in `auth_cache`, so the
+        password hash has to be computed only once per client (and
+        process, see :class:`AuthCache`).
         """
+        header = request.environ.get('HTTP_AUTHORIZATION')
+        if header is None:
+            return False
+        key = hashlib.sha256(header.encode('latin-1')).digest()
+        if key in self.auth_cache:
+            return True
         auth = request.authorization
-        if auth is None:
+        if auth is None or auth.password is None:
+            return False
+        if self.password_hash is not None:
+            verified = verify_password(auth.password, self.password_hash)
+        else:
+            verified = hmac.compare_digest(
+                auth.password.encode('utf-8'), self.password.encode('utf-8'))
+        if verified:
+            self.auth_cache.add(key)
+        return verified
+
+    def sign_session(self, expires):
+        """Get the signature of a session valid until `expires` (a
+        string with seconds since epoch).
+        """
+        return hmac.new(
+            self.session_key, expires.encode('ascii'),
+            hashlib.sha256).hexdigest()
+
+    def check_session(self, request):
+        """Check the session cookie sent with `request`.
+
+        Session cookies contain their expiry date and its signature.
+        Returns ``True`` if sessions are enabled and the cookie is
+        valid, ``False`` otherwise.
+        """
+        if self.session_lifetime is None:
+            return False
+        cookie = request.cookies.get(SESSION_COOKIE, '')
+        match = RE_SESSION_COOKIE.match(cookie)
+        if match is None:
             return False
-        if auth.password != self.password:
+        expires, signature = match.groups()
+        if int(expires) < time.time():
             return False
-        return True
+        return hmac.compare_digest(signature, self.sign_session(expires))
+
+    def start_session(self, response):
+        """Set a new session cookie in `response`, if sessions are
+        enabled.
+        """
+        if self.session_lifetime is None:
+            return
+        expires = '%d' % (time.time() + self.session_lifetime)
+        response.set_cookie(
+            SESSION_COOKIE, '%s.%s' % (expires, self.sign_session(expires)),
+            max_age=self.session_lifetime, secure=True, httponly=True,
+            samesite='Strict')
 
     def authenticate(self):
         """Send 401 requesting basic auth from client.
@@ -171,28 +2081,519 @@ class DropAFileApplication(object):
                   'Content-Type': 'text/html'}
             )
 
+    def check_request_size(self, request):
+        """Make sure, the body of `request` is not too large.
+
+        The size is taken from the `Content-Length` header, so the
+        body is not read. Raises
+        :class:`werkzeug.exceptions.RequestEntityTooLarge` if it
+        exceeds `max_request_size`.
+        """
+        length = request.content_length
+        if length is None:
+            return
+        if self.max_request_size is not None and (
+                length > self.max_request_size):
+            raise RequestEntityTooLarge('Request too large.')
+
     def handle_uploaded_files(self, request):
-        """Look for an upload file in `request`.
+        """Look for uploaded files in `request`.
+
+        Files found are saved to `storage`. Files already streamed
+        into `storage` by an :class:`UploadRequest` are committed
+        instead of copied. Other streamed files are aborted.
+
+        Time spent parsing the request and writing files is recorded
+        in `metrics`. Stored files are logged, also if others failed
+        (see :class:`UploadIncomplete`).
+
+        Returns a list of :data:`StoredFile`.
+        """
+        streams = getattr(request, 'upload_streams', [])
+        start = time.perf_counter()
+        try:
+            form, files = request.form, request.files
+            parsed = time.perf_counter()
+            write_time = sum([stream.write_time for stream in streams])
+            try:
+                stored_files = self.store_uploaded_files(
+                    form, files, streams)
+            except UploadIncomplete as exc:
+                for stored_file in exc.stored_files:
+                    self.log_received(
+                        stored_file, request, time.perf_counter() - start)
+                raise
+            stored = time.perf_counter()
+        finally:
+            for stream in streams:
+                self.storage.abort(stream)
+        if files:
+            self.metrics.observe_upload(
+                request.content_length or 0, parsed - start - write_time,
+                write_time + stored - parsed)
+        for stored_file in stored_files:
+            self.log_received(stored_file, request, stored - start)
+        return stored_files
+
+    def log_received(self, stored_file, request, duration):
+        """Log, that the :data:`StoredFile` `stored_file` was received
+        with `request`.
+
+        `duration` is the number of seconds it took to receive and
+        store the file.
+        """
+        logger.info("RECEIVED: %s", stored_file.path, extra=dict(
+            path=stored_file.path, size=stored_file.size,
+            digest=stored_file.digest, duration=round(duration, 6),
+            client=request.remote_addr, status=200))
+
+    def log_rejected(self, request, exc):
+        """Log, that `request` was rejected with the
+        :class:`werkzeug.exceptions.HTTPException` `exc`.
+        """
+        logger.warning("REJECTED: %s %s", exc.code, exc.name, extra=dict(
+            size=request.content_length, client=request.remote_addr,
+            status=exc.code))
 
-        If one is found, it is saved to `self.upload_dir`.
+    def store_uploaded_files(self, form, files, streams=()):
+        """Store the files sent in `files`.
+
+        `form` and `files` are multi dicts as found in
+        :attr:`werkzeug.wrappers.Request.form` and
+        :attr:`werkzeug.wrappers.Request.files`. We store all files
+        sent in fields matching `RE_FILE_FIELD`. `streams` is a list
+        of writers of `storage` already holding the contents of
+        uploaded files. Streams of stored files are committed and
+        removed from `streams`.
+
+        Places in `storage` are allocated in the order files were
+        sent. Moving the files in place is then done by the threads of
+        `executor`, if more than one file was sent. Places of files
+        that could not be stored are released again.
+
+        Chunks of files (requests with a `dzuuid` form field) are
+        handled by :meth:`store_chunk`.
+
+        Returns the list of :data:`StoredFile` stored. If storing
+        fails for all files, the first error is raised. If only some
+        files failed, :class:`UploadIncomplete` is raised.
+        """
+        uploaded_files = [
+            uploaded_file for name, uploaded_file in files.items(multi=True)
+            if RE_FILE_FIELD.match(name)]
+        if not uploaded_files:
+            return []
+        if 'dzuuid' in form:
+            stored_file = self.store_chunk(form, uploaded_files[0])
+            return [stored_file] if stored_file is not None else []
+        jobs = []
+        for uploaded_file in uploaded_files:
+            target = self.storage.allocate(uploaded_file.filename)
+            streamed = uploaded_file.stream in streams
+            if streamed:
+                streams.remove(uploaded_file.stream)
+            jobs.append((uploaded_file, target, streamed))
+        if len(jobs) == 1:
+            results = [self.run_job(self.finalize_upload, *jobs[0])]
+        else:
+            results = list(self.executor.map(
+                lambda job: self.run_job(self.finalize_upload, *job), jobs))
+        stored_files, errors = [], []
+        for job, (stored_file, error) in zip(jobs, results):
+            if error is None:
+                stored_files.append(stored_file)
+                continue
+            self.storage.release(job[1])
+            errors.append(error)
+        if not errors:
+            return stored_files
+        if not stored_files:
+            raise errors[0]
+        for error in errors:
+            logger.error(
+                "Storing an uploaded file failed.", exc_info=error)
+        raise UploadIncomplete(stored_files, len(jobs), self.hash_name)
+
+    def run_job(self, func, *args):
+        """Call `func` with `args`.
+
+        Returns a tuple `(result, None)`, or `(None, exception)` if
+        `func` raised an exception.
+        """
+        try:
+            return func(*args), None
+        except Exception as exc:
+            return None, exc
+
+    def finalize_upload(self, uploaded_file, target, streamed):
+        """Put `uploaded_file` into `storage` at `target`.
+
+        If `streamed` is ``True``, the file was streamed into a writer
+        of `storage` already, which is committed (or aborted, if that
+        fails). Otherwise it is copied.
+
+        Returns the :data:`StoredFile` stored.
+        """
+        digest = None
+        if isinstance(uploaded_file.stream, UploadStream):
+            digest = uploaded_file.stream.hexdigest()
+        if streamed:
+            try:
+                stored_file = self.storage.commit(
+                    uploaded_file.stream, target, digest)
+            except Exception:
+                self.storage.abort(uploaded_file.stream)
+                raise
+        else:
+            stored_file = self.storage.store(
+                target, uploaded_file.stream, digest)
+        self.write_manifest(stored_file)
+        return stored_file
+
+    def write_manifest(self, stored_file):
+        """Append a line with digest and path of the :data:`StoredFile`
+        `stored_file` to `manifest_path`, if set.
+
+        The line is written with a single call to a file opened in
+        append mode, so concurrent writers (also in other processes)
+        do not mix their lines.
         """
-        uploaded_file = request.files.get('file', None)
-        if uploaded_file is None:
+        if self.manifest_path is None or stored_file.digest is None:
             return
-        path = get_store_path(self.upload_dir, uploaded_file.filename)
-        print("RECEIVED: %s" % path)
-        uploaded_file.save(path)
+        line = '%s  %s\n' % (stored_file.digest, stored_file.path)
+        fd = os.open(
+            self.manifest_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def set_digest_headers(self, response, stored_files):
+        """Send the digests of `stored_files` with `response`.
+
+        Each :data:`StoredFile` gets an `X-Upload-Digest` header like
+        ``sha256=<HEXDIGEST>``, in the order files were sent.
+        """
+        for stored_file in stored_files:
+            if stored_file.digest is not None:
+                response.headers.add('X-Upload-Digest', '%s=%s' % (
+                    self.hash_name, stored_file.digest))
+
+    def get_chunk(self, form):
+        """Get the :data:`Chunk` described by the chunk fields in
+        `form` (see :meth:`store_chunk`).
+
+        Raises :class:`werkzeug.exceptions.BadRequest` if the fields
+        are missing or invalid and
+        :class:`werkzeug.exceptions.RequestEntityTooLarge` if the
+        complete file would exceed `max_file_size`.
+        """
+        try:
+            upload_id = form['dzuuid']
+            index = int(form['dzchunkindex'])
+            total = int(form['dztotalchunkcount'])
+            offset = int(form.get('dzchunkbyteoffset') or (
+                index * int(form['dzchunksize'])))
+            file_size = int(form.get('dztotalfilesize') or 0)
+        except (KeyError, ValueError):
+            raise BadRequest('Invalid chunk data.')
+        if not RE_UPLOAD_ID.match(upload_id) or not (
+                0 <= index < total <= MAX_CHUNK_COUNT) or not (
+                0 <= offset) or file_size < 0:
+            raise BadRequest('Invalid chunk data.')
+        limit = self.max_file_size
+        if limit is not None and (offset >= limit or file_size > limit):
+            discard_chunks(self.get_partial_path(upload_id))
+            raise RequestEntityTooLarge('Uploaded file too large.')
+        if file_size and (total > file_size or offset >= file_size):
+            raise BadRequest('Invalid chunk data.')
+        return Chunk(upload_id, index, total, offset, file_size)
+
+    def get_partial_path(self, upload_id):
+        """Get the path of the partial file of chunked upload
+        `upload_id`.
+
+        Its chunk index is stored next to it with suffix ``.idx``. When
+        complete, it is renamed to suffix ``.complete`` and a marker
+        with suffix ``.done`` is left.
+        """
+        return os.path.join(self.upload_dir, '.chunks-%s' % upload_id)
+
+    def open_chunk(self, form):
+        """Get a :class:`ChunkStream` to write the chunk described by
+        the chunk fields in `form` into.
+
+        Returns ``None`` if `form` contains no chunk fields. Chunks of
+        uploads completed already are written to :data:`os.devnull`.
+        When a partial file is created, leftovers of uploads not
+        finished in time are removed (see :meth:`remove_stale_chunks`).
+
+        See :meth:`get_chunk` for errors raised.
+        """
+        if 'dzuuid' not in form:
+            return None
+        chunk = self.get_chunk(form)
+        path = self.get_partial_path(chunk.upload_id)
+        if os.path.exists(path + '.done'):
+            return ChunkStream(os.devnull, chunk)
+        limit = None
+        if self.max_file_size is not None:
+            limit = self.max_file_size - chunk.offset
+        stream = ChunkStream(
+            path, chunk, limit, self.write_buffer_size,
+            chunk.file_size if self.preallocate else 0)
+        if stream.created:
+            self.remove_stale_chunks()
+        return stream
+
+    def remove_stale_chunks(self):
+        """Remove partial files, chunk indexes and markers of chunked
+        uploads not touched for `CHUNK_MAX_AGE` seconds.
+        """
+        max_mtime = time.time() - CHUNK_MAX_AGE
+        for name in os.listdir(self.upload_dir):
+            if not name.startswith('.chunks-'):
+                continue
+            path = os.path.join(self.upload_dir, name)
+            try:
+                if os.path.getmtime(path) < max_mtime:
+                    os.unlink(path)
+            except OSError:
+                # removed concurrently
+                pass
+
+    def store_chunk(self, form, uploaded_file):
+        """Store `uploaded_file`, a chunk of a file sent in pieces.
+
+        Dropzone (>= 5) can split uploads into chunks sent in separate
+        requests. Each chunk comes with form fields `dzuuid`
+        identifying the upload, `dzchunkindex`, `dztotalchunkcount`,
+        `dzchunkbyteoffset` and `dztotalfilesize`. We write each chunk
+        at its offset into a hidden partial file in `upload_dir` and
+        record its index. Chunks may arrive in any order and may be
+        re-sent, also after the upload was completed. Chunks streamed
+        into a :class:`ChunkStream` by an :class:`UploadRequest` are
+        in place already.
+
+        When all chunks arrived, the partial file is put into
+        `storage` and the :data:`StoredFile` is returned. Otherwise we
+        return ``None``. With `preallocate` set, disk space for the
+        whole file is allocated when the partial file is created, if
+        the client sent `dztotalfilesize`.
+
+        Raises :class:`werkzeug.exceptions.BadRequest` if the chunk
+        fields are missing or invalid or the complete file does not
+        match `dztotalfilesize`. In the latter case the received
+        chunks are discarded, so the upload can be sent again. Raises
+        :class:`werkzeug.exceptions.RequestEntityTooLarge` if the
+        complete file would exceed `max_file_size`.
+        """
+        stream = uploaded_file.stream
+        if not isinstance(stream, ChunkStream):
+            stream = self.open_chunk(form)
+            try:
+                copy_stream(
+                    uploaded_file.stream, stream, self.write_buffer_size)
+            except Exception:
+                stream.close()
+                raise
+        stream.close()
+        chunk = stream.chunk
+        if stream.path == os.devnull:
+            # re-sent chunk of a completed upload
+            return None
+        partial_path = stream.path
+        received = record_chunk(
+            partial_path + '.idx', chunk.index, chunk.offset + stream.size)
+        if not set(received).issuperset(range(chunk.total)):
+            return None
+        size = max(received.values())
+        if chunk.file_size and size != chunk.file_size:
+            # start over, the upload can be sent again
+            discard_chunks(partial_path)
+            raise BadRequest('Chunks do not match the file size.')
+        complete_path = partial_path + '.complete'
+        try:
+            os.rename(partial_path, complete_path)
+        except OSError:
+            # completed by a concurrent request
+            return None
+        open(partial_path + '.done', 'wb').close()
+        os.unlink(partial_path + '.idx')
+        if os.path.getsize(complete_path) != size:
+            # preallocated or written beyond the end
+            os.truncate(complete_path, size)
+        target = self.storage.allocate(uploaded_file.filename)
+        stored_file = self.storage.store(target, complete_path)
+        self.write_manifest(stored_file)
+        return stored_file
+
+    def get_static_asset(self, path):
+        """Get the :data:`StaticAsset` to serve for `path`.
+
+        Paths not listed in `PATH_MAP` are served the index page. The
+        asset is taken from memory. Only if `reload_static` is set, we
+        look at the file on disk and re-read it if it was modified.
+        """
+        if path not in PATH_MAP:
+            path = '/index.html'
+        asset = self.static_assets[path]
+        if self.reload_static:
+            if os.stat(asset.path).st_mtime != asset.mtime:
+                asset = load_static_asset(*PATH_MAP[path])
+                self.static_assets[path] = asset
+        return asset
+
+    def get_encoding(self, request, asset):
+        """Get the content-coding to send `asset` with.
+
+        Picks the encoding from `asset.encodings` preferred by the
+        client, as told by the `Accept-Encoding` header of
+        `request`. Returns ``None`` if the asset should be sent
+        uncompressed.
+        """
+        available = [
+            name for name, compress in ENCODINGS if name in asset.encodings]
+        return request.accept_encodings.best_match(available)
+
+    def get_etag(self, asset, encoding=None):
+        """Get the entity tag of `asset` sent with `encoding`.
+        """
+        if encoding is None:
+            return asset.etag
+        return '%s-%s' % (asset.etag, encoding)
+
+    def is_not_modified(self, request, asset, encoding=None):
+        """Tell whether `request` is a conditional request for `asset`,
+        that can be answered with ``304 Not Modified``.
+
+        `If-None-Match` takes precedence over `If-Modified-Since`.
+        Only ``GET`` and ``HEAD`` requests are considered.
+        """
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(
+                self.get_etag(asset, encoding))
+        if request.if_modified_since is not None:
+            since = calendar.timegm(request.if_modified_since.utctimetuple())
+            return int(asset.mtime) <= since
+        return False
+
+    def set_cache_headers(self, response, asset, encoding=None):
+        """Set validators and caching hints for `asset` on `response`.
+        """
+        response.set_etag(self.get_etag(asset, encoding))
+        response.last_modified = int(asset.mtime)
+        response.cache_control.private = True
+        response.cache_control.max_age = self.max_age
+        return response
 
-    @Request.application
+    def open_asset(self, asset):
+        """Open the file of `asset` for sending.
+
+        Returns ``None`` if the file cannot be opened or was modified
+        since the asset was loaded.
+        """
+        try:
+            file_descr = open(asset.path, 'rb')
+        except (IOError, OSError):
+            return None
+        stat = os.fstat(file_descr.fileno())
+        if stat.st_mtime != asset.mtime or stat.st_size != len(asset.data):
+            file_descr.close()
+            return None
+        return file_descr
+
+    def get_static_response(self, request):
+        """Get a response delivering the static file requested.
+
+        The response considers conditional requests, ranges requested
+        and the encodings accepted by the client.
+
+        Uncompressed files of at least `sendfile_min_size` bytes are
+        sent from disk, wrapped in the ``wsgi.file_wrapper`` of the
+        server, if it provides one. Servers can then send them with
+        :func:`os.sendfile`. Everything else, including ranges and all
+        files for servers without a file wrapper (like the bundled
+        Werkzeug server and the async engine), is sent from memory.
+        """
+        asset = self.get_static_asset(request.path)
+        encoding = self.get_encoding(request, asset)
+        if self.is_not_modified(request, asset, encoding):
+            response = Response(status=304)
+        else:
+            data = asset.encodings[encoding] if encoding else asset.data
+            file_descr = None
+            environ = request.environ
+            if encoding is None and request.method == 'GET' and (
+                    len(data) >= self.sendfile_min_size) and (
+                    'wsgi.file_wrapper' in environ) and (
+                    'HTTP_RANGE' not in environ):
+                file_descr = self.open_asset(asset)
+            if file_descr is None:
+                response = Response(data, mimetype=asset.mimetype)
+            else:
+                response = Response(
+                    wrap_file(environ, file_descr), mimetype=asset.mimetype,
+                    direct_passthrough=True)
+                response.content_length = len(data)
+            if encoding is not None:
+                response.content_encoding = encoding
+        response.vary.add('Accept-Encoding')
+        if request.method in ('GET', 'HEAD'):
+            self.set_cache_headers(response, asset, encoding)
+            if response.status_code == 200:
+                try:
+                    response.make_conditional(
+                        request, accept_ranges=True,
+                        complete_length=len(data))
+                except HTTPException:
+                    response.close()
+                    raise
+        return response
+
+    def close(self):
+        """Shut down the threads of `executor`, waiting for running
+        jobs.
+        """
+        self.executor.shutdown()
+
+    def get_metrics_response(self):
+        """Get a response with :attr:`metrics` in Prometheus text format.
+        """
+        return Response(
+            self.metrics.render(),
+            mimetype='text/plain; version=0.0.4',
+            headers={'Cache-Control': 'no-store'})
+
+    @UploadRequest.application
     def __call__(self, request):
-        if not self.check_auth(request):
+        start = time.perf_counter()
+        session = self.check_session(request)
+        authorized = session or self.check_auth(request)
+        self.metrics.observe(
+            'dropafile_auth_seconds', time.perf_counter() - start)
+        if not authorized:
             return self.authenticate()
-        self.handle_uploaded_files(request)
-        filename, mimetype = PATH_MAP.get(
-            request.path, PATH_MAP['/index.html'])
-        with open(os.path.join(STATIC_DIR, filename)) as file_descr:
-            page = file_descr.read()
-        return Response(page, mimetype=mimetype)
+        if request.path == self.metrics_path:
+            return self.get_metrics_response()
+        if self.upload_mode == 'stream':
+            request.storage = self.storage
+            request.open_chunk = self.open_chunk
+        request.max_file_size = self.max_file_size
+        request.hash_name = self.hash_name
+        try:
+            self.check_request_size(request)
+            stored_files = self.handle_uploaded_files(request)
+        except HTTPException as exc:
+            self.log_rejected(request, exc)
+            raise
+        response = self.get_static_response(request)
+        self.set_digest_headers(response, stored_files)
+        if not session:
+            self.start_session(response)
+        return response
 
 
 def execute_cmd(cmd_list):
@@ -200,6 +2601,7 @@ def execute_cmd(cmd_list):
 
     Returns stdout and stderr output.
     """
+    import subprocess
     pipe = subprocess.PIPE
     proc = subprocess.Popen(
         cmd_list, stdout=pipe, stderr=pipe, shell=False)
@@ -212,9 +2614,57 @@ def execute_cmd(cmd_list):
     return stdout, stderr
 
 
+def write_ssl_cert(cert_path, key_path, key_type='rsa', bits=4096, days=2,
+                   cn='localhost', country='US', state='', location=''):
+    """Create a self-signed SSL cert and key in-process.
+
+    Needs the `cryptography` package. Certificate and key are written
+    to `cert_path` and `key_path`. See :func:`create_ssl_cert` for the
+    other parameters.
+    """
+    load_crypto()
+    if key_type == 'ec':
+        key = ec.generate_private_key(ec.SECP256R1())
+    elif key_type == 'ed25519':
+        key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=bits)
+    attrs = [
+        (x509.NameOID.COUNTRY_NAME, country),
+        (x509.NameOID.STATE_OR_PROVINCE_NAME, state),
+        (x509.NameOID.LOCALITY_NAME, location),
+        (x509.NameOID.COMMON_NAME, cn),
+        ]
+    subject = x509.Name(
+        [x509.NameAttribute(oid, value) for oid, value in attrs if value])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(
+        subject).issuer_name(
+        subject).public_key(
+        key.public_key()).serial_number(
+        x509.random_serial_number()).not_valid_before(
+        now - datetime.timedelta(minutes=5)).not_valid_after(
+        now + datetime.timedelta(days=days)).add_extension(
+        x509.SubjectAlternativeName([
+            x509.DNSName(cn), x509.DNSName('localhost'),
+            x509.IPAddress(ipaddress.ip_address(u'127.0.0.1')),
+            x509.IPAddress(ipaddress.ip_address(u'::1'))]),
+        critical=False).sign(
+        key, None if key_type == 'ed25519' else hashes.SHA256())
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as file_descr:
+        file_descr.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()))
+    with open(cert_path, 'wb') as file_descr:
+        file_descr.write(cert.public_bytes(serialization.Encoding.PEM))
+
+
 def create_ssl_cert(path=None, bits=4096, days=2, cn='localhost',
-                    country='US', state='', location=''):
-    """Create an SSL RSA cert and key in directory `path`.
+                    country='US', state='', location='', key_type='rsa',
+                    quiet=False):
+    """Create an SSL cert and key in directory `path`.
 
     Returns a tuple `(certificate_path, key_path)`.
 
@@ -240,47 +2690,311 @@ def create_ssl_cert(path=None, bits=4096, days=2, cn='localhost',
 
     `state` and `location`
       will be empty by default.
+
+    `key_type`
+      one of `KEY_TYPES`. ``'rsa'`` by default. ECDSA (``'ec'``)
+      and Ed25519 keys are created much faster than RSA keys.
+
+    If the `cryptography` package is installed, key and certificate
+    are created in-process. Otherwise we call the `openssl`
+    commandline tool. Progress is printed unless `quiet` is ``True``.
     """
-    print("Creating temporary self-signed SSL certificate...")
+    if not quiet:
+        print("Creating temporary self-signed SSL certificate...")
     if path is None:
         path = tempfile.mkdtemp()
     cert_path = os.path.join(path, 'cert.pem')
     key_path = os.path.join(path, 'cert.key')
-    openssl_conf = os.path.join(os.path.dirname(__file__), 'openssl.conf')
-    subject = '/C=%s/ST=%s/L=%s/O=%s/OU=%s/CN=%s/emailAddress=%s/' % (
-        country, state, location, '', '', cn, '')
-    cmd = [
-        'openssl', 'req', '-x509', '-newkey', 'rsa:%s' % bits, '-nodes',
-        '-out', cert_path, '-keyout', key_path, '-days', '%s' % days,
-        '-sha256', '-config', openssl_conf, '-batch', "-subj", subject
-        ]
-    out, err = execute_cmd(cmd)
+    if load_crypto() is not None:
+        write_ssl_cert(
+            cert_path, key_path, key_type=key_type, bits=bits, days=days,
+            cn=cn, country=country, state=state, location=location)
+    else:
+        openssl_conf = os.path.join(
+            os.path.dirname(__file__), 'openssl.conf')
+        subject = '/C=%s/ST=%s/L=%s/O=%s/OU=%s/CN=%s/emailAddress=%s/' % (
+            country, state, location, '', '', cn, '')
+        newkey = ['-newkey', 'rsa:%s' % bits]
+        if key_type == 'ec':
+            newkey = [
+                '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1']
+        elif key_type == 'ed25519':
+            newkey = ['-newkey', 'ed25519']
+        cmd = ['openssl', 'req', '-x509'] + newkey + [
+            '-nodes', '-out', cert_path, '-keyout', key_path,
+            '-days', '%s' % days, '-sha256', '-config', openssl_conf,
+            '-batch', "-subj", subject
+            ]
+        out, err = execute_cmd(cmd)
+    if not quiet:
+        print("Done.")
+        print("Certificate in: %s" % cert_path)
+        print("Key in:         %s" % key_path)
+    return cert_path, key_path
+
+
+def cert_valid_for(cert_path, seconds):
+    """Tell whether the certificate in `cert_path` will still be valid
+    in `seconds` seconds.
+    """
+    if load_crypto() is not None:
+        with open(cert_path, 'rb') as file_descr:
+            cert = x509.load_pem_x509_certificate(file_descr.read())
+        not_after = getattr(cert, 'not_valid_after_utc', None)
+        if not_after is None:  # cryptography < 42
+            not_after = cert.not_valid_after
+        not_after = calendar.timegm(not_after.utctimetuple())
+        return not_after > time.time() + seconds
+    cmd = ['openssl', 'x509', '-checkend', '%d' % seconds, '-noout',
+           '-in', cert_path]
+    import subprocess
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(cmd, stdout=devnull, stderr=devnull) == 0
+
+
+def get_cached_ssl_cert(cache_dir, key_type='rsa', min_validity=3600):
+    """Get an SSL cert and key from `cache_dir`.
+
+    Certificates are kept in a subdirectory of `cache_dir` named after
+    `key_type`. Each certificate and its key form a generation
+    directory there, the symlink ``current`` points to the one in use.
+    If there is none or the current one expires within `min_validity`
+    seconds, we create a new generation. It is created in a temporary
+    directory, renamed when complete and then published by replacing
+    the symlink, so other servers using the same cache always get a
+    complete pair of certificate and key. The paths returned are
+    those in the generation directory and do not change when a newer
+    generation is published. Expired generations are removed.
+
+    Returns a tuple `(certificate_path, key_path)`.
+    """
+    path = os.path.join(cache_dir, key_type)
+    current_path = os.path.join(path, 'current')
+    try:
+        gen_path = os.path.join(path, os.readlink(current_path))
+    except OSError:
+        gen_path = None
+    if gen_path is not None:
+        cert_path = os.path.join(gen_path, 'cert.pem')
+        key_path = os.path.join(gen_path, 'cert.key')
+        if os.path.isfile(cert_path) and os.path.isfile(key_path) and (
+                cert_valid_for(cert_path, min_validity)):
+            print("Reusing SSL certificate.")
+            print("Certificate in: %s" % cert_path)
+            print("Key in:         %s" % key_path)
+            return cert_path, key_path
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    print("Creating temporary self-signed SSL certificate...")
+    tmp_path = tempfile.mkdtemp(prefix='tmp-', dir=path)
+    gen_name = 'gen-%010d-%s' % (time.time(), os.path.basename(tmp_path)[4:])
+    gen_path = os.path.join(path, gen_name)
+    try:
+        create_ssl_cert(tmp_path, key_type=key_type, quiet=True)
+        os.rename(tmp_path, gen_path)
+    except Exception:
+        shutil.rmtree(tmp_path, True)
+        raise
+    link_path = os.path.join(path, 'tmp-' + gen_name)
+    os.symlink(gen_name, link_path)
+    os.replace(link_path, current_path)
+    for name in os.listdir(path):
+        if name.startswith('gen-') and name != gen_name and not (
+                cert_valid_for(os.path.join(path, name, 'cert.pem'), 0)):
+            shutil.rmtree(os.path.join(path, name), True)
+    cert_path = os.path.join(gen_path, 'cert.pem')
+    key_path = os.path.join(gen_path, 'cert.key')
     print("Done.")
     print("Certificate in: %s" % cert_path)
     print("Key in:         %s" % key_path)
     return cert_path, key_path
 
 
-def get_ssl_context(cert_path=None, key_path=None):
+class CertPool(object):
+    """A pool of ready-made SSL certificates and keys in `directory`.
+
+    Creating keys (RSA keys in particular) takes a while. Servers
+    using a pool :meth:`take` a certificate created before and create
+    new ones in background (:meth:`start_filling`) until `size` of them
+    are ready again.
+
+    Certificates with keys of `key_type` are kept in a subdirectory
+    named after it. Each one is created in a temporary directory,
+    which is renamed when complete and renamed again when taken, so
+    several servers can share a pool. Certificates expiring within
+    `min_validity` seconds are not handed out.
+    """
+
+    def __init__(self, directory, key_type='rsa', size=2, min_validity=3600):
+        self.path = os.path.join(directory, key_type)
+        self.key_type = key_type
+        self.size = size
+        self.min_validity = min_validity
+        self.thread = None
+
+    def get_entries(self, prefix):
+        """Get paths of all entries with names starting with `prefix`,
+        oldest first.
+        """
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        return [os.path.join(self.path, name) for name in sorted(names)
+                if name.startswith(prefix)]
+
+    def take(self):
+        """Take a certificate from the pool.
+
+        Returns a tuple `(certificate_path, key_path)` or ``None`` if
+        no certificate is ready.
+        """
+        for path in self.get_entries('ready-'):
+            used_path = os.path.join(
+                self.path, 'used-' + os.path.basename(path)[6:])
+            try:
+                os.rename(path, used_path)
+            except OSError:
+                continue  # taken by someone else
+            cert_path = os.path.join(used_path, 'cert.pem')
+            if cert_valid_for(cert_path, self.min_validity):
+                return cert_path, os.path.join(used_path, 'cert.key')
+        return None
+
+    def remove_stale(self):
+        """Remove expired certificates and leftovers of creations
+        aborted more than an hour ago.
+        """
+        for path in self.get_entries('used-') + self.get_entries('ready-'):
+            if not cert_valid_for(os.path.join(path, 'cert.pem'), 0):
+                shutil.rmtree(path, True)
+        for path in self.get_entries('tmp-'):
+            if os.path.getmtime(path) < time.time() - 3600:
+                shutil.rmtree(path, True)
+
+    def fill(self):
+        """Create certificates until `size` of them are ready.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+        self.remove_stale()
+        while len(self.get_entries('ready-')) < self.size:
+            path = tempfile.mkdtemp(prefix='tmp-', dir=self.path)
+            create_ssl_cert(path, key_type=self.key_type, quiet=True)
+            os.rename(path, os.path.join(self.path, 'ready-%010d-%s' % (
+                time.time(), os.path.basename(path)[4:])))
+
+    def start_filling(self):
+        """Run :meth:`fill` in a background thread.
+
+        Returns the thread started.
+        """
+        self.thread = threading.Thread(
+            target=self.fill, name='dropafile-cert-pool')
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+
+def health_app(environ, start_response):
+    """A WSGI app telling we are starting.
+    """
+    return Response('starting\n', mimetype='text/plain')(
+        environ, start_response)
+
+
+def start_health_endpoint(port, host='127.0.0.1'):
+    """Serve :func:`health_app` on `host` and `port` over plain HTTP.
+
+    Meant to tell supervisors we are alive while we are not ready to
+    serve HTTPS yet. Requests are served by a background thread.
+    Returns the server, call `shutdown()` and `server_close()` on it
+    when done.
+    """
+    from werkzeug.serving import make_server
+    server = make_server(host, port, health_app)
+    thread = threading.Thread(
+        target=server.serve_forever, name='dropafile-health')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def get_ssl_cert(cert_path=None, key_path=None, cert_cache=None,
+                 key_type='rsa'):
+    """Get paths of an SSL certificate and key to serve HTTPS.
+
+    If `cert_path` or `key_path` are ``None``, we create some of type
+    `key_type`. If a `cert_cache` directory is given, we reuse a
+    certificate from there or store a newly created one in it.
+
+    Returns a tuple `(certificate_path, key_path)`.
+    """
+    if (key_path is None) or (cert_path is None):
+        if cert_cache is not None:
+            return get_cached_ssl_cert(cert_cache, key_type=key_type)
+        return create_ssl_cert(key_type=key_type)
+    return cert_path, key_path
+
+
+#: OpenSSL cipher list for TLS 1.2 connections: ECDHE key exchange
+#: and AEAD ciphers only. TLS 1.3 cipher suites are not affected.
+TLS_CIPHERS = 'ECDHE+AESGCM:ECDHE+CHACHA20'
+
+
+def get_ssl_context(cert_path=None, key_path=None, cert_cache=None,
+                    key_type='rsa', tickets=2):
     """Get an SSL context to serve HTTP.
 
-    If `cert_path` or `key_path` are ``None``, we create some. Then we
-    add some modifiers (avail. with Python >= 2.7.9) to disable unsafe
-    ciphers etc.
+    Certificate and key are got from :func:`get_ssl_cert`. We accept
+    TLS 1.2 and TLS 1.3 (used with all clients supporting it) only.
+    TLS 1.2 connections must use ECDHE key exchange with one of
+    `TLS_CIPHERS`. Curves are left at the OpenSSL defaults (like
+    X25519 and P-256). Pinning a single one with `set_ecdh_curve`
+    would rule out X25519 for TLS 1.3 as well. Ephemeral keys are
+    never reused since OpenSSL 1.1.0, so there is no option to set
+    for that.
+
+    Clients can resume sessions with session tickets instead of doing
+    a full handshake again. With TLS 1.3 we hand out `tickets` of them
+    after each handshake, so browsers opening several connections
+    need not share one. The ticket key is created with the context.
+    If the context is created before forking (like with `run_simple`
+    and `processes`), all worker processes share it and accept
+    tickets issued by each other.
 
     The returned SSL context can be used with Werkzeug `run_simple`.
+    Use :func:`get_tls_stats` to see how many handshakes were resumed.
     """
-    if (key_path is None) or (cert_path is None):
-        cert_path, key_path = create_ssl_cert()
-    ssl_context = (cert_path, key_path)
-    if hasattr(ssl, 'SSLContext'):  # py >= 2.7.9
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-        ssl_context.options |= ssl.OP_NO_SSLv2  # considered unsafe
-        ssl_context.options |= ssl.OP_NO_SSLv3  # considered unsafe
-        ssl_context.load_cert_chain(cert_path, key_path)
+    cert_path, key_path = get_ssl_cert(
+        cert_path, key_path, cert_cache=cert_cache, key_type=key_type)
+    import ssl
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+    ssl_context.set_ciphers(TLS_CIPHERS)
+    ssl_context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    ssl_context.options |= ssl.OP_NO_COMPRESSION
+    ssl_context.options &= ~ssl.OP_NO_TICKET
+    ssl_context.num_tickets = tickets
+    ssl_context.load_cert_chain(cert_path, key_path)
     return ssl_context
 
 
+def get_tls_stats(ssl_context):
+    """Get handshake statistics of server `ssl_context`.
+
+    Returns a dict with the number of `handshakes` completed, how many
+    of them `resumed` a former session and the `resumption_ratio`.
+    Numbers are counted per process, so with a process per request
+    they only cover the connection of that request.
+    """
+    stats = ssl_context.session_stats()
+    handshakes, resumed = stats['accept_good'], stats['hits']
+    ratio = float(resumed) / handshakes if handshakes else 0.0
+    return dict(
+        handshakes=handshakes, resumed=resumed, resumption_ratio=ratio)
+
+
 def run_server(args=None):
     """Run a `werkzeug` server, serving a :class:`DropAFileApplication`.
 
@@ -290,15 +3004,140 @@ def run_server(args=None):
     Options `argv` are taken from commandline if not specified.
 
     Generates a password and temporary SSL certificate/key on startup
-    unless otherwise requested in options/args.
+    unless otherwise requested in options/args. Certificates can be
+    reused with `--cert`/`--key` or `--cert-cache` or taken from a pool
+    filled in background with `--cert-pool`. A password hash can be
+    read with `--secret-file`. `--hash-secret` prints a hash of the
+    password instead of serving.
+
+    With `--threads` or `--processes` set, requests are served
+    concurrently. With `--engine async` we serve an
+    :class:`dropafile.aio.AsyncDropAFileApplication` with `uvicorn`
+    instead.
+
+    Log entries are written by a background thread, see
+    :func:`setup_logging`.
     """
     if args is None:
         args = sys.argv
     options = handle_options(args[1:])
-    ssl_context = get_ssl_context()
+    if options.hash_secret:
+        print(hash_password(options.secret or getpass.getpass()))
+        return
+    listener = setup_logging(
+        options.log_file, options.log_format,
+        multiprocess=options.processes > 1)
+    try:
+        serve(options)
+    finally:
+        listener.stop()
+
+
+def get_server_cert(options):
+    """Get paths of the SSL certificate and key to serve with as
+    requested by commandline `options`.
+
+    With `--cert-pool` we take a certificate from the pool, if there
+    is one ready, and fill the pool in background. Otherwise we get
+    one from :func:`get_ssl_cert`. With `--health-port` set, a health
+    endpoint is served meanwhile (see :func:`start_health_endpoint`).
+
+    Returns a tuple `(certificate_path, key_path)`.
+    """
+    pool, cert = None, None
+    if options.cert_pool is not None:
+        pool = CertPool(
+            options.cert_pool, key_type=options.key_type,
+            size=options.cert_pool_size)
+        cert = pool.take()
+        if cert is not None:
+            print("Taking SSL certificate from pool.")
+            print("Certificate in: %s" % cert[0])
+            print("Key in:         %s" % cert[1])
+    if cert is None:
+        health_server = None
+        if options.health_port is not None:
+            health_server = start_health_endpoint(options.health_port)
+        try:
+            cert = get_ssl_cert(
+                options.cert, options.key, cert_cache=options.cert_cache,
+                key_type=options.key_type)
+        finally:
+            if health_server is not None:
+                health_server.shutdown()
+                health_server.server_close()
+    if pool is not None:
+        pool.start_filling()
+    return cert
+
+
+def get_app_kw(options):
+    """Get keyword arguments for a :class:`DropAFileApplication` from
+    commandline `options`.
+    """
+    kw = dict(
+        password=options.secret, max_file_size=options.max_file_size,
+        max_request_size=options.max_request_size,
+        session_lifetime=options.session_lifetime,
+        hash_name=options.digest, manifest_path=options.manifest,
+        dedup=options.dedup, storage=options.storage, fsync=options.fsync,
+        fsync_interval=options.fsync_interval / 1000.0,
+        write_buffer_size=options.write_buffer,
+        preallocate=options.preallocate)
+    if options.object_store is not None:
+        from dropafile.objectstore import ObjectStorage
+        kw['storage'] = ObjectStorage(
+            options.object_store, hash_name=options.digest,
+            access_key=os.environ.get('AWS_ACCESS_KEY_ID'),
+            secret_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+            region=os.environ.get('AWS_REGION', 'us-east-1'))
+    if options.secret_file is not None:
+        kw['password_hash'] = read_secret_file(options.secret_file)
+    return kw
+
+
+def print_password(application, options):
+    """Tell the password of `application` (if we know it).
+    """
+    if application.password is None:
+        print("Password hash read from: %s" % options.secret_file)
+    else:
+        print("Password is: %s" % application.password)
     sys.stdout.flush()
-    application = DropAFileApplication(password=options.secret)
-    print("Password is: %s" % application.password)
+
+
+def serve(options):
+    """Serve dropafile as requested by the commandline `options`.
+    """
+    if options.engine == 'async':
+        from dropafile.aio import AsyncDropAFileApplication, run_async_server
+        cert_path, key_path = get_server_cert(options)
+        application = AsyncDropAFileApplication(**get_app_kw(options))
+        print_password(application, options)
+        try:
+            run_async_server(
+                application, options.host, options.port, cert_path,
+                key_path)
+        finally:
+            application.close()
+        return
+    from werkzeug.serving import run_simple
+    cert_path, key_path = get_server_cert(options)
+    ssl_context = get_ssl_context(
+        cert_path, key_path, tickets=options.tls_tickets)
     sys.stdout.flush()
-    run_simple(options.host, options.port, application,
-               ssl_context=ssl_context)
+    application = DropAFileApplication(
+        ssl_context=ssl_context, **get_app_kw(options))
+    print_password(application, options)
+    if options.processes > 1:
+        # children forked per request only know their own metrics
+        application.metrics_path = None
+    wsgi_app = application
+    if options.threads > 1:
+        wsgi_app = ConcurrencyLimit(application, options.threads)
+    try:
+        run_simple(options.host, options.port, wsgi_app,
+                   ssl_context=ssl_context, threaded=options.threads > 1,
+                   processes=options.processes)
+    finally:
+        application.close()
@@ -0,0 +1,418 @@
+#    dropafile -- drop me a file on a webpage
+#    Copyright (C) 2015  Uli Fouquet
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""dropafile.aio - Asynchronous (ASGI) dropafile application.
+
+Serves the same pages as :class:`dropafile.DropAFileApplication`, but
+as an `ASGI` application. Uploads are parsed while they arrive and
+written to disk in an executor, so slow clients do not block a thread
+each.
+
+Requires Python >= 3.7. Serving it from commandline requires the
+`uvicorn` package.
+"""
+import asyncio
+import ssl
+import time
+from io import BytesIO
+from werkzeug.datastructures import FileStorage, MultiDict
+from werkzeug.exceptions import (
+    BadRequest, HTTPException, RequestEntityTooLarge)
+from werkzeug.http import parse_options_header
+from werkzeug.wrappers import Request
+from dropafile import (
+    TLS_CIPHERS, DropAFileApplication, UploadIncomplete, UploadStream)
+try:
+    import uvicorn
+except ImportError:  # pragma: no cover
+    uvicorn = None
+
+
+class MultipartParser(object):
+    """An incremental parser for ``multipart/form-data`` bodies.
+
+    Feed the parser with chunks of the body as they arrive. For each
+    chunk :meth:`feed` returns a list of events:
+
+    ``('part', name, filename, content_type)``
+      a new part starts. `filename` is ``None`` for plain form fields.
+
+    ``('data', data)``
+      some bytes of the current part.
+
+    ``('end', )``
+      the current part is complete.
+
+    Only a few bytes (the length of the boundary) are kept between
+    calls, apart from part headers, which may be at most
+    `max_header_size` bytes long. Boundary lines may be padded with
+    at most `max_padding` bytes.
+    """
+
+    #: maximum size of headers of a single part.
+    max_header_size = 16 * 1024
+
+    #: maximum number of bytes allowed between a boundary and its CRLF.
+    max_padding = 64
+
+    def __init__(self, boundary):
+        self.delimiter = b'\r\n--' + boundary
+        # the first boundary needs no leading CRLF
+        self.buffer = b'\r\n'
+        self.state = 'preamble'
+
+    def feed(self, data):
+        """Parse `data`, the next chunk of the body.
+
+        Raises :class:`ValueError` if the body is malformed.
+        """
+        self.buffer += data
+        events = []
+        while self.parse_next(events):
+            pass
+        return events
+
+    def close(self):
+        """Tell, that the body is complete.
+
+        Raises :class:`ValueError` if the body was truncated.
+        """
+        if self.state != 'done':
+            raise ValueError('Incomplete multipart body.')
+
+    def parse_next(self, events):
+        # parse one step of the buffer. Returns whether to go on.
+        if self.state == 'preamble':
+            pos = self.buffer.find(self.delimiter)
+            if pos == -1:
+                self.buffer = self.buffer[-len(self.delimiter):]
+                return False
+            self.buffer = self.buffer[pos + len(self.delimiter):]
+            self.state = 'boundary'
+        elif self.state == 'boundary':
+            if len(self.buffer) < 2:
+                return False
+            if self.buffer[:2] == b'--':
+                self.state = 'done'
+                self.buffer = b''
+                return False
+            pos = self.buffer.find(b'\r\n', 0, self.max_padding + 2)
+            if pos == -1:
+                if len(self.buffer) > self.max_padding + 1:
+                    raise ValueError('Invalid multipart boundary line.')
+                return False
+            self.buffer = self.buffer[pos + 2:]
+            self.state = 'headers'
+        elif self.state == 'headers':
+            pos = self.buffer.find(b'\r\n\r\n')
+            if pos == -1:
+                if len(self.buffer) > self.max_header_size:
+                    raise ValueError('Multipart headers too long.')
+                return False
+            events.append(self.parse_headers(self.buffer[:pos]))
+            self.buffer = self.buffer[pos + 4:]
+            self.state = 'body'
+        elif self.state == 'body':
+            pos = self.buffer.find(self.delimiter)
+            if pos == -1:
+                # keep what might be the start of a delimiter
+                keep = len(self.delimiter) - 1
+                if len(self.buffer) > keep:
+                    events.append(('data', self.buffer[:-keep]))
+                    self.buffer = self.buffer[-keep:]
+                return False
+            if pos:
+                events.append(('data', self.buffer[:pos]))
+            events.append(('end', ))
+            self.buffer = self.buffer[pos + len(self.delimiter):]
+            self.state = 'boundary'
+        else:
+            return False
+        return True
+
+    def parse_headers(self, data):
+        # get a `part` event from the raw headers `data` of a part.
+        headers = dict()
+        for line in data.decode('utf-8', 'replace').split('\r\n'):
+            if ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        disposition, options = parse_options_header(
+            headers.get('content-disposition', ''))
+        if disposition != 'form-data' or 'name' not in options:
+            raise ValueError('Invalid multipart part.')
+        return ('part', options['name'], options.get('filename', None),
+                headers.get('content-type', 'text/plain'))
+
+
+def make_environ(scope):
+    """Get a basic WSGI environment from an ASGI HTTP `scope`.
+
+    The environment contains no body. It is sufficient to create
+    :class:`werkzeug.wrappers.Request` objects, to check
+    authentication and to find out which static file to deliver.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(),
+        'wsgi.errors': BytesIO(),
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_%s' % name
+        if name in environ:
+            value = '%s,%s' % (environ[name], value)
+        environ[name] = value
+    return environ
+
+
+async def send_response(response, environ, send):
+    """Send the :class:`werkzeug.wrappers.Response` `response` via the
+    ASGI callable `send`.
+
+    Bodies read from files (streamed responses) are read in the
+    default executor and sent block by block.
+    """
+    headers = response.get_wsgi_headers(environ)
+    app_iter = response.get_app_iter(environ)
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [
+            (key.lower().encode('latin-1'), value.encode('latin-1'))
+            for key, value in headers.to_wsgi_list()],
+        })
+    try:
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            body = b''
+        elif response.is_streamed:
+            loop = asyncio.get_running_loop()
+            blocks = iter(app_iter)
+            while True:
+                block = await loop.run_in_executor(None, next, blocks, None)
+                if block is None:
+                    break
+                await send({
+                    'type': 'http.response.body', 'body': block,
+                    'more_body': True})
+            body = b''
+        else:
+            body = b''.join(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class AsyncDropAFileApplication(DropAFileApplication):
+    """Drop-A-File application for ASGI servers.
+
+    Accepts the same arguments as :class:`DropAFileApplication` and
+    delivers the same pages. Uploaded files are always streamed into
+    `storage`. Unauthorized or too large requests are answered
+    without receiving their body.
+    """
+
+    #: maximum size of plain form fields in uploads.
+    max_form_memory_size = 500 * 1024
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        environ = make_environ(scope)
+        request = Request(environ)
+        try:
+            response = await self.handle_request(request, receive)
+        except HTTPException as exc:
+            response = exc.get_response(environ)
+        await send_response(response, environ, send)
+
+    async def handle_lifespan(self, receive, send):
+        """Answer ASGI lifespan events.
+        """
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle_request(self, request, receive):
+        """Get a response for `request`.
+
+        `receive` is the ASGI callable delivering the request body.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        session = self.check_session(request)
+        # password hashes take a while, keep the loop running meanwhile
+        authorized = session or await loop.run_in_executor(
+            None, self.check_auth, request)
+        self.metrics.observe(
+            'dropafile_auth_seconds', time.perf_counter() - start)
+        if not authorized:
+            return self.authenticate()
+        if request.path == self.metrics_path:
+            return self.get_metrics_response()
+        stored_files = []
+        try:
+            self.check_request_size(request)
+            if request.mimetype == 'multipart/form-data':
+                stored_files = await self.receive_uploaded_files(
+                    request, receive)
+        except HTTPException as exc:
+            self.log_rejected(request, exc)
+            raise
+        response = self.get_static_response(request)
+        self.set_digest_headers(response, stored_files)
+        if not session:
+            self.start_session(response)
+        return response
+
+    async def receive_uploaded_files(self, request, receive):
+        """Receive the multipart body of `request` and store the file
+        sent.
+
+        Files are written into writers of `storage` while they
+        arrive, chunks of chunked uploads right into their partial
+        file (see :meth:`dropafile.DropAFileApplication.open_chunk`).
+        Blocking disk operations are run in the default executor of
+        the running loop. Timings are recorded in `metrics`, stored
+        files are logged.
+
+        Returns a list of :data:`dropafile.StoredFile`.
+        """
+        boundary = request.mimetype_params.get('boundary', '')
+        if not boundary:
+            raise BadRequest('Missing multipart boundary.')
+        loop = asyncio.get_running_loop()
+        parser = MultipartParser(boundary.encode('latin-1'))
+        form, files, streams = MultiDict(), MultiDict(), []
+        part, field = None, None
+        received, start = 0, time.perf_counter()
+        try:
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    raise BadRequest('Client disconnected.')
+                more_body = message.get('more_body', False)
+                body = message.get('body', b'')
+                received += len(body)
+                if self.max_request_size is not None and (
+                        received > self.max_request_size):
+                    # bodies sent without `Content-Length`
+                    raise RequestEntityTooLarge('Request too large.')
+                try:
+                    events = parser.feed(body)
+                    if not more_body:
+                        parser.close()
+                except ValueError as err:
+                    raise BadRequest(str(err))
+                for event in events:
+                    if event[0] == 'part':
+                        part, field = event, []
+                        if part[2] is not None:
+                            # chunks go right into their partial file
+                            stream = await loop.run_in_executor(
+                                None, self.open_chunk, form)
+                        if part[2] is not None and stream is None:
+                            size = None
+                            if streams:
+                                # the file before is complete
+                                await loop.run_in_executor(
+                                    None, self.storage.trim, streams[-1])
+                            elif request.content_length is not None:
+                                # the first file might be the only one
+                                size = request.content_length - (
+                                    received - len(body))
+                            stream = await loop.run_in_executor(
+                                None, self.storage.open_write, part[2], size)
+                            stream = UploadStream(
+                                stream, self.max_file_size, self.hash_name)
+                            streams.append(stream)
+                        if part[2] is not None:
+                            files.add(part[1], FileStorage(
+                                stream, part[2], part[1],
+                                content_type=part[3]))
+                    elif event[0] == 'data':
+                        if part[2] is not None:
+                            await loop.run_in_executor(
+                                None, stream.write, event[1])
+                            continue
+                        field.append(event[1])
+                        if sum(map(len, field)) > self.max_form_memory_size:
+                            raise BadRequest('Form field too large.')
+                    elif part[2] is not None:
+                        await loop.run_in_executor(None, stream.seek, 0)
+                    else:
+                        value = b''.join(field).decode('utf-8', 'replace')
+                        form.add(part[1], value)
+            parsed = time.perf_counter()
+            write_time = sum([stream.write_time for stream in streams])
+            try:
+                stored_files = await loop.run_in_executor(
+                    None, self.store_uploaded_files, form, files, streams)
+            except UploadIncomplete as exc:
+                for stored_file in exc.stored_files:
+                    self.log_received(
+                        stored_file, request, time.perf_counter() - start)
+                raise
+            stored = time.perf_counter()
+        finally:
+            for stream in streams:
+                await loop.run_in_executor(None, self.storage.abort, stream)
+        if files:
+            self.metrics.observe_upload(
+                received, parsed - start - write_time,
+                write_time + stored - parsed)
+        for stored_file in stored_files:
+            self.log_received(stored_file, request, stored - start)
+        return stored_files
+
+
+def run_async_server(application, host, port, cert_path, key_path):
+    """Serve the ASGI `application` with `uvicorn`.
+
+    Listens on `host` and `port` and serves HTTPS with the certificate
+    in `cert_path` and key in `key_path`. TLS 1.2 connections are
+    restricted to `TLS_CIPHERS` like with :func:`dropafile.get_ssl_context`.
+    """
+    if uvicorn is None:
+        raise RuntimeError('The async engine requires `uvicorn`.')
+    uvicorn.run(application, host=host, port=port, ssl_certfile=cert_path,
+                ssl_keyfile=key_path, ssl_version=ssl.PROTOCOL_TLS_SERVER,
+                ssl_ciphers=TLS_CIPHERS, log_level='info')
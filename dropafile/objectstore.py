@@ -0,0 +1,422 @@
+#    dropafile -- drop me a file on a webpage
+#    Copyright (C) 2015  Uli Fouquet
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""dropafile.objectstore - Store uploads in an S3 compatible object store.
+
+:class:`ObjectStorage` can be passed as `storage` to
+:class:`dropafile.DropAFileApplication`. Uploaded files are sent to
+the object store in parts, while they still arrive, using the
+multipart upload API of Amazon S3 (also provided by MinIO, Ceph and
+others). They are not stored locally first.
+
+Requests are signed with AWS signature version 4, if credentials are
+given. Only the Python standard library is used.
+"""
+import concurrent.futures
+import datetime
+import hashlib
+import hmac
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http import client as httplib
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from werkzeug import secure_filename
+from dropafile import StoredFile, UploadStream
+
+
+#: Hash of request bodies sent in signed requests. Bodies themselves
+#: are not signed, like with presigned URLs.
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+
+
+class ObjectStoreError(IOError):
+    """A request to the object store failed.
+    """
+
+
+def get_signing_key(secret_key, date, region, service='s3'):
+    """Derive an AWS signature version 4 signing key.
+
+    `date` is the day of the request in the format ``YYYYMMDD``.
+    """
+    key = ('AWS4' + secret_key).encode('utf-8')
+    for msg in (date, region, service, 'aws4_request'):
+        key = hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+    return key
+
+
+def quote_query(query):
+    """Get the canonical query string of `query`, a list of
+    ``(name, value)`` pairs.
+    """
+    return '&'.join(['%s=%s' % (quote(name, safe='-_.~'),
+                                quote(value, safe='-_.~'))
+                     for name, value in sorted(query)])
+
+
+def sign_request(method, path, query, headers, access_key, secret_key,
+                 region, now=None):
+    """Sign a request with AWS signature version 4.
+
+    `path` is the (quoted) path requested, `query` a list of
+    ``(name, value)`` pairs and `headers` a dict with lowercase header
+    names, including `host`. The headers needed for authentication are
+    added to `headers`. `now` is the :class:`datetime.datetime` (UTC)
+    of the request.
+    """
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    headers['x-amz-date'] = amz_date
+    headers['x-amz-content-sha256'] = UNSIGNED_PAYLOAD
+    names = sorted(headers)
+    canonical_request = '\n'.join(
+        [method, path, quote_query(query)] +
+        ['%s:%s' % (name, headers[name].strip()) for name in names] +
+        ['', ';'.join(names), UNSIGNED_PAYLOAD])
+    scope = '%s/%s/s3/aws4_request' % (amz_date[:8], region)
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256', amz_date, scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+    signature = hmac.new(
+        get_signing_key(secret_key, amz_date[:8], region),
+        string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    headers['authorization'] = (
+        'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, '
+        'Signature=%s' % (access_key, scope, ';'.join(names), signature))
+    return headers
+
+
+def find_text(data, tag):
+    """Get the text of the first element named `tag` in the XML
+    document `data`, regardless of namespaces.
+    """
+    for elem in ElementTree.fromstring(data).iter():
+        if elem.tag.split('}')[-1] == tag:
+            return elem.text
+    raise ObjectStoreError('No %s in response' % tag)
+
+
+class ObjectStoreClient(object):
+    """A minimal client for the bucket at `url` of an S3 compatible
+    object store, like ``https://s3.example.com/mybucket``.
+
+    Requests are signed if `access_key` and `secret_key` are given.
+    Each request uses a connection of its own, so the client can be
+    used by several threads at once.
+    """
+
+    def __init__(self, url, access_key=None, secret_key=None,
+                 region='us-east-1', timeout=60):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.netloc:
+            raise ValueError('Invalid object store URL: %s' % url)
+        self.url = url.rstrip('/')
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.bucket_path = parts.path.rstrip('/')
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.timeout = timeout
+
+    def get_url(self, key):
+        """Get the URL of the object `key`.
+        """
+        return '%s/%s' % (self.url, quote(key))
+
+    def request(self, method, key, query=(), body=b'', headers=None):
+        """Send a request for the object `key`.
+
+        Returns the response and its body. Raises
+        :class:`ObjectStoreError` if the request failed.
+        """
+        path = '%s/%s' % (self.bucket_path, quote(key))
+        headers = dict(headers or {}, host=self.netloc)
+        if self.access_key is not None:
+            sign_request(method, path, query, headers, self.access_key,
+                         self.secret_key, self.region)
+        if query:
+            path = '%s?%s' % (path, quote_query(query))
+        conn_class = httplib.HTTPConnection
+        if self.scheme == 'https':
+            conn_class = httplib.HTTPSConnection
+        conn = conn_class(self.netloc, timeout=self.timeout)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, httplib.HTTPException) as err:
+            raise ObjectStoreError('%s %s failed: %s' % (method, key, err))
+        finally:
+            conn.close()
+        if response.status >= 300:
+            raise ObjectStoreError('%s %s failed: %s %s' % (
+                method, key, response.status, response.reason))
+        return response, data
+
+    def put_object(self, key, data):
+        """Store `data` as object `key` in a single request.
+        """
+        self.request('PUT', key, body=data)
+
+    def create_multipart_upload(self, key):
+        """Start a multipart upload of object `key`.
+
+        Returns the upload id.
+        """
+        response, data = self.request('POST', key, [('uploads', '')])
+        return find_text(data, 'UploadId')
+
+    def upload_part(self, key, upload_id, num, data):
+        """Upload part number `num` (counting from 1) of a multipart
+        upload.
+
+        Returns the entity tag of the part.
+        """
+        response, body = self.request('PUT', key, [
+            ('partNumber', str(num)), ('uploadId', upload_id)], body=data)
+        return response.getheader('ETag')
+
+    def complete_multipart_upload(self, key, upload_id, etags):
+        """Complete a multipart upload of the parts with `etags`.
+        """
+        body = ''.join(
+            ['<CompleteMultipartUpload>'] +
+            ['<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' % (
+                num, escape(etag)) for num, etag in enumerate(etags, 1)] +
+            ['</CompleteMultipartUpload>'])
+        response, data = self.request(
+            'POST', key, [('uploadId', upload_id)], body=body.encode('utf-8'))
+        if b'<Error>' in data:
+            # errors may be reported after a ``200 OK``
+            raise ObjectStoreError('Completing %s failed: %s' % (
+                key, find_text(data, 'Message')))
+
+    def abort_multipart_upload(self, key, upload_id):
+        """Abort a multipart upload and drop the parts uploaded.
+        """
+        self.request('DELETE', key, [('uploadId', upload_id)])
+
+
+class MultipartWriter(object):
+    """A writable file object sending data written to object `key` of
+    :class:`ObjectStorage` `storage`.
+
+    Data is buffered until `storage.part_size` bytes arrived. Then a
+    multipart upload is started (once) and the part is sent by the
+    threads of `storage.executor`, while writing goes on. At most
+    `storage.max_pending` parts per writer are buffered or in flight,
+    writing blocks until one of them was sent.
+
+    Files smaller than a part are sent in a single request, when
+    :meth:`finish` is called. Until then, they can be read back.
+    """
+
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.name = key
+        self.buffer = bytearray()
+        self.position = 0
+        self.size = 0
+        self.upload_id = None
+        self.parts = []
+        self.pending = threading.BoundedSemaphore(storage.max_pending)
+        self.aborted = False
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        part_size = self.storage.part_size
+        while len(self.buffer) >= part_size:
+            self.send_part(bytes(self.buffer[:part_size]))
+            del self.buffer[:part_size]
+        return len(data)
+
+    def send_part(self, data):
+        """Send `data` as next part in background.
+        """
+        client = self.storage.client
+        if self.upload_id is None:
+            self.upload_id = client.create_multipart_upload(self.key)
+        self.pending.acquire()
+        future = self.storage.executor.submit(
+            client.upload_part, self.key, self.upload_id,
+            len(self.parts) + 1, data)
+        future.add_done_callback(lambda future: self.pending.release())
+        self.parts.append(future)
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.position
+        elif whence == os.SEEK_END:
+            pos += len(self.buffer)
+        self.position = pos
+        return pos
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        """Read data written, as long as nothing was sent yet.
+        """
+        if self.upload_id is not None:
+            raise ObjectStoreError('Data of %s was sent already' % self.key)
+        end = len(self.buffer) if size < 0 else self.position + size
+        data = bytes(self.buffer[self.position:end])
+        self.position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+    def finish(self):
+        """Send the data left and complete the upload.
+        """
+        client = self.storage.client
+        if self.upload_id is None:
+            client.put_object(self.key, bytes(self.buffer))
+        else:
+            if self.buffer:
+                self.send_part(bytes(self.buffer))
+            etags = [future.result() for future in self.parts]
+            client.complete_multipart_upload(self.key, self.upload_id, etags)
+        self.buffer = bytearray()
+
+    def abort(self):
+        """Discard the data written and parts sent already.
+        """
+        if self.aborted:
+            return
+        self.aborted = True
+        self.buffer = bytearray()
+        for future in self.parts:
+            future.cancel()
+        concurrent.futures.wait(self.parts)
+        if self.upload_id is not None:
+            self.storage.client.abort_multipart_upload(
+                self.key, self.upload_id)
+
+
+class ObjectStorage(object):
+    """Store uploaded files in the object store bucket at `url`.
+
+    Has the interface of :class:`dropafile.FlatStorage`. Uploads
+    streamed into a writer got from :meth:`open_write` are sent in
+    parts of `part_size` bytes while they arrive (see
+    :class:`MultipartWriter`). Amazon S3 requires parts of at least
+    5 MB. Memory used per upload is bounded by `max_pending` parts.
+    Parts are sent by up to `workers` threads.
+
+    Objects are named ``<prefix><random id>/<filename>``. The local
+    `directory` keeps partial files of chunked uploads only. If none
+    is given, a temporary directory is created.
+
+    `access_key`, `secret_key` and `region` are used to sign requests
+    (see :class:`ObjectStoreClient`). Digests of files are computed
+    with `hash_name`.
+    """
+
+    def __init__(self, url, directory=None, hash_name='sha256',
+                 part_size=8 * 1024 * 1024, max_pending=4, workers=8,
+                 access_key=None, secret_key=None, region='us-east-1',
+                 prefix=''):
+        self.client = ObjectStoreClient(
+            url, access_key=access_key, secret_key=secret_key,
+            region=region)
+        if directory is None:
+            directory = tempfile.mkdtemp()
+        self.directory = directory
+        self.hash_name = hash_name
+        self.part_size = part_size
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.prefix = prefix
+
+    def open_write(self, filename, size=None):
+        """Get a :class:`MultipartWriter` to stream an uploaded file
+        named `filename` into.
+
+        The object name is chosen here already. `size` is ignored.
+        """
+        key = '%s%s/%s' % (
+            self.prefix, uuid.uuid4().hex, secure_filename(filename) or 'file')
+        return MultipartWriter(self, key)
+
+    def allocate(self, filename):
+        """Reserve a place for an uploaded file named `filename`.
+
+        Object names are unique anyway, so this is the filename only.
+        """
+        return filename
+
+    def release(self, target):
+        """Give up `target`, as returned by :meth:`allocate`.
+
+        Nothing was reserved, so there is nothing to do.
+        """
+
+    def commit(self, writer, target, digest=None):
+        """Complete the upload of `writer`.
+
+        Objects keep the name given by :meth:`open_write`, `target` is
+        not used. Returns a :data:`dropafile.StoredFile` with the URL
+        of the object as `path`.
+        """
+        writer.finish()
+        return StoredFile(
+            self.client.get_url(writer.key), writer.size, digest)
+
+    def trim(self, writer):
+        """Give back space preallocated for `writer`.
+
+        Nothing is preallocated for objects, so there is nothing to do.
+        """
+
+    def abort(self, writer):
+        """Discard the upload of `writer`.
+        """
+        writer.abort()
+
+    def store(self, target, source, digest=None):
+        """Send `source` as object for an upload named `target`.
+
+        `source` is the path of a local file, which is removed
+        afterwards, or a file object.
+        """
+        writer = UploadStream(
+            self.open_write(target),
+            hash_name=self.hash_name if digest is None else None)
+        try:
+            if isinstance(source, str):
+                with open(source, 'rb') as file_descr:
+                    shutil.copyfileobj(file_descr, writer, self.part_size)
+            else:
+                shutil.copyfileobj(source, writer, self.part_size)
+            stored_file = self.commit(
+                writer, target, digest or writer.hexdigest())
+        except Exception:
+            self.abort(writer)
+            raise
+        if isinstance(source, str):
+            os.unlink(source)
+        return stored_file
@@ -29,7 +29,6 @@ def read(fname):
     return open(os.path.join(os.path.dirname(__file__), fname)).read()
 
 install_requires = [
-    'argparse',
     'Werkzeug',
     ]
 
@@ -43,6 +42,18 @@ docs_require = [
     'Sphinx',
     ]
 
+brotli_require = [
+    'brotli',
+    ]
+
+crypto_require = [
+    'cryptography',
+    ]
+
+async_require = [
+    'uvicorn',
+    ]
+
 setup(
     name="dropafile",
     version="0.1.2.dev0",
@@ -71,21 +82,27 @@ setup(
             "License :: OSI Approved :: "
             "GNU General Public License v3 or later (GPLv3+)"),
         "Operating System :: POSIX :: Linux",
-        "Programming Language :: Python :: 2",
-        "Programming Language :: Python :: 2.6",
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.3",
-        "Programming Language :: Python :: 3.4",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
         "Programming Language :: Python :: Implementation :: CPython",
     ],
     include_package_data=True,
     zip_safe=False,
+    python_requires='>=3.7',
     install_requires=install_requires,
     tests_require=tests_require,
     extras_require=dict(
         tests=tests_require,
         docs=docs_require,
+        brotli=brotli_require,
+        crypto=crypto_require,
+        asgi=async_require,
         ),
     cmdclass={'test': PyTest},
     entry_points={
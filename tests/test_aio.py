@@ -0,0 +1,380 @@
+# tests for dropafile.aio module.
+import asyncio
+import hashlib
+import os
+import pytest
+import threading
+from io import BytesIO
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_options_header
+from werkzeug.test import EnvironBuilder
+from dropafile import preallocate
+from dropafile.aio import (
+    AsyncDropAFileApplication, MultipartParser, make_environ)
+from test_dropafile import chunk_data, encode_creds
+
+
+def multipart_body(data):
+    # get content type and body of a multipart request sending `data`
+    environ = EnvironBuilder(method='POST', data=data).get_environ()
+    return environ['CONTENT_TYPE'], environ['wsgi.input'].read()
+
+
+def get_boundary(content_type):
+    # get the multipart boundary from `content_type`
+    return parse_options_header(content_type)[1]['boundary'].encode('ascii')
+
+
+def parse_all(parser, body, chunk_size):
+    # feed `body` to `parser` in chunks of `chunk_size`, merge data events
+    events = []
+    for pos in range(0, len(body), chunk_size):
+        for event in parser.feed(body[pos:pos + chunk_size]):
+            if event[0] == 'data' and events and events[-1][0] == 'data':
+                events[-1] = ('data', events[-1][1] + event[1])
+            else:
+                events.append(event)
+    parser.close()
+    return events
+
+
+def call_app(app, method='GET', path='/', headers=None, body=b'',
+             chunk_size=1024):
+    # call ASGI `app` and return status, headers and body of response.
+    scope = {
+        'type': 'http', 'method': method, 'path': path,
+        'query_string': b'', 'scheme': 'https', 'http_version': '1.1',
+        'server': ('localhost', 8443), 'client': ('127.0.0.1', 12345),
+        'headers': [
+            (key.lower().encode('latin-1'), value.encode('latin-1'))
+            for key, value in (headers or {}).items()],
+        }
+    chunks = [body[pos:pos + chunk_size]
+              for pos in range(0, len(body), chunk_size)] or [b'']
+    messages = [
+        {'type': 'http.request', 'body': chunk,
+         'more_body': num < len(chunks) - 1}
+        for num, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    resp_headers = dict(
+        (key.decode('latin-1'), value.decode('latin-1'))
+        for key, value in sent[0]['headers'])
+    assert not sent[-1].get('more_body', False)
+    return sent[0]['status'], resp_headers, b''.join(
+        [message['body'] for message in sent[1:]])
+
+
+class TestMultipartParser(object):
+
+    @pytest.mark.parametrize("chunk_size", [1, 7, 64, 100000])
+    def test_parse(self, chunk_size):
+        # we can parse bodies delivered in chunks of any size
+        content_type, body = multipart_body({
+            'field': 'value',
+            'file': (BytesIO(b'foo\r\n--bar' * 100), 'test.txt')})
+        boundary = get_boundary(content_type)
+        events = parse_all(MultipartParser(boundary), body, chunk_size)
+        assert ('part', 'field', None, 'text/plain') in events
+        pos = events.index(('part', 'file', 'test.txt', 'text/plain'))
+        assert events[pos + 1] == ('data', b'foo\r\n--bar' * 100)
+        assert events[pos + 2] == ('end', )
+
+    def test_parse_incomplete(self):
+        # truncated bodies are noticed
+        content_type, body = multipart_body({
+            'file': (BytesIO(b'foo'), 'test.txt')})
+        boundary = get_boundary(content_type)
+        parser = MultipartParser(boundary)
+        parser.feed(body[:-10])
+        with pytest.raises(ValueError):
+            parser.close()
+
+    def test_parse_invalid_headers(self):
+        # parts must be form-data with a name
+        parser = MultipartParser(b'xx')
+        with pytest.raises(ValueError):
+            parser.feed(b'--xx\r\nContent-Type: text/plain\r\n\r\nfoo')
+
+    def test_parse_boundary_padding(self):
+        # boundary lines may be padded a bit, not endlessly
+        parser = MultipartParser(b'xx')
+        assert parser.feed(b'--xx  \r\n') == []
+        parser = MultipartParser(b'xx')
+        parser.feed(b'--xx' + b' ' * 65)
+        with pytest.raises(ValueError):
+            parser.feed(b' ')
+        parser = MultipartParser(b'xx')
+        with pytest.raises(ValueError):
+            parser.feed(b'--xx' + b' ' * 100 + b'\r\n')
+
+
+class TestHelpers(object):
+
+    def test_make_environ(self):
+        # we can turn ASGI scopes into WSGI environments
+        environ = make_environ({
+            'type': 'http', 'method': 'POST', 'path': '/index.html',
+            'query_string': b'a=1', 'headers': [
+                (b'content-type', b'text/plain'),
+                (b'authorization', b'Basic Zm9vOmJhcg==')]})
+        assert environ['REQUEST_METHOD'] == 'POST'
+        assert environ['PATH_INFO'] == '/index.html'
+        assert environ['QUERY_STRING'] == 'a=1'
+        assert environ['CONTENT_TYPE'] == 'text/plain'
+        assert environ['HTTP_AUTHORIZATION'] == 'Basic Zm9vOmJhcg=='
+
+
+class TestAsyncApp(object):
+
+    def test_unauthorized_by_default(self):
+        # by default we get an Unauthorized message
+        app = AsyncDropAFileApplication()
+        status, headers, body = call_app(app)
+        assert status == 401
+        assert 'www-authenticate' in headers
+
+    def test_auth_in_executor(self):
+        # credentials are checked outside the event loop thread
+        app = AsyncDropAFileApplication()
+        threads = []
+        app.check_auth = lambda request: threads.append(
+            threading.current_thread()) or True
+        status, headers, body = call_app(app)
+        assert status == 200
+        assert threads and threads[0] is not threading.current_thread()
+
+    def test_page_response(self):
+        # we can get some HTML page for any path
+        app = AsyncDropAFileApplication()
+        headers = {'Authorization': encode_creds(password=app.password)}
+        status, headers, body = call_app(app, headers=headers)
+        assert status == 200
+        assert headers['content-type'] == 'text/html; charset=utf-8'
+        assert body == app.static_assets['/index.html'].data
+
+    def test_get_js_streamed(self):
+        # files sent from disk are sent in several blocks
+        app = AsyncDropAFileApplication()
+        headers = {'Authorization': encode_creds(password=app.password)}
+        status, headers, body = call_app(
+            app, path='/dropzone.js', headers=headers)
+        assert status == 200
+        assert body == app.static_assets['/dropzone.js'].data
+
+    def test_get_js_range(self):
+        # ranges can be requested like in the WSGI app
+        app = AsyncDropAFileApplication()
+        headers = {'Authorization': encode_creds(password=app.password),
+                   'Range': 'bytes=-10'}
+        status, headers, body = call_app(
+            app, path='/dropzone.js', headers=headers)
+        assert status == 206
+        assert body == app.static_assets['/dropzone.js'].data[-10:]
+
+    def test_session(self):
+        # session cookies are set like in the WSGI app
+        app = AsyncDropAFileApplication(session_lifetime=60)
+        headers = {'Authorization': encode_creds(password=app.password)}
+        status, headers, body = call_app(app, headers=headers)
+        assert status == 200
+        cookie = headers['set-cookie'].split(';')[0]
+        status, headers, body = call_app(app, headers={'Cookie': cookie})
+        assert status == 200
+        assert 'set-cookie' not in headers
+
+    def test_get_js_gzipped(self):
+        # static files are delivered like in the WSGI app
+        app = AsyncDropAFileApplication()
+        headers = {'Authorization': encode_creds(password=app.password),
+                   'Accept-Encoding': 'gzip'}
+        status, headers, body = call_app(
+            app, path='/dropzone.js', headers=headers)
+        assert status == 200
+        assert headers['content-encoding'] == 'gzip'
+        assert body == app.static_assets['/dropzone.js'].encodings['gzip']
+
+    def test_send_file(self):
+        # we can send files
+        app = AsyncDropAFileApplication()
+        content_type, body = multipart_body({
+            'file': (BytesIO(b'Some Content' * 1000), 'sample.txt'),
+            'not_file': (BytesIO(b'Other Content'), 'other.txt')})
+        headers = {'Authorization': encode_creds(password=app.password),
+                   'Content-Type': content_type}
+        status, headers, resp_body = call_app(
+            app, method='POST', path='/index.html', headers=headers,
+            body=body, chunk_size=100)
+        assert status == 200
+        assert os.listdir(app.upload_dir) == ['sample.txt']
+        with open(os.path.join(app.upload_dir, 'sample.txt'), 'rb') as fd:
+            assert fd.read() == b'Some Content' * 1000
+
+    def test_send_file_preallocated(self, monkeypatch):
+        # space can be preallocated, files are truncated when complete
+        monkeypatch.setattr('dropafile.PREALLOCATE_MIN_SIZE', 0)
+        app = AsyncDropAFileApplication(preallocate=True)
+        content_type, body = multipart_body({
+            'file': (BytesIO(b'Some Content' * 1000), 'sample.txt')})
+        headers = {'Authorization': encode_creds(password=app.password),
+                   'Content-Type': content_type,
+                   'Content-Length': str(len(body))}
+        status, headers, resp_body = call_app(
+            app, method='POST', path='/index.html', headers=headers,
+            body=body, chunk_size=100)
+        assert status == 200
+        with open(os.path.join(app.upload_dir, 'sample.txt'), 'rb') as fd:
+            assert fd.read() == b'Some Content' * 1000
+
+    def test_send_files_preallocated(self, monkeypatch):
+        # only the first file gets space preallocated, given back later
+        monkeypatch.setattr('dropafile.PREALLOCATE_MIN_SIZE', 0)
+        sizes = []
+
+        def fake_preallocate(fd, size):
+            sizes.append(size)
+            return preallocate(fd, size)
+
+        monkeypatch.setattr('dropafile.preallocate', fake_preallocate)
+        app = AsyncDropAFileApplication(preallocate=True)
+        content_type, body = multipart_body(MultiDict([
+            ('file[0]', (BytesIO(b'foo' * 1000), 'foo.txt')),
+            ('file[1]', (BytesIO(b'bar' * 100000), 'bar.txt'))]))
+        headers = {'Authorization': encode_creds(password=app.password),
+                   'Content-Type': content_type,
+                   'Content-Length': str(len(body))}
+        status, headers, resp_body = call_app(
+            app, method='POST', path='/index.html', headers=headers,
+            body=body, chunk_size=1000)
+        assert status == 200
+        assert sizes == [len(body)]
+        for name, size in (('foo.txt', 3000), ('bar.txt', 300000)):
+            st = os.stat(os.path.join(app.upload_dir, name))
+            assert st.st_size == size
+            assert st.st_blocks * 512 < size + 8192
+
+    def test_send_files_multiple(self):
+        # we can send several files at once
+        app = AsyncDropAFileApplication()
+        content_type, body = multipart_body(MultiDict([
+            ('file[0]', (BytesIO(b'foo'), 'foo.txt')),
+            ('file[1]', (BytesIO(b'bar'), 'bar.txt'))]))
+        headers = {'Authorization': encode_creds(password=app.password),
+                   'Content-Type': content_type}
+        status, headers, resp_body = call_app(
+            app, method='POST', path='/index.html', headers=headers,
+            body=body)
+        assert status == 200
+        assert sorted(os.listdir(app.upload_dir)) == ['bar.txt', 'foo.txt']
+
+    def test_send_file_digest(self):
+        # digests of sent files are returned, duplicates can be skipped
+        app = AsyncDropAFileApplication(dedup='skip')
+        for num in range(2):
+            content_type, body = multipart_body({
+                'file': (BytesIO(b'Some Content'), 'sample.txt')})
+            headers = {'Authorization': encode_creds(password=app.password),
+                       'Content-Type': content_type}
+            status, headers, resp_body = call_app(
+                app, method='POST', path='/index.html', headers=headers,
+                body=body, chunk_size=5)
+            assert headers['x-upload-digest'] == 'sha256=%s' % (
+                hashlib.sha256(b'Some Content').hexdigest())
+        assert os.listdir(app.upload_dir) == ['sample.txt']
+
+    def test_send_file_chunked(self):
+        # we can send files in chunks, written right into a partial file
+        app = AsyncDropAFileApplication()
+        app.storage.open_write = None
+        for num in range(3):
+            content_type, body = multipart_body(
+                chunk_data(b'Some Content', num, chunk_size=5))
+            headers = {'Authorization': encode_creds(password=app.password),
+                       'Content-Type': content_type}
+            status, headers, resp_body = call_app(
+                app, method='POST', path='/index.html', headers=headers,
+                body=body)
+            assert status == 200
+        assert sorted(os.listdir(app.upload_dir)) == [
+            '.chunks-some-uuid.done', 'test.txt']
+        with open(os.path.join(app.upload_dir, 'test.txt'), 'rb') as fd:
+            assert fd.read() == b'Some Content'
+
+    def test_send_file_truncated(self):
+        # incomplete bodies give 400, no files are left over
+        app = AsyncDropAFileApplication()
+        content_type, body = multipart_body({
+            'file': (BytesIO(b'Some Content'), 'sample.txt')})
+        headers = {'Authorization': encode_creds(password=app.password),
+                   'Content-Type': content_type}
+        status, headers, resp_body = call_app(
+            app, method='POST', path='/index.html', headers=headers,
+            body=body[:-20])
+        assert status == 400
+        assert os.listdir(app.upload_dir) == []
+
+    def test_send_file_too_large(self):
+        # too large files result in 413, nothing is stored
+        app = AsyncDropAFileApplication(max_file_size=1000)
+        content_type, body = multipart_body({
+            'file': (BytesIO(b'Some Content' * 100), 'sample.txt')})
+        headers = {'Authorization': encode_creds(password=app.password),
+                   'Content-Type': content_type}
+        status, headers, resp_body = call_app(
+            app, method='POST', path='/index.html', headers=headers,
+            body=body, chunk_size=100)
+        assert status == 413
+        assert os.listdir(app.upload_dir) == []
+
+    @pytest.mark.parametrize("content_length", [True, False])
+    def test_send_request_too_large(self, content_length):
+        # too large requests result in 413, with or w/o Content-Length
+        app = AsyncDropAFileApplication(max_request_size=1000)
+        content_type, body = multipart_body({
+            'file': (BytesIO(b'Some Content' * 100), 'sample.txt')})
+        headers = {'Authorization': encode_creds(password=app.password),
+                   'Content-Type': content_type}
+        if content_length:
+            headers['Content-Length'] = str(len(body))
+        status, headers, resp_body = call_app(
+            app, method='POST', path='/index.html', headers=headers,
+            body=body, chunk_size=100)
+        assert status == 413
+        assert os.listdir(app.upload_dir) == []
+
+    def test_metrics(self):
+        # uploads are recorded in metrics
+        app = AsyncDropAFileApplication()
+        content_type, body = multipart_body({
+            'file': (BytesIO(b'Some Content'), 'sample.txt')})
+        headers = {'Authorization': encode_creds(password=app.password),
+                   'Content-Type': content_type}
+        call_app(app, method='POST', path='/index.html', headers=headers,
+                 body=body)
+        status, headers, resp_body = call_app(
+            app, path='/metrics', headers={
+                'Authorization': encode_creds(password=app.password)})
+        assert status == 200
+        assert b'dropafile_upload_bytes_sum %d.0\n' % len(body) in resp_body
+        assert b'dropafile_auth_seconds_count 2\n' in resp_body
+
+    def test_send_file_unauthorized(self):
+        # unauthorized uploads are not stored
+        app = AsyncDropAFileApplication()
+        content_type, body = multipart_body({
+            'file': (BytesIO(b'Some Content'), 'sample.txt')})
+        headers = {'Content-Type': content_type}
+        status, headers, resp_body = call_app(
+            app, method='POST', path='/index.html', headers=headers,
+            body=body)
+        assert status == 401
+        assert os.listdir(app.upload_dir) == []
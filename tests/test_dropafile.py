@@ -1,20 +1,45 @@
 # tests for dropafile module.
+import argparse
 import base64
+import errno
+import hashlib
+import http.client
+import json
+import logging
+import logging.handlers
 import math
 import os
 import pytest
 import re
 import shutil
+import socket
+import ssl
 import subprocess
+import sys
 import tempfile
+import threading
+import time
+import zlib
 from contextlib import contextmanager
 from io import BytesIO
-from werkzeug.datastructures import Headers
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
 from werkzeug.test import Client, create_environ, EnvironBuilder
 from werkzeug.wrappers import BaseResponse, Request
+from werkzeug.wsgi import ClosingIterator, FileWrapper
 from dropafile import (
     DropAFileApplication, execute_cmd, create_ssl_cert, get_random_password,
-    ALLOWED_PWD_CHARS, handle_options, run_server, get_store_path
+    ALLOWED_PWD_CHARS, handle_options, run_server, get_store_path,
+    load_static_asset, PATH_MAP, STATIC_DIR, compress_gzip, brotli,
+    UploadRequest, record_chunk, ConcurrencyLimit,
+    StorePathAllocator, claim_path, get_ssl_context, get_cached_ssl_cert,
+    cert_valid_for, write_ssl_cert, x509, parse_size, Histogram, Metrics,
+    UploadStream, setup_logging, logger, hash_password, verify_password,
+    read_secret_file, AuthCache, SESSION_COOKIE, get_file_digest,
+    DigestIndex, StoredFile, FlatStorage, ContentAddressedStorage,
+    get_tls_stats, get_version, CertPool, start_health_endpoint,
+    get_server_cert, Syncer, copy_stream, preallocate, create_upload_stream,
+    ChunkStream, serve, UMASK
     )
 
 
@@ -36,6 +61,108 @@ def popen(*args, **kw):
         p.wait()
 
 
+def tls_handshakes(ssl_context, num, max_version=None):
+    # connect `num` times to a server using `ssl_context`, resuming the
+    # first session. Returns the TLS versions used.
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(num)
+
+    def serve():
+        for _ in range(num):
+            conn, _ = server.accept()
+            try:
+                with ssl_context.wrap_socket(conn, server_side=True) as tls:
+                    tls.sendall(b'x')
+                    tls.recv(1)
+            except ssl.SSLError:
+                conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    client_context = ssl._create_unverified_context()
+    if max_version is not None:
+        client_context.maximum_version = max_version
+    session, versions = None, []
+    for _ in range(num):
+        conn = socket.create_connection(server.getsockname())
+        with client_context.wrap_socket(conn, session=session) as tls:
+            tls.recv(1)  # TLS 1.3 tickets arrive after the handshake
+            tls.sendall(b'x')
+            session = session or tls.session
+            versions.append(tls.version())
+    thread.join()
+    server.close()
+    return versions
+
+
+@pytest.fixture(scope="function")
+def static_dir(request, monkeypatch):
+    """A temporary copy of the static files dir, set as `STATIC_DIR`.
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'static')
+    shutil.copytree(STATIC_DIR, path)
+    monkeypatch.setattr('dropafile.STATIC_DIR', path)
+    return path
+
+
+@pytest.fixture(scope="function")
+def log_listener(request, capsys):
+    """Log to (captured) stdout in background.
+
+    Use :func:`flush_log` to get all records written.
+    """
+    listener = setup_logging()
+
+    def teardown():
+        listener.stop()
+        for log in (logger, logging.getLogger('werkzeug')):
+            for handler in log.handlers[:]:
+                log.removeHandler(handler)
+            log.setLevel(logging.NOTSET)
+            log.propagate = True
+
+    request.addfinalizer(teardown)
+    return listener
+
+
+def flush_log(listener):
+    # let `listener` write all pending records
+    listener.stop()
+    listener.start()
+
+
+def chunk_data(content, index, chunk_size=4, upload_id='some-uuid',
+               filename='test.txt'):
+    # form data of chunk number `index` of `content` as sent by dropzone
+    chunks = int(math.ceil(len(content) / float(chunk_size)))
+    start = index * chunk_size
+    return {
+        'dzuuid': upload_id,
+        'dzchunkindex': str(index),
+        'dztotalfilesize': str(len(content)),
+        'dzchunksize': str(chunk_size),
+        'dztotalchunkcount': str(chunks),
+        'dzchunkbyteoffset': str(start),
+        'file': (BytesIO(content[start:start + chunk_size]), filename),
+        }
+
+
+class UnreadableStream(object):
+    # a `wsgi.input` that must not be read
+    def read(self, *args):
+        raise AssertionError('request body read')
+
+    readline = read
+
+
+def call_wsgi_app(app, environ):
+    # call WSGI `app` with `environ`, return status line and body
+    status = []
+    body = b''.join(app(environ, lambda s, h, e=None: status.append(s)))
+    return status[0], body
+
+
 def encode_creds(username='somename', password=''):
     # turn credentials given into base64 encoded string
     auth_string = '%s:%s' % (username, password)
@@ -76,6 +203,234 @@ class TestHelpers(object):
         assert os.path.isfile(cert_path)
         shutil.rmtree(os.path.dirname(cert_path))
 
+    @pytest.mark.parametrize("key_type", ["rsa", "ec", "ed25519"])
+    def test_create_cert_key_types(self, key_type):
+        # we can create certs with different types of keys
+        cert_path, key_path = create_ssl_cert(key_type=key_type, bits=2048)
+        assert os.path.isfile(cert_path)
+        assert os.path.isfile(key_path)
+        assert cert_valid_for(cert_path, 3600) is True
+        assert cert_valid_for(cert_path, 3 * 86400) is False
+        get_ssl_context(cert_path, key_path)
+
+    @pytest.mark.parametrize("key_type", ["rsa", "ec", "ed25519"])
+    def test_create_cert_openssl(self, key_type, monkeypatch):
+        # w/o cryptography, we create certs with openssl
+        monkeypatch.setattr('dropafile.x509', None)
+        cert_path, key_path = create_ssl_cert(key_type=key_type, bits=2048)
+        assert cert_valid_for(cert_path, 3600) is True
+        get_ssl_context(cert_path, key_path)
+
+    @pytest.mark.skipif(x509 is None, reason="needs cryptography")
+    def test_write_ssl_cert(self):
+        # we can create certs in-process
+        path = tempfile.mkdtemp()
+        cert_path = os.path.join(path, 'cert.pem')
+        key_path = os.path.join(path, 'cert.key')
+        write_ssl_cert(cert_path, key_path, key_type='ec', cn='example.org')
+        with open(cert_path, 'rb') as fd:
+            cert = x509.load_pem_x509_certificate(fd.read())
+        assert cert.subject.rfc4514_string() == 'CN=example.org,C=US'
+        assert oct(os.stat(key_path).st_mode & 0o777) == oct(0o600)
+        # validity is computed in UTC
+        assert cert_valid_for(cert_path, 86400 * 2 - 60) is True
+        assert cert_valid_for(cert_path, 86400 * 2 + 60) is False
+
+    def test_get_cached_ssl_cert(self, capsys):
+        # certs in a cache dir are reused
+        cache_dir = os.path.join(tempfile.mkdtemp(), 'certs')
+        cert_path, key_path = get_cached_ssl_cert(cache_dir, key_type='ec')
+        # the generation created was published by the `current` link
+        link_path = os.path.join(cache_dir, 'ec', 'current')
+        gen_path = os.path.join(cache_dir, 'ec', os.readlink(link_path))
+        assert cert_path == os.path.join(gen_path, 'cert.pem')
+        assert key_path == os.path.join(gen_path, 'cert.key')
+        assert sorted(os.listdir(os.path.join(cache_dir, 'ec'))) == [
+            'current', os.path.basename(gen_path)]
+        assert sorted(os.listdir(gen_path)) == ['cert.key', 'cert.pem']
+        with open(cert_path, 'rb') as fd:
+            cert = fd.read()
+        out, err = capsys.readouterr()
+        assert get_cached_ssl_cert(cache_dir, key_type='ec') == (
+            cert_path, key_path)
+        with open(cert_path, 'rb') as fd:
+            assert fd.read() == cert
+        out, err = capsys.readouterr()
+        assert 'Reusing SSL certificate' in out
+        assert 'Certificate in: %s' % cert_path in out
+
+    def test_get_ssl_context(self):
+        # we get contexts for TLS >= 1.2, with ECDHE for TLS 1.2
+        cert_path, key_path = create_ssl_cert(key_type='ec')
+        ssl_context = get_ssl_context(cert_path, key_path, tickets=3)
+        assert ssl_context.minimum_version == ssl.TLSVersion.TLSv1_2
+        assert not ssl_context.options & ssl.OP_NO_TICKET
+        assert ssl_context.num_tickets == 3
+        for cipher in ssl_context.get_ciphers():
+            if cipher['protocol'] == 'TLSv1.2':
+                assert cipher['kea'] == 'kx-ecdhe'
+                assert cipher['aead'] is True
+
+    @pytest.mark.parametrize("version", ["TLSv1.2", "TLSv1.3"])
+    def test_get_tls_stats(self, version):
+        # we can tell how many handshakes resumed a session
+        cert_path, key_path = create_ssl_cert(key_type='ec')
+        ssl_context = get_ssl_context(cert_path, key_path)
+        assert get_tls_stats(ssl_context) == dict(
+            handshakes=0, resumed=0, resumption_ratio=0.0)
+        max_version = getattr(ssl.TLSVersion, version.replace('.', '_'))
+        assert tls_handshakes(ssl_context, 4, max_version) == [version] * 4
+        assert get_tls_stats(ssl_context) == dict(
+            handshakes=4, resumed=3, resumption_ratio=0.75)
+
+    def test_get_cached_ssl_cert_expiring(self, monkeypatch):
+        # certs about to expire are replaced by a new generation, the
+        # old pair stays intact for servers using it
+        cache_dir = tempfile.mkdtemp()
+        cert_path, key_path = get_cached_ssl_cert(cache_dir, key_type='ec')
+        with open(cert_path, 'rb') as fd:
+            cert = fd.read()
+        new_paths = get_cached_ssl_cert(
+            cache_dir, key_type='ec', min_validity=86400 * 3)
+        assert new_paths != (cert_path, key_path)
+        with open(new_paths[0], 'rb') as fd:
+            assert fd.read() != cert
+        with open(cert_path, 'rb') as fd:
+            assert fd.read() == cert
+        ssl.create_default_context(ssl.Purpose.CLIENT_AUTH).load_cert_chain(
+            *new_paths)
+        assert get_cached_ssl_cert(cache_dir, key_type='ec') == new_paths
+        # expired generations are removed
+        monkeypatch.setattr(
+            'dropafile.cert_valid_for', lambda path, seconds: False)
+        get_cached_ssl_cert(cache_dir, key_type='ec')
+        assert len([name for name in os.listdir(os.path.join(cache_dir, 'ec'))
+                    if name.startswith('gen-')]) == 1
+
+    def test_get_version(self):
+        # we can get the version of the installed distribution
+        import dropafile
+        assert get_version() == dropafile.__version__
+        assert re.match(r'^\d+\.\d+', get_version())
+        with pytest.raises(AttributeError):
+            dropafile.unknown_attribute
+
+    def test_import_is_lean(self):
+        # slow imports are deferred until needed
+        output = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, dropafile; print("\\n".join(sys.modules))'],
+            universal_newlines=True)
+        imported = set(output.splitlines())
+        assert 'dropafile' in imported
+        for name in ('pkg_resources', 'importlib.metadata', 'cryptography',
+                     'subprocess', 'werkzeug.serving'):
+            assert name not in imported
+
+    def test_copy_stream(self):
+        # we can copy file objects, reusing one buffer if possible
+        buffers = []
+
+        class Source(BytesIO):
+            def readinto(self, buf):
+                buffers.append(buf)
+                return super(Source, self).readinto(buf)
+
+        target = BytesIO()
+        copy_stream(Source(b'0123456789'), target, buffer_size=4)
+        assert target.getvalue() == b'0123456789'
+        assert len(buffers) == 4
+        assert all(buf is buffers[0] for buf in buffers)
+
+    def test_copy_stream_read_only(self):
+        # sources without `readinto` are read
+        class Source(object):
+            def __init__(self):
+                self.stream = BytesIO(b'0123456789')
+
+            def read(self, size=-1):
+                return self.stream.read(size)
+
+        target = BytesIO()
+        copy_stream(Source(), target, buffer_size=4)
+        assert target.getvalue() == b'0123456789'
+
+    def test_preallocate(self, monkeypatch):
+        # we can allocate disk space for files of known size
+        monkeypatch.setattr('dropafile.PREALLOCATE_MIN_SIZE', 1000)
+        with create_upload_stream(tempfile.mkdtemp()) as stream:
+            assert preallocate(stream.fileno(), 999) is False
+            assert os.fstat(stream.fileno()).st_size == 0
+            assert preallocate(stream.fileno(), 5000) is True
+            assert os.fstat(stream.fileno()).st_size == 5000
+
+    def test_preallocate_unsupported(self, monkeypatch):
+        # filesystems refusing preallocation are no problem
+        messages = []
+
+        def posix_fallocate(fd, offset, size):
+            raise OSError(errno.ENOSPC, 'no space left')
+
+        monkeypatch.setattr('os.posix_fallocate', posix_fallocate)
+        monkeypatch.setattr(
+            'dropafile.logger.debug', lambda *args: messages.append(args))
+        with create_upload_stream(tempfile.mkdtemp()) as stream:
+            assert preallocate(stream.fileno(), 1 << 24) is False
+        assert len(messages) == 1
+        assert 'no space left' in messages[0][0] % messages[0][1:]
+
+    def test_start_health_endpoint(self):
+        # we can tell we are starting over plain HTTP
+        server = start_health_endpoint(0)
+        try:
+            conn = http.client.HTTPConnection(
+                '127.0.0.1', server.server_port)
+            conn.request('GET', '/health')
+            resp = conn.getresponse()
+            assert resp.status == 200
+            assert resp.read() == b'starting\n'
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_get_server_cert_pool(self, capsys, monkeypatch):
+        # with a cert pool, we take certs from there and refill it
+        monkeypatch.setattr(CertPool, 'start_filling', CertPool.fill)
+        options = handle_options([
+            '--cert-pool', tempfile.mkdtemp(), '--key-type', 'ec',
+            '--cert-pool-size', '1'])
+        cert_path, key_path = get_server_cert(options)
+        out, err = capsys.readouterr()
+        assert 'Creating temporary self-signed SSL certificate' in out
+        assert 'Certificate in: %s' % cert_path in out
+        cert_path, key_path = get_server_cert(options)
+        out, err = capsys.readouterr()
+        assert 'Taking SSL certificate from pool.' in out
+        assert 'Certificate in: %s' % cert_path in out
+        assert cert_path.startswith(options.cert_pool)
+        assert len(os.listdir(os.path.join(options.cert_pool, 'ec'))) == 2
+
+    def test_get_server_cert_health(self, monkeypatch):
+        # while a cert is created, the health endpoint is served
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        answers = []
+
+        def fake_get_ssl_cert(*args, **kw):
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            conn.request('GET', '/')
+            answers.append(conn.getresponse().read())
+            conn.close()
+            return 'cert.pem', 'cert.key'
+
+        monkeypatch.setattr('dropafile.get_ssl_cert', fake_get_ssl_cert)
+        options = handle_options(['--health-port', '%s' % port])
+        assert get_server_cert(options) == ('cert.pem', 'cert.key')
+        assert answers == [b'starting\n']
+
     def test_get_random_password(self):
         # we can get a random password
         allowed_chars = '[A-HJ-NP-Z2-9a-hjkmnp-z]'
@@ -90,6 +445,160 @@ class TestHelpers(object):
         password = get_random_password()
         assert len(password) * entropy_per_char >= 128
 
+    def test_load_static_asset(self):
+        # we can load static files into memory
+        asset = load_static_asset('style.css', 'text/css')
+        path = os.path.join(STATIC_DIR, 'style.css')
+        with open(path, 'rb') as fd:
+            content = fd.read()
+        assert asset.path == path
+        assert asset.data == content
+        assert asset.mimetype == 'text/css'
+        assert asset.content_length == len(content)
+        assert asset.mtime == os.path.getmtime(path)
+        assert asset.etag == hashlib.sha256(content).hexdigest()[:32]
+
+    def test_load_static_asset_encodings(self):
+        # compressed variants of static files are created on load
+        asset = load_static_asset('dropzone.js', 'text/javascript')
+        assert 'gzip' in asset.encodings
+        assert len(asset.encodings['gzip']) < asset.content_length
+        assert zlib.decompress(
+            asset.encodings['gzip'], 16 + zlib.MAX_WBITS) == asset.data
+
+    @pytest.mark.skipif(brotli is None, reason="needs brotli")
+    def test_load_static_asset_encodings_brotli(self):
+        # with brotli installed, we also provide brotli variants
+        asset = load_static_asset('dropzone.js', 'text/javascript')
+        assert brotli.decompress(asset.encodings['br']) == asset.data
+
+    def test_compress_gzip(self):
+        # we can gzip data, the result depends on data only
+        compressed = compress_gzip(b'foo' * 100)
+        assert zlib.decompress(compressed, 16 + zlib.MAX_WBITS) == (
+            b'foo' * 100)
+        assert compress_gzip(b'foo' * 100) == compressed
+
+    def test_parse_size(self):
+        # we can parse sizes with and without units
+        assert parse_size('1000') == 1000
+        assert parse_size('2K') == 2048
+        assert parse_size('2kb') == 2048
+        assert parse_size('1.5M') == 1572864
+        assert parse_size('1G') == 1024 ** 3
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_size('1X')
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_size('')
+
+    def test_setup_logging(self, capsys, log_listener):
+        # records are written in background, request logs to stderr
+        logger.info("Hi there")
+        logging.getLogger('werkzeug').info("GET /")
+        flush_log(log_listener)
+        out, err = capsys.readouterr()
+        assert out == 'Hi there\n'
+        assert err == 'GET /\n'
+
+    def test_setup_logging_json(self, log_listener):
+        # we can write JSON lines to files
+        log_file = os.path.join(tempfile.mkdtemp(), 'log.json')
+        listener = setup_logging(log_file=log_file, log_format='json')
+        assert len([handler for handler in logger.handlers if isinstance(
+            handler, logging.handlers.QueueHandler)]) == 1
+        logger.info("RECEIVED: %s", '/foo', extra=dict(
+            path='/foo', size=3, digest='abc', duration=0.5,
+            client='127.0.0.1', status=200))
+        listener.stop()
+        with open(log_file) as fd:
+            record = json.loads(fd.read())
+        assert record['message'] == 'RECEIVED: /foo'
+        assert record['level'] == 'INFO'
+        assert record['logger'] == 'dropafile'
+        assert record['path'] == '/foo'
+        assert record['size'] == 3
+        assert record['digest'] == 'abc'
+        assert record['duration'] == 0.5
+        assert record['client'] == '127.0.0.1'
+        assert record['status'] == 200
+
+    def test_setup_logging_multiprocess(self, capsys, log_listener):
+        # records of forked processes are not lost
+        listener = setup_logging(multiprocess=True)
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            logger.info("Hi from child")
+            os._exit(0)
+        os.waitpid(pid, 0)
+        listener.stop()
+        out, err = capsys.readouterr()
+        assert out == 'Hi from child\n'
+
+    def test_setup_logging_file(self, log_listener):
+        # we can write text logs to files
+        log_file = os.path.join(tempfile.mkdtemp(), 'log.txt')
+        listener = setup_logging(log_file=log_file)
+        logger.info("RECEIVED: %s", '/foo')
+        listener.stop()
+        with open(log_file) as fd:
+            assert fd.read().endswith(' RECEIVED: /foo\n')
+
+    def test_hash_password(self):
+        # we can hash passwords with scrypt and check them
+        hashed = hash_password('sosecret')
+        assert hashed.startswith('scrypt$16384$8$1$')
+        assert hashed != hash_password('sosecret')
+        assert verify_password('sosecret', hashed) is True
+        assert verify_password('wrong', hashed) is False
+        assert hash_password('sosecret', salt=b'salt') == (
+            hash_password('sosecret', salt=b'salt'))
+
+    def test_hash_password_pbkdf2(self, monkeypatch):
+        # we can hash passwords with PBKDF2
+        monkeypatch.setattr('dropafile.PBKDF2_ITERATIONS', 1000)
+        hashed = hash_password('sosecret', method='pbkdf2_sha256')
+        assert hashed.startswith('pbkdf2_sha256$1000$')
+        assert verify_password('sosecret', hashed) is True
+        assert verify_password('wrong', hashed) is False
+        with pytest.raises(ValueError):
+            hash_password('sosecret', method='md5')
+
+    def test_verify_password_invalid_hash(self):
+        # invalid hashes are complained about
+        for password_hash in ('', 'scrypt$1$ab$cd', 'md5$ab$cd',
+                              'pbkdf2_sha256$many$ab$cd', 'scrypt$x'):
+            with pytest.raises(ValueError):
+                verify_password('sosecret', password_hash)
+
+    def test_read_secret_file(self):
+        # we can read password hashes from files
+        path = os.path.join(tempfile.mkdtemp(), 'secret')
+        with open(path, 'w') as fd:
+            fd.write('pbkdf2_sha256$1000$ab$cd\n')
+        assert read_secret_file(path) == 'pbkdf2_sha256$1000$ab$cd'
+        with open(path, 'w') as fd:
+            fd.write('sosecret\n')
+        with pytest.raises(ValueError):
+            read_secret_file(path)
+
+    def test_auth_cache(self):
+        # the auth cache keeps the most recently used keys
+        cache = AuthCache(maxsize=2)
+        cache.add(b'a')
+        cache.add(b'b')
+        assert b'a' in cache
+        cache.add(b'c')
+        assert b'a' in cache
+        assert b'b' not in cache
+        assert b'c' in cache
+
+    def test_record_chunk(self):
+        # we can record chunk numbers
+        path = os.path.join(tempfile.mkdtemp(), 'chunks.idx')
+        assert record_chunk(path, 1, 8) == {1: 8}
+        assert record_chunk(path, 0, 4) == {0: 4, 1: 8}
+        assert record_chunk(path, 1, 8) == {0: 4, 1: 8}
+
     def test_get_store_path(self):
         # we can get a safe storage path
         store_dir = tempfile.mkdtemp()
@@ -117,6 +626,566 @@ class TestHelpers(object):
         path = get_store_path(store_dir, 'test.txt')
         assert path.endswith('/test.txt-1')
 
+    def test_get_store_path_claims_path(self):
+        # the path returned is claimed (by creating an empty file)
+        store_dir = tempfile.mkdtemp()
+        path1 = get_store_path(store_dir, 'test.txt')
+        assert os.path.isfile(path1)
+        assert os.path.getsize(path1) == 0
+        path2 = get_store_path(store_dir, 'test.txt')
+        assert path2 == path1 + '-1'
+
+    def test_get_store_path_concurrent(self):
+        # concurrent callers never get the same path
+        store_dir = tempfile.mkdtemp()
+        paths = []
+
+        def get_path():
+            paths.append(get_store_path(store_dir, 'scan.pdf'))
+
+        threads = [threading.Thread(target=get_path) for x in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set(paths)) == 20
+        assert len(os.listdir(store_dir)) == 20
+
+    def test_claim_path(self):
+        # we can claim paths
+        path = os.path.join(tempfile.mkdtemp(), 'test.txt')
+        assert claim_path(path) is True
+        assert os.path.isfile(path)
+        assert claim_path(path) is False
+
+    def test_concurrency_limit(self):
+        # we can limit the number of requests handled concurrently
+        running = []
+        max_running = []
+
+        def app(environ, start_response):
+            running.append(1)
+            max_running.append(len(running))
+            time.sleep(0.01)
+            running.pop()
+            return [b'']
+
+        def request():
+            app_iter = limited({}, None)
+            list(app_iter)
+            app_iter.close()
+
+        limited = ConcurrencyLimit(app, 2)
+        threads = [threading.Thread(target=request) for x in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(max_running) == 10
+        assert max(max_running) <= 2
+
+    def test_concurrency_limit_until_closed(self):
+        # requests hold their slot until the response was sent
+        closed = []
+
+        def app(environ, start_response):
+            return ClosingIterator([b'foo'], lambda: closed.append(1))
+
+        limited = ConcurrencyLimit(app, 1)
+        app_iter = limited({}, None)
+        assert list(app_iter) == [b'foo']
+        assert limited.semaphore.acquire(False) is False
+        app_iter.close()
+        assert closed == [1]
+        assert limited.semaphore.acquire(False) is True
+
+
+class TestDigestIndex(object):
+
+    def test_get_file_digest(self):
+        # we can get digests of files
+        path = os.path.join(tempfile.mkdtemp(), 'test.txt')
+        with open(path, 'wb') as fd:
+            fd.write(b'foo')
+        assert get_file_digest(path, 'sha256') == (
+            hashlib.sha256(b'foo').hexdigest())
+        assert get_file_digest(path, 'md5') == hashlib.md5(b'foo').hexdigest()
+
+    def test_index(self):
+        # files in a directory are indexed by digest, hidden ones not
+        upload_dir = tempfile.mkdtemp()
+        for name, content in (('a', b'foo'), ('b', b'foo'), ('.c', b'bar')):
+            with open(os.path.join(upload_dir, name), 'wb') as fd:
+                fd.write(content)
+        os.mkdir(os.path.join(upload_dir, 'd'))
+        index = DigestIndex(upload_dir, 'sha256')
+        foo, bar = [hashlib.sha256(x).hexdigest() for x in (b'foo', b'bar')]
+        assert index.get(foo) == os.path.join(upload_dir, 'a')
+        assert index.get(bar) is None
+        index.add(bar, os.path.join(upload_dir, '.c'))
+        assert index.get(bar) == os.path.join(upload_dir, '.c')
+
+    def test_index_removed_files(self):
+        # files removed meanwhile are forgotten
+        upload_dir = tempfile.mkdtemp()
+        with open(os.path.join(upload_dir, 'a'), 'wb') as fd:
+            fd.write(b'foo')
+        index = DigestIndex(upload_dir, 'sha256')
+        os.unlink(os.path.join(upload_dir, 'a'))
+        assert index.get(hashlib.sha256(b'foo').hexdigest()) is None
+        assert index.paths == {}
+
+
+class TestStorage(object):
+
+    def test_flat_store(self):
+        # files are stored under their name, renamed or copied
+        upload_dir = tempfile.mkdtemp()
+        storage = FlatStorage(upload_dir)
+        source = os.path.join(upload_dir, '.upload-foo')
+        with open(source, 'wb') as fd:
+            fd.write(b'foo')
+        target = storage.allocate('test.txt')
+        assert target == os.path.join(upload_dir, 'test.txt')
+        assert storage.store(target, source) == StoredFile(
+            target, 3, hashlib.sha256(b'foo').hexdigest())
+        target = storage.allocate('test.txt')
+        assert storage.store(target, BytesIO(b'bar'), 'known') == (
+            StoredFile(target, 3, 'known'))
+        assert sorted(os.listdir(upload_dir)) == ['test.txt', 'test.txt-1']
+
+    def test_flat_store_mode(self):
+        # stored files honour the umask
+        storage = FlatStorage(tempfile.mkdtemp())
+        writer = UploadStream(storage.open_write('test.txt'))
+        writer.write(b'foo')
+        stored_file = storage.commit(writer, storage.allocate('test.txt'))
+        mode = os.stat(stored_file.path).st_mode & 0o777
+        assert mode == 0o666 & ~UMASK
+
+    def test_cas_store(self):
+        # blobs are stored by digest in sharded subdirectories
+        upload_dir = tempfile.mkdtemp()
+        storage = ContentAddressedStorage(upload_dir)
+        digest = hashlib.sha256(b'foo').hexdigest()
+        stored_file = storage.store(
+            storage.allocate('test.txt'), BytesIO(b'foo'))
+        assert stored_file == StoredFile(os.path.join(
+            upload_dir, 'objects', digest[:2], digest[2:4], digest), 3, digest)
+        with open(stored_file.path, 'rb') as fd:
+            assert fd.read() == b'foo'
+        assert sorted(os.listdir(upload_dir)) == ['index.jsonl', 'objects']
+
+    def test_cas_store_duplicates(self):
+        # identical content is stored once, but indexed under each name
+        upload_dir = tempfile.mkdtemp()
+        storage = ContentAddressedStorage(upload_dir, depth=1)
+        source = os.path.join(upload_dir, '.upload-foo')
+        with open(source, 'wb') as fd:
+            fd.write(b'foo')
+        digest = hashlib.sha256(b'foo').hexdigest()
+        path1 = storage.store('a.txt', source, digest).path
+        path2 = storage.store('b.txt', BytesIO(b'foo')).path
+        assert path1 == path2 == os.path.join(
+            upload_dir, 'objects', digest[:2], digest)
+        assert sorted(os.listdir(upload_dir)) == ['index.jsonl', 'objects']
+        assert [entry['digest'] for entry in storage.lookup('b.txt')] == [
+            digest]
+
+    def test_cas_index(self):
+        # the index is read back on startup
+        upload_dir = tempfile.mkdtemp()
+        storage = ContentAddressedStorage(upload_dir)
+        for content in (b'foo', b'bar'):
+            storage.store('test.txt', BytesIO(content))
+        entries = ContentAddressedStorage(upload_dir).lookup('test.txt')
+        assert [(entry['name'], entry['digest'], entry['size'])
+                for entry in entries] == [
+            ('test.txt', hashlib.sha256(b'foo').hexdigest(), 3),
+            ('test.txt', hashlib.sha256(b'bar').hexdigest(), 3)]
+        assert entries[0]['time'] <= entries[1]['time']
+        assert storage.lookup('other.txt') == []
+
+    def test_flat_store_copy_failing(self):
+        # copies failing halfway leave no partial content at target
+        upload_dir = tempfile.mkdtemp()
+        storage = FlatStorage(upload_dir)
+
+        class FailingSource(object):
+            def __init__(self):
+                self.reads = 0
+
+            def read(self, size):
+                self.reads += 1
+                if self.reads > 1:
+                    raise IOError('connection lost')
+                return b'x' * 100
+
+        target = storage.allocate('test.txt')
+        with pytest.raises(IOError):
+            storage.store(target, FailingSource())
+        assert os.listdir(upload_dir) == ['test.txt']
+        assert os.path.getsize(target) == 0
+
+    def test_flat_store_fsync(self, monkeypatch):
+        # files are synced before they are renamed, dirs afterwards
+        synced = []
+        monkeypatch.setattr(
+            'dropafile.fsync_path',
+            lambda path: synced.append((path, os.listdir(upload_dir))))
+        upload_dir = tempfile.mkdtemp()
+        storage = FlatStorage(upload_dir, syncer=Syncer('file'))
+        target = storage.allocate('test.txt')
+        storage.store(target, BytesIO(b'foo'))
+        assert len(synced) == 2
+        assert synced[0][0].startswith(os.path.join(upload_dir, '.upload-'))
+        assert os.path.basename(synced[0][0]) in synced[0][1]
+        assert synced[1] == (upload_dir, ['test.txt'])
+
+    def test_cas_store_fsync(self, monkeypatch):
+        # blobs, new directories and the index are synced
+        synced = []
+        monkeypatch.setattr('dropafile.fsync_path', synced.append)
+        upload_dir = tempfile.mkdtemp()
+        storage = ContentAddressedStorage(
+            upload_dir, depth=1, syncer=Syncer('file'))
+        digest = hashlib.sha256(b'foo').hexdigest()
+        storage.store('a.txt', BytesIO(b'foo'))
+        blob_dir = os.path.join(upload_dir, 'objects', digest[:2])
+        assert synced[1:] == [
+            blob_dir, os.path.join(upload_dir, 'objects'), upload_dir,
+            os.path.join(upload_dir, 'index.jsonl')]
+        del synced[:]
+        storage.store('b.txt', BytesIO(b'foo'))
+        assert synced == [os.path.join(upload_dir, 'index.jsonl')]
+
+    def test_flat_store_preallocated(self, monkeypatch):
+        # preallocated space is dropped when writers are committed
+        monkeypatch.setattr('dropafile.PREALLOCATE_MIN_SIZE', 0)
+        upload_dir = tempfile.mkdtemp()
+        storage = FlatStorage(upload_dir, preallocate=True, buffer_size=16)
+        writer = UploadStream(storage.open_write('test.txt', 4096))
+        assert os.path.getsize(writer.name) == 4096
+        writer.write(b'foo' * 10)
+        writer.seek(0)
+        stored_file = storage.commit(writer, storage.allocate('test.txt'))
+        assert stored_file.size == 30
+        with open(stored_file.path, 'rb') as fd:
+            assert fd.read() == b'foo' * 10
+
+    def test_cas_requires_hash_name(self):
+        # content addressed storage needs digests
+        with pytest.raises(ValueError):
+            ContentAddressedStorage(tempfile.mkdtemp(), hash_name=None)
+
+
+class TestSyncer(object):
+
+    def test_invalid_mode(self):
+        # we complain about unknown modes
+        with pytest.raises(ValueError):
+            Syncer('sometimes')
+
+    def test_none(self, monkeypatch):
+        # by default nothing is synced
+        synced = []
+        monkeypatch.setattr('dropafile.fsync_path', synced.append)
+        Syncer().sync('/some/path')
+        assert synced == []
+
+    def test_file(self):
+        # files and dirs can be synced right away, time is recorded
+        metrics = Metrics()
+        syncer = Syncer('file', metrics=metrics)
+        path = tempfile.mkdtemp()
+        syncer.sync(path)
+        assert metrics.histograms['dropafile_fsync_seconds'].count == 1
+        with pytest.raises(OSError):
+            syncer.sync(os.path.join(path, 'not-existing'))
+
+    def test_batch(self, monkeypatch):
+        # paths synced concurrently are synced together, once each
+        synced = []
+        monkeypatch.setattr('dropafile.fsync_path', synced.append)
+        syncer = Syncer('batch', interval=0.1)
+        threads = [
+            threading.Thread(target=syncer.sync, args=(path, ))
+            for path in ('/a', '/b', '/a')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(synced) == ['/a', '/b']
+        syncer.sync('/a')
+        assert sorted(synced) == ['/a', '/a', '/b']
+
+    def test_batch_errors(self):
+        # errors are raised in the thread waiting for the path
+        syncer = Syncer('batch', interval=0.001)
+        with pytest.raises(OSError):
+            syncer.sync(os.path.join(tempfile.mkdtemp(), 'not-existing'))
+        syncer.sync(tempfile.mkdtemp())
+
+
+class TestCertPool(object):
+
+    def test_take_empty(self):
+        # empty pools hand out nothing
+        pool = CertPool(tempfile.mkdtemp(), key_type='ec')
+        assert pool.take() is None
+
+    def test_fill_and_take(self):
+        # we can take certs created before, each one once
+        pool = CertPool(tempfile.mkdtemp(), key_type='ec', size=2)
+        pool.fill()
+        assert len(pool.get_entries('ready-')) == 2
+        cert_path, key_path = pool.take()
+        assert os.path.isfile(key_path)
+        assert cert_valid_for(cert_path, 3600) is True
+        assert os.path.basename(
+            os.path.dirname(cert_path)).startswith('used-')
+        assert pool.take()[0] != cert_path
+        assert pool.take() is None
+
+    def test_take_expiring(self):
+        # certs expiring soon are not handed out
+        pool = CertPool(
+            tempfile.mkdtemp(), key_type='ec', size=1,
+            min_validity=3 * 86400)
+        pool.fill()
+        assert pool.take() is None
+
+    def test_start_filling(self):
+        # pools can be filled in background, leftovers are removed
+        directory = tempfile.mkdtemp()
+        leftover = os.path.join(directory, 'ec', 'tmp-leftover')
+        os.makedirs(leftover)
+        os.utime(leftover, (0, 0))
+        pool = CertPool(directory, key_type='ec', size=1)
+        pool.start_filling().join()
+        ready = pool.get_entries('ready-')
+        assert len(ready) == 1
+        assert os.listdir(pool.path) == [os.path.basename(ready[0])]
+
+
+class TestStorePathAllocator(object):
+
+    def test_get_store_path(self):
+        # we can get a safe storage path
+        store_dir = tempfile.mkdtemp()
+        allocator = StorePathAllocator(store_dir)
+        path = allocator.get_store_path('test.txt')
+        assert path == os.path.join(store_dir, 'test.txt')
+        assert os.path.isfile(path)
+
+    def test_get_store_path_numbered(self):
+        # already used names get numbers
+        store_dir = tempfile.mkdtemp()
+        allocator = StorePathAllocator(store_dir)
+        paths = [allocator.get_store_path('test.txt') for x in range(3)]
+        assert paths == [
+            os.path.join(store_dir, 'test.txt'),
+            os.path.join(store_dir, 'test.txt-1'),
+            os.path.join(store_dir, 'test.txt-2')]
+
+    def test_get_store_path_secure_filename(self):
+        # filenames are secured
+        store_dir = tempfile.mkdtemp()
+        allocator = StorePathAllocator(store_dir)
+        path = allocator.get_store_path('../../test.txt')
+        assert path == os.path.join(store_dir, 'test.txt')
+
+    def test_seeded_from_directory(self):
+        # existing files are considered when the allocator is created
+        store_dir = tempfile.mkdtemp()
+        for name in ('test.txt', 'test.txt-2', 'other-7', '.upload-1'):
+            open(os.path.join(store_dir, name), 'w').write('foo')
+        allocator = StorePathAllocator(store_dir)
+        assert allocator.next_num == {
+            'test.txt': 3, 'test.txt-2': 1, 'other': 8, 'other-7': 1}
+        path = allocator.get_store_path('test.txt')
+        assert path == os.path.join(store_dir, 'test.txt-3')
+
+    def test_files_created_later(self):
+        # files created by others are not overwritten
+        store_dir = tempfile.mkdtemp()
+        allocator = StorePathAllocator(store_dir)
+        open(os.path.join(store_dir, 'test.txt'), 'w').write('foo')
+        open(os.path.join(store_dir, 'test.txt-1'), 'w').write('foo')
+        path = allocator.get_store_path('test.txt')
+        assert path == os.path.join(store_dir, 'test.txt-2')
+        assert allocator.next_num['test.txt'] == 3
+
+    def test_concurrent(self):
+        # concurrent allocators never hand out the same path
+        store_dir = tempfile.mkdtemp()
+        allocators = [StorePathAllocator(store_dir) for x in range(2)]
+        paths = []
+
+        def get_path(allocator):
+            for x in range(10):
+                paths.append(allocator.get_store_path('scan.pdf'))
+
+        threads = [
+            threading.Thread(target=get_path, args=(allocators[x % 2], ))
+            for x in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set(paths)) == 40
+        assert len(os.listdir(store_dir)) == 40
+
+
+class TestMetrics(object):
+
+    def test_histogram(self):
+        # histograms sort values into buckets
+        hist = Histogram([1, 10])
+        for value in (0.5, 1, 5, 50):
+            hist.observe(value)
+        assert hist.counts == [2, 1, 1]
+        assert hist.count == 4
+        assert hist.sum == 56.5
+
+    def test_histogram_render(self):
+        # histograms can be rendered in Prometheus format
+        hist = Histogram([1, 10])
+        for value in (0.5, 5, 50):
+            hist.observe(value)
+        assert hist.render('foo') == [
+            'foo_bucket{le="1"} 1',
+            'foo_bucket{le="10"} 2',
+            'foo_bucket{le="+Inf"} 3',
+            'foo_sum 55.5',
+            'foo_count 3']
+
+    def test_observe(self):
+        # we can record values
+        metrics = Metrics()
+        metrics.observe('dropafile_auth_seconds', 0.002)
+        assert metrics.histograms['dropafile_auth_seconds'].count == 1
+        with pytest.raises(KeyError):
+            metrics.observe('unknown', 1)
+
+    def test_observe_upload(self):
+        # we can record uploads at once
+        metrics = Metrics()
+        metrics.observe_upload(4000000, 1.5, 0.5)
+        hists = metrics.histograms
+        assert hists['dropafile_upload_bytes'].sum == 4000000
+        assert hists['dropafile_upload_parse_seconds'].sum == 1.5
+        assert hists['dropafile_upload_write_seconds'].sum == 0.5
+        assert hists['dropafile_upload_throughput_mbps'].sum == 2.0
+
+    def test_render(self):
+        # all metrics are rendered, with help and type
+        metrics = Metrics()
+        text = metrics.render()
+        for name, help_text, buckets in Metrics.METRICS:
+            assert '# HELP %s %s\n' % (name, help_text) in text
+            assert '# TYPE %s histogram\n' % name in text
+            assert '%s_count 0\n' % name in text
+        assert 'dropafile_tls' not in text
+
+    def test_render_tls(self):
+        # TLS handshake counters are rendered if we know the context
+        cert_path, key_path = create_ssl_cert(key_type='ec')
+        ssl_context = get_ssl_context(cert_path, key_path)
+        tls_handshakes(ssl_context, 2)
+        text = Metrics(ssl_context).render()
+        assert '# TYPE dropafile_tls_handshakes counter\n' in text
+        assert 'dropafile_tls_handshakes 2\n' in text
+        assert 'dropafile_tls_resumed 1\n' in text
+        assert 'dropafile_tls_resumption_ratio 0.5\n' in text
+
+
+class TestUploadRequest(object):
+
+    def test_spool_by_default(self):
+        # w/o an upload dir, uploads are spooled as usual
+        builder = EnvironBuilder(
+            method='POST',
+            data={'file': (BytesIO(b'foo'), 'test.txt')}
+            )
+        req = UploadRequest(builder.get_environ())
+        assert req.files['file'].read() == b'foo'
+        assert req.upload_streams == []
+
+    def test_stream_to_storage(self):
+        # with a storage set, files are written into its writers
+        upload_dir = tempfile.mkdtemp()
+        builder = EnvironBuilder(
+            method='POST',
+            data={'file': (BytesIO(b'foo'), 'test.txt'),
+                  'other': (BytesIO(b'bar'), 'test2.txt')}
+            )
+        req = UploadRequest(builder.get_environ())
+        req.storage = FlatStorage(upload_dir, buffer_size=1024)
+        stream = req.files['file'].stream
+        assert len(req.upload_streams) == 2
+        assert os.path.dirname(stream.name) == upload_dir
+        assert os.path.basename(stream.name).startswith('.upload-')
+        stream.close()
+        with open(stream.name, 'rb') as fd:
+            assert fd.read() == b'foo'
+
+    @pytest.mark.parametrize("streamed", [False, True])
+    def test_max_file_size(self, streamed):
+        # files larger than `max_file_size` are rejected while parsed
+        upload_dir = tempfile.mkdtemp()
+        builder = EnvironBuilder(
+            method='POST',
+            data={'file': (BytesIO(b'foo' * 10), 'test.txt'),
+                  'other': (BytesIO(b'bar'), 'test2.txt')}
+            )
+        req = UploadRequest(builder.get_environ())
+        if streamed:
+            req.storage = FlatStorage(upload_dir)
+        req.max_file_size = 20
+        with pytest.raises(RequestEntityTooLarge):
+            req.files
+        for stream in req.upload_streams:
+            req.storage.abort(stream)
+        assert os.listdir(upload_dir) == []
+
+    def test_max_file_size_not_exceeded(self):
+        # files up to `max_file_size` are accepted
+        upload_dir = tempfile.mkdtemp()
+        builder = EnvironBuilder(
+            method='POST',
+            data={'file': (BytesIO(b'foo' * 10), 'test.txt'),
+                  'other': (BytesIO(b'bar'), 'test2.txt')}
+            )
+        req = UploadRequest(builder.get_environ())
+        req.storage = FlatStorage(upload_dir)
+        req.max_file_size = 30
+        stream = req.files['file'].stream
+        assert stream in req.upload_streams
+        stream.close()
+        with open(stream.name, 'rb') as fd:
+            assert fd.read() == b'foo' * 10
+
+    def test_upload_stream(self):
+        # upload streams count bytes and time written
+        stream = UploadStream(BytesIO())
+        stream.write(b'foo')
+        stream.write(b'bar')
+        assert stream.size == 6
+        assert stream.write_time > 0
+        assert stream.getvalue() == b'foobar'
+        stream = UploadStream(BytesIO(), limit=5)
+        with pytest.raises(RequestEntityTooLarge):
+            stream.write(b'foobar')
+
+    def test_upload_stream_digest(self):
+        # upload streams can compute digests of data written
+        stream = UploadStream(BytesIO(), hash_name='sha256')
+        stream.write(b'foo')
+        stream.write(b'bar')
+        assert stream.hexdigest() == hashlib.sha256(b'foobar').hexdigest()
+        assert UploadStream(BytesIO()).hexdigest() is None
+
 
 class TestApp(object):
     # no browser tests here
@@ -132,6 +1201,53 @@ class TestApp(object):
         app = DropAFileApplication(password='verysecret')
         assert app.password == 'verysecret'
 
+    def test_app_has_path_allocator(self):
+        # DropAFileApplications allocate paths in the upload dir
+        app = DropAFileApplication()
+        assert isinstance(app.storage, FlatStorage)
+        assert app.storage.path_allocator.directory == app.upload_dir
+
+    def test_app_loads_static_assets(self):
+        # all static files are read on startup
+        app = DropAFileApplication()
+        assert sorted(app.static_assets.keys()) == sorted(PATH_MAP.keys())
+        assert app.reload_static is False
+
+    def test_get_static_asset(self):
+        # we can get static assets by path
+        app = DropAFileApplication()
+        asset = app.get_static_asset('/dropzone.js')
+        assert asset.path == os.path.join(STATIC_DIR, 'dropzone.js')
+        assert asset.mimetype == 'text/javascript'
+
+    def test_get_static_asset_unknown_path(self):
+        # unknown paths give the index page
+        app = DropAFileApplication()
+        asset = app.get_static_asset('/not-existing')
+        assert asset is app.static_assets['/index.html']
+
+    def test_get_static_asset_cached(self, static_dir):
+        # modifications of static files are not noticed by default
+        app = DropAFileApplication()
+        path = os.path.join(static_dir, 'style.css')
+        with open(path, 'w') as fd:
+            fd.write('changed')
+        os.utime(path, (0, 0))
+        asset = app.get_static_asset('/style.css')
+        assert asset.data != b'changed'
+
+    def test_get_static_asset_reload(self, static_dir):
+        # with `reload_static` we notice changed static files
+        app = DropAFileApplication(reload_static=True)
+        path = os.path.join(static_dir, 'style.css')
+        with open(path, 'w') as fd:
+            fd.write('changed')
+        os.utime(path, (0, 0))
+        asset = app.get_static_asset('/style.css')
+        assert asset.data == b'changed'
+        assert asset.content_length == 7
+        assert app.get_static_asset('/style.css') is asset
+
     def test_check_auth_requires_auth(self):
         # we require at least some creds to authenticate
         app = DropAFileApplication()
@@ -160,6 +1276,91 @@ class TestApp(object):
         request = Request(env)
         assert app.check_auth(request) is True
 
+    def test_check_auth_password_hash(self):
+        # we can check passwords against a hash
+        app = DropAFileApplication(password_hash=hash_password('sosecret'))
+        assert app.password is None
+        env = create_environ()
+        env.update(HTTP_AUTHORIZATION=encode_creds(password='sosecret'))
+        assert app.check_auth(Request(env)) is True
+        env.update(HTTP_AUTHORIZATION=encode_creds(password='wrong'))
+        assert app.check_auth(Request(env)) is False
+
+    def test_check_auth_password_hash_invalid(self):
+        # we cannot set passwords and hashes, hashes must be valid
+        with pytest.raises(ValueError):
+            DropAFileApplication(
+                password='sosecret', password_hash=hash_password('sosecret'))
+        with pytest.raises(ValueError):
+            DropAFileApplication(password_hash='sosecret')
+
+    def test_check_auth_cached(self, monkeypatch):
+        # verified credentials are checked only once
+        app = DropAFileApplication(password_hash=hash_password('sosecret'))
+        calls = []
+
+        def verify(password, password_hash):
+            calls.append(password)
+            return password == 'sosecret'
+
+        monkeypatch.setattr('dropafile.verify_password', verify)
+        env = create_environ()
+        env.update(HTTP_AUTHORIZATION=encode_creds(password='sosecret'))
+        for num in range(3):
+            assert app.check_auth(Request(env)) is True
+        env.update(HTTP_AUTHORIZATION=encode_creds(password='wrong'))
+        for num in range(2):
+            assert app.check_auth(Request(env)) is False
+        assert calls == ['sosecret', 'wrong', 'wrong']
+
+    def test_check_session_disabled(self):
+        # by default, sessions are not accepted
+        app = DropAFileApplication()
+        expires = '%d' % (time.time() + 60)
+        env = create_environ(headers={'Cookie': '%s=%s.%s' % (
+            SESSION_COOKIE, expires, app.sign_session(expires))})
+        assert app.check_session(Request(env)) is False
+
+    def test_check_session(self):
+        # we accept valid session cookies only
+        app = DropAFileApplication(session_lifetime=60)
+        expires = '%d' % (time.time() + 60)
+        signature = app.sign_session(expires)
+        other_app = DropAFileApplication(session_lifetime=60)
+        for cookie, valid in [
+                ('%s.%s' % (expires, signature), True),
+                ('%s.%s' % (expires, '0' * 64), False),
+                ('%d.%s' % (int(expires) + 1, signature), False),
+                ('%s.%s' % (expires, other_app.sign_session(expires)), False),
+                ('%s.%s' % (expires, signature[:-1]), False),
+                ('garbage', False),
+                ]:
+            env = create_environ(headers={
+                'Cookie': '%s=%s' % (SESSION_COOKIE, cookie)})
+            assert app.check_session(Request(env)) is valid
+
+    def test_check_session_expired(self):
+        # expired sessions are not accepted
+        app = DropAFileApplication(session_lifetime=60)
+        expires = '%d' % (time.time() - 1)
+        env = create_environ(headers={'Cookie': '%s=%s.%s' % (
+            SESSION_COOKIE, expires, app.sign_session(expires))})
+        assert app.check_session(Request(env)) is False
+
+    def test_start_session(self):
+        # we can set session cookies
+        app = DropAFileApplication(session_lifetime=60)
+        response = BaseResponse()
+        app.start_session(response)
+        cookie = response.headers['Set-Cookie']
+        assert cookie.startswith(SESSION_COOKIE + '=')
+        for flag in ('Secure', 'HttpOnly', 'Max-Age=60', 'SameSite=Strict'):
+            assert flag in cookie
+        value = cookie.split(';')[0].split('=', 1)[1]
+        env = create_environ(headers={
+            'Cookie': '%s=%s' % (SESSION_COOKIE, value)})
+        assert app.check_session(Request(env)) is True
+
     def test_handle_uploaded_files(self):
         # we can send files (that are stored)
         app = DropAFileApplication()
@@ -173,6 +1374,221 @@ class TestApp(object):
         assert os.path.isfile(expected_path)
         assert open(expected_path, 'r').read() == 'foo'
 
+    def test_handle_uploaded_files_streamed(self):
+        # files streamed into the upload dir are moved in place
+        app = DropAFileApplication()
+        builder = EnvironBuilder(
+            method='POST',
+            data={'file': (BytesIO(b'foo'), 'test.txt'),
+                  'not_file': (BytesIO(b'bar'), 'test2.txt')}
+            )
+        req = UploadRequest(builder.get_environ())
+        req.upload_dir = app.upload_dir
+        app.handle_uploaded_files(req)
+        assert os.listdir(app.upload_dir) == ['test.txt']
+        expected_path = os.path.join(app.upload_dir, 'test.txt')
+        assert open(expected_path, 'r').read() == 'foo'
+
+    def test_handle_uploaded_files_streamed_wrong_formfield_name(self):
+        # streamed files we do not accept are removed
+        app = DropAFileApplication()
+        builder = EnvironBuilder(
+            method='POST',
+            data={'not_file': (BytesIO(b'foo'), 'test.txt')}
+            )
+        req = UploadRequest(builder.get_environ())
+        req.upload_dir = app.upload_dir
+        app.handle_uploaded_files(req)
+        assert os.listdir(app.upload_dir) == []
+
+    def test_store_chunks(self):
+        # chunks are assembled to a complete file
+        app = DropAFileApplication()
+        for num in range(3):
+            builder = EnvironBuilder(
+                method='POST', data=chunk_data(b'0123456789', num))
+            req = UploadRequest(builder.get_environ())
+            req.upload_dir = app.upload_dir
+            app.handle_uploaded_files(req)
+        assert sorted(os.listdir(app.upload_dir)) == [
+            '.chunks-some-uuid.done', 'test.txt']
+        path = os.path.join(app.upload_dir, 'test.txt')
+        assert open(path, 'r').read() == '0123456789'
+
+    def test_store_chunks_preallocated(self, monkeypatch):
+        # space for the complete file can be allocated with 1st chunk
+        monkeypatch.setattr('dropafile.PREALLOCATE_MIN_SIZE', 0)
+        app = DropAFileApplication(preallocate=True, write_buffer_size=4)
+        partial_path = os.path.join(app.upload_dir, '.chunks-some-uuid')
+        for num in (1, 0, 2):
+            builder = EnvironBuilder(
+                method='POST', data=chunk_data(b'0123456789', num))
+            app.handle_uploaded_files(Request(builder.get_environ()))
+            if num == 1:
+                assert os.path.getsize(partial_path) == 10
+        path = os.path.join(app.upload_dir, 'test.txt')
+        assert open(path, 'r').read() == '0123456789'
+
+    def test_store_chunks_any_order(self):
+        # chunks may come in any order and can be re-sent
+        app = DropAFileApplication()
+        for num in (2, 0, 0):
+            builder = EnvironBuilder(
+                method='POST', data=chunk_data(b'0123456789', num))
+            app.handle_uploaded_files(Request(builder.get_environ()))
+        assert 'test.txt' not in os.listdir(app.upload_dir)
+        builder = EnvironBuilder(
+            method='POST', data=chunk_data(b'0123456789', 1))
+        req = Request(builder.get_environ())
+        path = app.store_chunk(req.form, req.files['file']).path
+        assert path == os.path.join(app.upload_dir, 'test.txt')
+        assert sorted(os.listdir(app.upload_dir)) == [
+            '.chunks-some-uuid.done', 'test.txt']
+        assert open(path, 'r').read() == '0123456789'
+
+    def test_store_chunks_output(self, capsys, log_listener):
+        # chunked files are listed on commandline when complete
+        app = DropAFileApplication()
+        builder = EnvironBuilder(
+            method='POST', data=chunk_data(b'0123456789', 0))
+        app.handle_uploaded_files(Request(builder.get_environ()))
+        flush_log(log_listener)
+        out, err = capsys.readouterr()
+        assert 'RECEIVED' not in out
+        for num in (1, 2):
+            builder = EnvironBuilder(
+                method='POST', data=chunk_data(b'0123456789', num))
+            app.handle_uploaded_files(Request(builder.get_environ()))
+        flush_log(log_listener)
+        out, err = capsys.readouterr()
+        assert 'RECEIVED:' in out
+
+    def test_store_chunks_invalid(self):
+        # invalid chunk data is rejected
+        app = DropAFileApplication()
+        data = chunk_data(b'0123456789', 0, upload_id='../../foo')
+        builder = EnvironBuilder(method='POST', data=data)
+        with pytest.raises(BadRequest):
+            app.handle_uploaded_files(Request(builder.get_environ()))
+        data = chunk_data(b'0123456789', 0)
+        data['dzchunkindex'] = '3'
+        builder = EnvironBuilder(method='POST', data=data)
+        with pytest.raises(BadRequest):
+            app.handle_uploaded_files(Request(builder.get_environ()))
+        assert os.listdir(app.upload_dir) == []
+
+    def test_store_chunks_too_large(self):
+        # chunked files larger than `max_file_size` are rejected
+        app = DropAFileApplication(max_file_size=8)
+        data = chunk_data(b'0123456789', 0)
+        builder = EnvironBuilder(method='POST', data=data)
+        with pytest.raises(RequestEntityTooLarge):
+            app.handle_uploaded_files(Request(builder.get_environ()))
+        # clients might lie about the total size
+        for num in range(3):
+            data = chunk_data(b'0123456789', num)
+            data['dztotalfilesize'] = '8'
+            builder = EnvironBuilder(method='POST', data=data)
+            if num < 2:
+                app.handle_uploaded_files(Request(builder.get_environ()))
+                continue
+            with pytest.raises(RequestEntityTooLarge):
+                app.handle_uploaded_files(Request(builder.get_environ()))
+        assert os.listdir(app.upload_dir) == []
+
+    def test_store_chunks_invalid_counts(self):
+        # chunk numbers and sizes must fit together
+        app = DropAFileApplication()
+        for key, value in (('dzchunkindex', '-1'),
+                           ('dztotalchunkcount', '1000000'),
+                           ('dztotalchunkcount', '11'),
+                           ('dzchunkbyteoffset', '10'),
+                           ('dztotalfilesize', '-1')):
+            data = chunk_data(b'0123456789', 0)
+            data[key] = value
+            if key == 'dztotalchunkcount':
+                data['dzchunkindex'] = str(int(value) - 1)
+            builder = EnvironBuilder(method='POST', data=data)
+            with pytest.raises(BadRequest):
+                app.handle_uploaded_files(Request(builder.get_environ()))
+        assert os.listdir(app.upload_dir) == []
+
+    def test_store_chunks_size_mismatch(self):
+        # complete files must have the size announced, else they can
+        # be sent again
+        app = DropAFileApplication()
+        for num in range(3):
+            data = chunk_data(b'0123456789', num)
+            data['dztotalfilesize'] = '11'
+            builder = EnvironBuilder(method='POST', data=data)
+            if num < 2:
+                app.handle_uploaded_files(Request(builder.get_environ()))
+                continue
+            with pytest.raises(BadRequest):
+                app.handle_uploaded_files(Request(builder.get_environ()))
+        assert os.listdir(app.upload_dir) == []
+        for num in range(3):
+            builder = EnvironBuilder(
+                method='POST', data=chunk_data(b'0123456789', num))
+            app.handle_uploaded_files(Request(builder.get_environ()))
+        with open(os.path.join(app.upload_dir, 'test.txt'), 'rb') as fd:
+            assert fd.read() == b'0123456789'
+
+    def test_store_chunks_resent_after_completion(self):
+        # chunks re-sent after the upload completed are ignored
+        app = DropAFileApplication()
+        for num in (0, 1, 2, 1):
+            builder = EnvironBuilder(
+                method='POST', data=chunk_data(b'0123456789', num))
+            app.handle_uploaded_files(Request(builder.get_environ()))
+        assert sorted(os.listdir(app.upload_dir)) == [
+            '.chunks-some-uuid.done', 'test.txt']
+
+    def test_store_chunks_streamed(self):
+        # in stream mode chunks are written right into the partial file
+        app = DropAFileApplication(upload_mode='stream')
+        partial_path = os.path.join(app.upload_dir, '.chunks-some-uuid')
+        builder = EnvironBuilder(
+            method='POST', data=chunk_data(b'0123456789', 1))
+        req = UploadRequest(builder.get_environ())
+        req.storage = app.storage
+        req.open_chunk = app.open_chunk
+        assert isinstance(req.files['file'].stream, ChunkStream)
+        assert req.upload_streams == []
+        assert app.handle_uploaded_files(req) == []
+        with open(partial_path, 'rb') as fd:
+            assert fd.read() == b'\x00' * 4 + b'4567'
+
+    def test_store_chunks_remove_stale(self):
+        # leftovers of unfinished chunked uploads are removed
+        app = DropAFileApplication()
+        stale_path = os.path.join(app.upload_dir, '.chunks-old-uuid')
+        for path in (stale_path, stale_path + '.idx'):
+            open(path, 'wb').close()
+            os.utime(path, (0, 0))
+        open(os.path.join(app.upload_dir, '.chunks-new-uuid'), 'wb').close()
+        builder = EnvironBuilder(
+            method='POST', data=chunk_data(b'0123456789', 0))
+        app.handle_uploaded_files(Request(builder.get_environ()))
+        assert sorted(os.listdir(app.upload_dir)) == [
+            '.chunks-new-uuid', '.chunks-some-uuid', '.chunks-some-uuid.idx']
+
+    def test_check_request_size(self):
+        # we can check the size of requests w/o reading them
+        app = DropAFileApplication(max_request_size=100)
+        environ = create_environ(method='POST')
+        environ.update({
+            'CONTENT_LENGTH': '101', 'wsgi.input': UnreadableStream()})
+        with pytest.raises(RequestEntityTooLarge):
+            app.check_request_size(Request(environ))
+        environ['CONTENT_LENGTH'] = '100'
+        assert app.check_request_size(Request(environ)) is None
+
+    def test_invalid_upload_mode(self):
+        # we complain about unknown upload modes
+        with pytest.raises(ValueError):
+            DropAFileApplication(upload_mode='invalid')
+
     def test_handle_uploaded_files_wrong_formfield_name(self):
         # only files with form-name 'file' are considered
         app = DropAFileApplication()
@@ -185,7 +1601,7 @@ class TestApp(object):
         assert os.listdir(app.upload_dir) == []
 
     def test_handle_uploaded_files_multiple_at_once(self):
-        # we only take one file, even if multiple are offered
+        # we only take files from fields named `file`
         app = DropAFileApplication()
         builder = EnvironBuilder(
             method='POST',
@@ -196,7 +1612,277 @@ class TestApp(object):
         app.handle_uploaded_files(req)
         assert os.listdir(app.upload_dir) == ['test.txt']
 
-    def test_handle_uploaded_files_output(self, capsys):
+    def test_handle_uploaded_files_multiple_fields(self):
+        # we take all files from fields `file`, `file[]` and `file[NUM]`
+        app = DropAFileApplication()
+        builder = EnvironBuilder(
+            method='POST',
+            data=MultiDict([
+                ('file', (BytesIO(b'foo'), 'test.txt')),
+                ('file', (BytesIO(b'bar'), 'test.txt')),
+                ('file[]', (BytesIO(b'baz'), 'baz.txt')),
+                ('file[0]', (BytesIO(b'zero'), 'zero.txt')),
+                ('file[1]', (BytesIO(b'one'), 'one.txt')),
+                ('file[x]', (BytesIO(b'x'), 'x.txt')),
+                ('files', (BytesIO(b'y'), 'y.txt'))])
+            )
+        req = UploadRequest(builder.get_environ())
+        req.upload_dir = app.upload_dir
+        app.handle_uploaded_files(req)
+        assert sorted(os.listdir(app.upload_dir)) == [
+            'baz.txt', 'one.txt', 'test.txt', 'test.txt-1', 'zero.txt']
+        contents = dict()
+        for name in os.listdir(app.upload_dir):
+            with open(os.path.join(app.upload_dir, name), 'rb') as fd:
+                contents[name] = fd.read()
+        assert contents == {
+            'baz.txt': b'baz', 'one.txt': b'one', 'test.txt': b'foo',
+            'test.txt-1': b'bar', 'zero.txt': b'zero'}
+
+    def test_store_uploaded_files_digest(self):
+        # digests of stored files are returned
+        app = DropAFileApplication()
+        req = Request(EnvironBuilder(method='POST', data={
+            'file': (BytesIO(b'foo'), 'test.txt')}).get_environ())
+        assert app.store_uploaded_files(req.form, req.files) == [
+            StoredFile(os.path.join(app.upload_dir, 'test.txt'), 3,
+                       hashlib.sha256(b'foo').hexdigest())]
+
+    def test_store_uploaded_files_no_digest(self):
+        # hashing can be disabled
+        app = DropAFileApplication(hash_name=None)
+        req = Request(EnvironBuilder(method='POST', data={
+            'file': (BytesIO(b'foo'), 'test.txt')}).get_environ())
+        assert app.store_uploaded_files(req.form, req.files)[0].digest is None
+
+    def test_invalid_digest_options(self):
+        # unknown hash algorithms and dedup modes are rejected
+        with pytest.raises(ValueError):
+            DropAFileApplication(hash_name='invalid')
+        with pytest.raises(ValueError):
+            DropAFileApplication(dedup='invalid')
+        with pytest.raises(ValueError):
+            DropAFileApplication(hash_name=None, dedup='link')
+
+    def test_manifest(self):
+        # digests can be appended to a manifest
+        manifest_path = os.path.join(tempfile.mkdtemp(), 'SHA256SUMS')
+        app = DropAFileApplication(manifest_path=manifest_path)
+        for content in (b'foo', b'bar'):
+            req = Request(EnvironBuilder(method='POST', data={
+                'file': (BytesIO(content), 'test.txt')}).get_environ())
+            app.store_uploaded_files(req.form, req.files)
+        with open(manifest_path) as fd:
+            assert fd.read() == '%s  %s\n%s  %s\n' % (
+                hashlib.sha256(b'foo').hexdigest(),
+                os.path.join(app.upload_dir, 'test.txt'),
+                hashlib.sha256(b'bar').hexdigest(),
+                os.path.join(app.upload_dir, 'test.txt-1'))
+
+    @pytest.mark.parametrize("dedup", ['link', 'skip'])
+    def test_dedup(self, dedup):
+        # identical files are linked or skipped
+        upload_dir = tempfile.mkdtemp()
+        with open(os.path.join(upload_dir, 'old.txt'), 'wb') as fd:
+            fd.write(b'foo')
+        app = DropAFileApplication(upload_dir=upload_dir, dedup=dedup)
+        stored_files = []
+        for content in (b'foo', b'bar', b'bar'):
+            req = Request(EnvironBuilder(method='POST', data={
+                'file': (BytesIO(content), 'new.txt')}).get_environ())
+            stored_files += app.store_uploaded_files(req.form, req.files)
+        paths = [stored_file.path for stored_file in stored_files]
+        if dedup == 'skip':
+            assert sorted(os.listdir(upload_dir)) == ['new.txt-1', 'old.txt']
+            assert paths == [
+                os.path.join(upload_dir, 'old.txt'),
+                os.path.join(upload_dir, 'new.txt-1'),
+                os.path.join(upload_dir, 'new.txt-1')]
+        else:
+            assert sorted(os.listdir(upload_dir)) == [
+                'new.txt', 'new.txt-1', 'new.txt-2', 'old.txt']
+            assert os.path.samefile(paths[0], os.path.join(
+                upload_dir, 'old.txt'))
+            assert os.path.samefile(paths[1], paths[2])
+
+    def test_dedup_chunked(self):
+        # files sent in chunks are deduplicated as well
+        upload_dir = tempfile.mkdtemp()
+        with open(os.path.join(upload_dir, 'old.txt'), 'wb') as fd:
+            fd.write(b'Some Content')
+        app = DropAFileApplication(upload_dir=upload_dir, dedup='skip')
+        for num in range(3):
+            req = Request(EnvironBuilder(
+                method='POST',
+                data=chunk_data(b'Some Content', num, chunk_size=5)
+                ).get_environ())
+            stored_files = app.store_uploaded_files(req.form, req.files)
+        assert stored_files == [StoredFile(
+            os.path.join(upload_dir, 'old.txt'), 12,
+            hashlib.sha256(b'Some Content').hexdigest())]
+        assert sorted(os.listdir(upload_dir)) == [
+            '.chunks-some-uuid.done', 'old.txt']
+
+    def test_store_uploaded_files_cas(self):
+        # files can be stored by content, also when sent in chunks
+        app = DropAFileApplication(storage='cas')
+        for num in range(3):
+            req = Request(EnvironBuilder(
+                method='POST',
+                data=chunk_data(b'Some Content', num, chunk_size=5)
+                ).get_environ())
+            stored_files = app.store_uploaded_files(req.form, req.files)
+        req = Request(EnvironBuilder(method='POST', data={
+            'file': (BytesIO(b'Some Content'), 'other.txt')}).get_environ())
+        assert app.store_uploaded_files(req.form, req.files) == stored_files
+        assert sorted(os.listdir(app.upload_dir)) == [
+            '.chunks-some-uuid.done', 'index.jsonl', 'objects']
+        assert stored_files[0].path.startswith(
+            os.path.join(app.upload_dir, 'objects'))
+        assert len(app.storage.lookup('test.txt')) == 1
+        assert len(app.storage.lookup('other.txt')) == 1
+        with pytest.raises(ValueError):
+            DropAFileApplication(storage='invalid')
+
+    def test_store_uploaded_files_many(self):
+        # many files in one request are stored in parallel
+        app = DropAFileApplication(finalize_workers=3)
+        data = MultiDict([
+            ('file', (BytesIO(b'%d' % num), 'scan.pdf'))
+            for num in range(50)])
+        req = Request(EnvironBuilder(method='POST', data=data).get_environ())
+        stored_files = app.store_uploaded_files(req.form, req.files)
+        assert len(stored_files) == 50
+        assert len(os.listdir(app.upload_dir)) == 50
+        for num, stored_file in enumerate(stored_files):
+            with open(stored_file.path, 'rb') as fd:
+                assert fd.read() == b'%d' % num
+
+    @pytest.mark.parametrize("upload_mode", ["stream", "spool"])
+    def test_store_uploaded_files_partly_failing(
+            self, upload_mode, capsys, log_listener):
+        # files stored are reported, places of failed ones released
+        app = DropAFileApplication(upload_mode=upload_mode)
+        store = app.storage.store
+
+        def failing_store(target, source, digest=None):
+            if target.endswith('bad.txt'):
+                raise IOError('disk on fire')
+            return store(target, source, digest)
+
+        app.storage.store = failing_store
+        client = Client(app, BaseResponse)
+        headers = get_basic_auth_headers(password=app.password)
+        resp = client.post('/index.html', headers=headers, data=MultiDict([
+            ('file', (BytesIO(b'good'), 'good.txt')),
+            ('file', (BytesIO(b'bad'), 'bad.txt'))]))
+        assert resp.status_code == 500
+        assert b'Stored 1 of 2 files.' in resp.data
+        assert resp.headers.getlist('X-Upload-Digest') == [
+            'sha256=%s' % hashlib.sha256(b'good').hexdigest()]
+        assert os.listdir(app.upload_dir) == ['good.txt']
+        flush_log(log_listener)
+        out, err = capsys.readouterr()
+        assert 'RECEIVED: %s' % os.path.join(
+            app.upload_dir, 'good.txt') in out
+        assert 'disk on fire' in out + err
+
+    def test_store_uploaded_files_all_failing(self):
+        # if no file could be stored, the error is raised
+        app = DropAFileApplication()
+
+        def failing_store(target, source, digest=None):
+            raise IOError('disk on fire')
+
+        app.storage.store = failing_store
+        req = Request(EnvironBuilder(method='POST', data={
+            'file': (BytesIO(b'foo'), 'foo.txt')}).get_environ())
+        with pytest.raises(IOError):
+            app.store_uploaded_files(req.form, req.files)
+        assert os.listdir(app.upload_dir) == []
+
+    def test_close(self):
+        # the threads storing files can be shut down
+        app = DropAFileApplication()
+        app.close()
+        with pytest.raises(RuntimeError):
+            app.executor.submit(len, [])
+
+    @pytest.mark.parametrize("upload_mode", ["stream", "spool"])
+    def test_store_uploaded_files_fsync(self, upload_mode):
+        # files of concurrent uploads can be synced in batches
+        app = DropAFileApplication(
+            finalize_workers=3, fsync='batch', upload_mode=upload_mode)
+        assert app.storage.syncer.mode == 'batch'
+        client = Client(app, BaseResponse)
+        headers = get_basic_auth_headers(password=app.password)
+        resp = client.post('/index.html', headers=headers, data=MultiDict([
+            ('file', (BytesIO(b'%d' % num), 'scan.pdf'))
+            for num in range(5)]))
+        assert resp.status_code == 200
+        assert len(os.listdir(app.upload_dir)) == 5
+        # one sync of the file and one of the directory per file
+        hist = app.metrics.histograms['dropafile_fsync_seconds']
+        assert hist.count == 10
+
+    @pytest.mark.parametrize("upload_mode", ["stream", "spool"])
+    def test_store_uploaded_files_preallocated(
+            self, upload_mode, monkeypatch):
+        # space is preallocated for the first upload, based on
+        # Content-Length
+        monkeypatch.setattr('dropafile.PREALLOCATE_MIN_SIZE', 0)
+        sizes = []
+
+        def fake_preallocate(fd, size):
+            sizes.append(size)
+            return preallocate(fd, size)
+
+        monkeypatch.setattr('dropafile.preallocate', fake_preallocate)
+        app = DropAFileApplication(
+            preallocate=True, write_buffer_size=1024, upload_mode=upload_mode)
+        client = Client(app, BaseResponse)
+        headers = get_basic_auth_headers(password=app.password)
+        resp = client.post('/index.html', headers=headers, data=MultiDict([
+            ('file', (BytesIO(b'foo' * 1000), 'foo.txt')),
+            ('file', (BytesIO(b'bar' * 10), 'bar.txt'))]))
+        assert resp.status_code == 200
+        for name, content in (('foo.txt', b'foo' * 1000),
+                              ('bar.txt', b'bar' * 10)):
+            with open(os.path.join(app.upload_dir, name), 'rb') as fd:
+                assert fd.read() == content
+        if upload_mode == 'spool':
+            assert sizes == []
+        else:
+            assert len(sizes) == 1
+            assert sizes[0] > 3030
+
+    def test_store_uploaded_files_preallocated_trimmed(self, monkeypatch):
+        # space preallocated for a file is given back when the next starts
+        monkeypatch.setattr('dropafile.PREALLOCATE_MIN_SIZE', 0)
+        blocks = []
+
+        def fake_trim(storage, writer):
+            trim(storage, writer)
+            blocks.append(os.fstat(writer.fileno()).st_blocks * 512)
+
+        trim = FlatStorage.trim
+        monkeypatch.setattr(FlatStorage, 'trim', fake_trim)
+        app = DropAFileApplication(preallocate=True)
+        client = Client(app, BaseResponse)
+        headers = get_basic_auth_headers(password=app.password)
+        resp = client.post('/index.html', headers=headers, data=MultiDict([
+            ('file', (BytesIO(b'foo' * 1000), 'foo.txt')),
+            ('file', (BytesIO(b'bar' * 100000), 'bar.txt'))]))
+        assert resp.status_code == 200
+        # trimmed when `bar.txt` started and when committed
+        assert len(blocks) == 3
+        assert blocks[0] < 3000 + 8192
+        for name, size in (('foo.txt', 3000), ('bar.txt', 300000)):
+            st = os.stat(os.path.join(app.upload_dir, name))
+            assert st.st_size == size
+            assert st.st_blocks * 512 < size + 8192
+
+    def test_handle_uploaded_files_output(self, capsys, log_listener):
         # sent files are listed on commandline
         app = DropAFileApplication()
         builder = EnvironBuilder(
@@ -205,15 +1891,17 @@ class TestApp(object):
             )
         req = Request(builder.get_environ())
         app.handle_uploaded_files(req)
+        flush_log(log_listener)
         out, err = capsys.readouterr()
         assert 'RECEIVED:' in out
         assert 'test.txt' in out
 
-    def test_handle_uploaded_files_no_files(self, capsys):
+    def test_handle_uploaded_files_no_files(self, capsys, log_listener):
         # we notice if no files was sent (and do nothing)
         app = DropAFileApplication()
         req = Request(create_environ())
         app.handle_uploaded_files(req)
+        flush_log(log_listener)
         out, err = capsys.readouterr()
         assert os.listdir(app.upload_dir) == []
         assert 'RECEIVED' not in out
@@ -257,6 +1945,12 @@ class TestArgParser(object):
         assert '--host' in out
         assert '--port' in out
         assert '--secret' in out
+        assert '--threads' in out
+        assert '--cert' in out
+        assert '--key' in out
+        assert '--cert-cache' in out
+        assert '--key-type' in out
+        assert '--processes' in out
 
     def test_defaults(self):
         # we can get options with defaults set
@@ -265,6 +1959,32 @@ class TestArgParser(object):
         assert result.host == 'localhost'
         assert result.port == 8443
         assert result.secret is None
+        assert result.threads == 1
+        assert result.processes == 1
+        assert result.cert is None
+        assert result.key is None
+        assert result.cert_cache is None
+        assert result.key_type == 'rsa'
+        assert result.max_file_size is None
+        assert result.max_request_size is None
+        assert result.log_file is None
+        assert result.secret_file is None
+        assert result.hash_secret is False
+        assert result.session_lifetime is None
+        assert result.log_format == 'text'
+        assert result.digest == 'sha256'
+        assert result.manifest is None
+        assert result.dedup is None
+        assert result.storage == 'flat'
+        assert result.object_store is None
+        assert result.tls_tickets == 2
+        assert result.cert_pool is None
+        assert result.cert_pool_size == 2
+        assert result.health_port is None
+        assert result.fsync == 'none'
+        assert result.fsync_interval == 10
+        assert result.write_buffer == 64 * 1024
+        assert result.preallocate is False
 
     def test_host(self):
         result = handle_options(['--host', 'foo'])
@@ -278,9 +1998,138 @@ class TestArgParser(object):
         result = handle_options(['--secret', 'sosecret'])
         assert result.secret == 'sosecret'
 
+    def test_threads(self):
+        result = handle_options(['--threads', '20'])
+        assert result.threads == 20
+
+    def test_processes(self):
+        result = handle_options(['--processes', '4'])
+        assert result.processes == 4
+
+    def test_cert_and_key(self):
+        result = handle_options(['--cert', 'my.pem', '--key', 'my.key'])
+        assert result.cert == 'my.pem'
+        assert result.key == 'my.key'
+
+    def test_cert_without_key(self, capsys):
+        # --cert and --key are required together
+        with pytest.raises(SystemExit):
+            handle_options(['--cert', 'my.pem'])
+        with pytest.raises(SystemExit):
+            handle_options(['--key', 'my.key'])
+
+    def test_cert_cache(self):
+        result = handle_options(['--cert-cache', '/tmp/certs'])
+        assert result.cert_cache == '/tmp/certs'
+
+    def test_cert_pool(self, capsys):
+        result = handle_options(
+            ['--cert-pool', '/tmp/pool', '--cert-pool-size', '3'])
+        assert result.cert_pool == '/tmp/pool'
+        assert result.cert_pool_size == 3
+        with pytest.raises(SystemExit):
+            handle_options(['--cert-pool', 'x', '--cert-cache', 'y'])
+        with pytest.raises(SystemExit):
+            handle_options(
+                ['--cert-pool', 'x', '--cert', 'c.pem', '--key', 'c.key'])
+
+    def test_fsync(self, capsys):
+        result = handle_options(['--fsync', 'batch', '--fsync-interval', '5'])
+        assert result.fsync == 'batch'
+        assert result.fsync_interval == 5
+        with pytest.raises(SystemExit):
+            handle_options(['--fsync', 'always'])
+
+    def test_write_buffer_and_preallocate(self):
+        result = handle_options(['--write-buffer', '1M', '--preallocate'])
+        assert result.write_buffer == 1024 * 1024
+        assert result.preallocate is True
+
+    def test_health_port(self):
+        result = handle_options(['--health-port', '8080'])
+        assert result.health_port == 8080
+
+    def test_key_type(self, capsys):
+        result = handle_options(['--key-type', 'ec'])
+        assert result.key_type == 'ec'
+        with pytest.raises(SystemExit):
+            handle_options(['--key-type', 'dsa'])
+
+    def test_tls_tickets(self):
+        result = handle_options(['--tls-tickets', '4'])
+        assert result.tls_tickets == 4
+
+    def test_max_sizes(self, capsys):
+        result = handle_options(
+            ['--max-file-size', '500M', '--max-request-size', '1G'])
+        assert result.max_file_size == 500 * 1024 * 1024
+        assert result.max_request_size == 1024 * 1024 * 1024
+        with pytest.raises(SystemExit):
+            handle_options(['--max-file-size', 'much'])
+
+    def test_secret_file(self, capsys):
+        result = handle_options(['--secret-file', 'my.secret'])
+        assert result.secret_file == 'my.secret'
+        with pytest.raises(SystemExit):
+            handle_options(['--secret-file', 'my.secret', '-s', 'foo'])
+
+    def test_session_lifetime(self):
+        result = handle_options(['--session-lifetime', '3600'])
+        assert result.session_lifetime == 3600
+
+    def test_digest_options(self, capsys):
+        result = handle_options(
+            ['--digest', 'md5', '--manifest', 'SUMS', '--dedup', 'link'])
+        assert result.digest == 'md5'
+        assert result.manifest == 'SUMS'
+        assert result.dedup == 'link'
+        with pytest.raises(SystemExit):
+            handle_options(['--dedup', 'invalid'])
+
+    def test_storage(self, capsys):
+        result = handle_options(['--storage', 'cas'])
+        assert result.storage == 'cas'
+        with pytest.raises(SystemExit):
+            handle_options(['--storage', 'invalid'])
+
+    def test_object_store(self, capsys):
+        result = handle_options(['--object-store', 'http://localhost/b'])
+        assert result.object_store == 'http://localhost/b'
+        with pytest.raises(SystemExit):
+            handle_options(
+                ['--object-store', 'http://localhost/b', '--storage', 'cas'])
+
+    def test_log_options(self, capsys):
+        result = handle_options(
+            ['--log-file', 'my.log', '--log-format', 'json'])
+        assert result.log_file == 'my.log'
+        assert result.log_format == 'json'
+        with pytest.raises(SystemExit):
+            handle_options(['--log-format', 'xml'])
+
+    def test_threads_and_processes(self, capsys):
+        # we cannot have threads and processes at the same time
+        with pytest.raises(SystemExit):
+            handle_options(['--threads', '2', '--processes', '2'])
+
+    def test_dedup_and_processes(self, capsys):
+        # processes forked per request cannot share a digest index
+        with pytest.raises(SystemExit):
+            handle_options(['--dedup', 'link', '--processes', '2'])
+        out, err = capsys.readouterr()
+        assert '--dedup excludes --processes' in err
+        assert handle_options(
+            ['--dedup', 'link', '--threads', '2']).dedup == 'link'
+
 
 class Test_run_server(object):
 
+    def test_hash_secret(self, capsys):
+        # we can get a password hash
+        run_server(['dropafile', '--hash-secret', '-s', 'sosecret'])
+        out, err = capsys.readouterr()
+        assert verify_password('sosecret', out.strip()) is True
+
     def test_no_options(self, proc_runner):
         # we can start a server (no options given)
         proc_runner.argv = ['dropafile', ]
@@ -309,6 +2158,18 @@ class Test_run_server(object):
             )
         assert "https://0.0.0.0:12345/" in err
 
+    def test_processes_no_metrics(self, monkeypatch, capsys):
+        # metrics are not served by processes forked per request
+        served = []
+        monkeypatch.setattr(
+            'werkzeug.serving.run_simple', lambda *args, **kw: served.append(
+                (args[2], kw['processes'])))
+        serve(handle_options(['--processes', '2', '--key-type', 'ec']))
+        serve(handle_options(['--key-type', 'ec']))
+        assert served[0][0].metrics_path is None
+        assert served[0][1] == 2
+        assert served[1][0].metrics_path == '/metrics'
+
 
 class TestFunctional(object):
     # Functional browser tests
@@ -335,6 +2196,94 @@ class TestFunctional(object):
         mimetype = resp.headers.get('Content-Type')
         assert mimetype == 'text/javascript; charset=utf-8'
 
+    def test_get_js_from_disk(self):
+        # large files are sent via the file wrapper of the server
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(password=application.password)
+        wrapped = []
+
+        def file_wrapper(file_descr, buffer_size):
+            wrapped.append(file_descr.name)
+            return FileWrapper(file_descr, buffer_size)
+
+        resp = client.get('dropzone.js', headers=headers, environ_overrides={
+            'wsgi.file_wrapper': file_wrapper})
+        asset = application.static_assets['/dropzone.js']
+        assert wrapped == [asset.path]
+        assert resp.data == asset.data
+        assert resp.headers['Content-Length'] == str(len(asset.data))
+        assert resp.headers['Accept-Ranges'] == 'bytes'
+        # small files, ranges and HEAD requests are served from memory
+        for method, path in (('GET', '/'), ('HEAD', '/dropzone.js')):
+            client.open(path, method=method, headers=headers,
+                        environ_overrides={'wsgi.file_wrapper': file_wrapper})
+        headers.add('Range', 'bytes=100-199')
+        resp = client.get('dropzone.js', headers=headers, environ_overrides={
+            'wsgi.file_wrapper': file_wrapper})
+        assert resp.data == asset.data[100:200]
+        assert len(wrapped) == 1
+
+    def test_get_js_without_file_wrapper(self, monkeypatch):
+        # servers without file wrapper get large files from memory
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(password=application.password)
+        opened = []
+        monkeypatch.setattr(application, 'open_asset', opened.append)
+        resp = client.get('dropzone.js', headers=headers)
+        assert resp.data == application.static_assets['/dropzone.js'].data
+        assert opened == []
+
+    def test_get_js_modified_on_disk(self):
+        # files modified since startup are not sent from disk
+        application = DropAFileApplication()
+        asset = application.static_assets['/dropzone.js']
+        file_descr = application.open_asset(asset)
+        assert file_descr.read() == asset.data
+        file_descr.close()
+        assert application.open_asset(asset._replace(mtime=0)) is None
+        assert application.open_asset(asset._replace(path='/invalid')) is None
+
+    @pytest.mark.parametrize("encoding", [None, 'gzip'])
+    def test_get_js_range(self, encoding):
+        # ranges of static files can be requested
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(password=application.password)
+        headers.add('Range', 'bytes=100-199')
+        asset = application.static_assets['/dropzone.js']
+        data = asset.data
+        if encoding is not None:
+            headers.add('Accept-Encoding', encoding)
+            data = asset.encodings[encoding]
+        resp = client.get('dropzone.js', headers=headers)
+        assert resp.status_code == 206
+        assert resp.data == data[100:200]
+        assert resp.headers['Content-Range'] == 'bytes 100-199/%d' % (
+            len(data))
+        assert resp.headers['Content-Length'] == '100'
+
+    def test_get_js_range_invalid(self):
+        # unsatisfiable ranges are rejected
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(password=application.password)
+        headers.add('Range', 'bytes=100000000-')
+        resp = client.get('dropzone.js', headers=headers)
+        assert resp.status_code == 416
+
+    def test_get_js_if_range(self):
+        # ranges are sent only if the file did not change
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(password=application.password)
+        headers.add('Range', 'bytes=0-9')
+        headers.add('If-Range', '"outdated"')
+        resp = client.get('dropzone.js', headers=headers)
+        assert resp.status_code == 200
+        assert resp.data == application.static_assets['/dropzone.js'].data
+
     def test_get_css(self):
         # we can get the dropzonejs CSS
         application = DropAFileApplication()
@@ -346,6 +2295,131 @@ class TestFunctional(object):
         mimetype = resp.headers.get('Content-Type')
         assert mimetype == 'text/css; charset=utf-8'
 
+    def test_get_js_content_length(self):
+        # the content length of static files is set
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        resp = client.get('dropzone.js', headers=headers)
+        expected = os.path.getsize(os.path.join(STATIC_DIR, 'dropzone.js'))
+        assert resp.headers.get('Content-Length') == str(expected)
+        assert len(resp.data) == expected
+
+    def test_get_js_cache_headers(self):
+        # static files come with validators and caching hints
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        resp = client.get('dropzone.js', headers=headers)
+        asset = application.static_assets['/dropzone.js']
+        assert resp.headers.get('ETag') == '"%s"' % asset.etag
+        assert resp.headers.get('Last-Modified') is not None
+        assert resp.headers.get('Cache-Control') == 'private, max-age=3600'
+
+    def test_get_js_max_age(self):
+        # the max-age of static files can be set
+        application = DropAFileApplication(max_age=60)
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        resp = client.get('dropzone.js', headers=headers)
+        assert resp.headers.get('Cache-Control') == 'private, max-age=60'
+
+    def test_get_js_if_none_match(self):
+        # a matching ETag gives a 304 w/o body
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        etag = client.get('dropzone.js', headers=headers).headers['ETag']
+        headers.add('If-None-Match', etag)
+        resp = client.get('dropzone.js', headers=headers)
+        assert resp.status == '304 NOT MODIFIED'
+        assert resp.data == b''
+        assert resp.headers.get('ETag') == etag
+
+    def test_get_js_if_none_match_outdated(self):
+        # a non-matching ETag gives the full file
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        headers.add('If-None-Match', '"outdated"')
+        resp = client.get('dropzone.js', headers=headers)
+        assert resp.status == '200 OK'
+        assert len(resp.data) > 0
+
+    def test_get_js_if_modified_since(self):
+        # unmodified files are not sent again
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        modified = client.get(
+            'dropzone.js', headers=headers).headers['Last-Modified']
+        headers.add('If-Modified-Since', modified)
+        resp = client.get('dropzone.js', headers=headers)
+        assert resp.status == '304 NOT MODIFIED'
+        headers.set('If-Modified-Since', 'Thu, 01 Jan 1970 00:00:00 GMT')
+        resp = client.get('dropzone.js', headers=headers)
+        assert resp.status == '200 OK'
+
+    def test_get_js_gzipped(self):
+        # clients accepting gzip get a compressed variant
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        headers.add('Accept-Encoding', 'gzip, deflate')
+        resp = client.get('dropzone.js', headers=headers)
+        asset = application.static_assets['/dropzone.js']
+        assert resp.headers.get('Content-Encoding') == 'gzip'
+        assert resp.headers.get('Vary') == 'Accept-Encoding'
+        assert resp.headers.get('ETag') == '"%s-gzip"' % asset.etag
+        assert resp.headers.get('Content-Length') == str(
+            len(asset.encodings['gzip']))
+        assert zlib.decompress(
+            resp.data, 16 + zlib.MAX_WBITS) == asset.data
+
+    def test_get_js_uncompressed(self):
+        # clients not accepting compressed content get plain files
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        headers.add('Accept-Encoding', 'gzip;q=0')
+        resp = client.get('dropzone.js', headers=headers)
+        assert resp.headers.get('Content-Encoding') is None
+        assert resp.headers.get('Vary') == 'Accept-Encoding'
+        assert resp.data == application.static_assets['/dropzone.js'].data
+
+    def test_get_js_gzipped_if_none_match(self):
+        # conditional requests consider the encoding
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        headers.add('Accept-Encoding', 'gzip')
+        etag = client.get('dropzone.js', headers=headers).headers['ETag']
+        headers.add('If-None-Match', etag)
+        resp = client.get('dropzone.js', headers=headers)
+        assert resp.status == '304 NOT MODIFIED'
+        headers.set('Accept-Encoding', 'identity')
+        resp = client.get('dropzone.js', headers=headers)
+        assert resp.status == '200 OK'
+
+    def test_post_ignores_conditions(self):
+        # POST requests are never answered with 304
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        headers.add('If-None-Match', '*')
+        resp = client.post('/index.html', headers=headers)
+        assert resp.status == '200 OK'
+
     def test_send_file(self):
         # we can send files
         application = DropAFileApplication()
@@ -362,6 +2436,161 @@ class TestFunctional(object):
         assert resp.status == '200 OK'
         uploaded_path = os.path.join(application.upload_dir, 'sample.txt')
         assert os.path.isfile(uploaded_path)
+        assert os.listdir(application.upload_dir) == ['sample.txt']
+        assert resp.headers.getlist('X-Upload-Digest') == [
+            'sha256=%s' % hashlib.sha256(b'Some Content').hexdigest()]
+
+    def test_send_files_digests(self):
+        # digests of all files sent are returned in order
+        application = DropAFileApplication(hash_name='md5')
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        resp = client.post(
+            '/index.html', headers=headers, data=MultiDict([
+                ('file[0]', (BytesIO(b'foo'), 'foo.txt')),
+                ('file[1]', (BytesIO(b'bar'), 'bar.txt'))]))
+        assert resp.headers.getlist('X-Upload-Digest') == [
+            'md5=%s' % hashlib.md5(b'foo').hexdigest(),
+            'md5=%s' % hashlib.md5(b'bar').hexdigest()]
+
+    def test_send_file_spooled(self):
+        # we can send files in 'spool' mode
+        application = DropAFileApplication(upload_mode='spool')
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        resp = client.post(
+            '/index.html',
+            headers=headers,
+            data={
+                'file': (BytesIO(b'Some Content'), 'sample.txt'),
+                },
+            )
+        assert resp.status == '200 OK'
+        uploaded_path = os.path.join(application.upload_dir, 'sample.txt')
+        with open(uploaded_path, 'rb') as fd:
+            assert fd.read() == b'Some Content'
+
+    def test_send_file_chunked(self):
+        # we can send files in chunks
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        for num in range(3):
+            resp = client.post(
+                '/index.html', headers=headers,
+                data=chunk_data(b'Some Content', num, chunk_size=5))
+            assert resp.status == '200 OK'
+        assert sorted(os.listdir(application.upload_dir)) == [
+            '.chunks-some-uuid.done', 'test.txt']
+        uploaded_path = os.path.join(application.upload_dir, 'test.txt')
+        with open(uploaded_path, 'rb') as fd:
+            assert fd.read() == b'Some Content'
+
+    def test_send_file_chunked_invalid(self):
+        # invalid chunks result in 400 Bad Request
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        data = chunk_data(b'Some Content', 0)
+        del data['dztotalchunkcount']
+        resp = client.post('/index.html', headers=headers, data=data)
+        assert resp.status == '400 BAD REQUEST'
+        assert os.listdir(application.upload_dir) == []
+
+    def test_send_file_too_large(self):
+        # too large files result in 413, nothing is stored
+        application = DropAFileApplication(max_file_size=100)
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        resp = client.post('/index.html', headers=headers, data={
+            'file': (BytesIO(b'Some Content' * 10), 'sample.txt'),
+            'other': (BytesIO(b'Other Content' * 10), 'other.txt')})
+        assert resp.status == '413 REQUEST ENTITY TOO LARGE'
+        assert os.listdir(application.upload_dir) == []
+
+    def test_send_file_chunked_too_large(self):
+        # chunked files are limited as a whole
+        application = DropAFileApplication(max_file_size=10)
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        resp = client.post(
+            '/index.html', headers=headers,
+            data=chunk_data(b'Some Content', 0, chunk_size=5))
+        assert resp.status == '413 REQUEST ENTITY TOO LARGE'
+        assert os.listdir(application.upload_dir) == []
+
+    def test_send_request_too_large(self):
+        # too large requests are rejected before the body is read
+        application = DropAFileApplication(max_request_size=1000)
+        environ = EnvironBuilder(
+            method='POST', path='/index.html',
+            headers=get_basic_auth_headers(
+                username='somename', password=application.password),
+            data={'file': (BytesIO(b'Some Content' * 100), 'sample.txt')}
+            ).get_environ()
+        environ['wsgi.input'] = UnreadableStream()
+        status, body = call_wsgi_app(application, environ)
+        assert status == '413 REQUEST ENTITY TOO LARGE'
+        assert os.listdir(application.upload_dir) == []
+
+    def test_send_file_unauthorized(self):
+        # unauthorized uploads get 401 before the body is read
+        application = DropAFileApplication()
+        environ = EnvironBuilder(
+            method='POST', path='/index.html',
+            data={'file': (BytesIO(b'Some Content'), 'sample.txt')}
+            ).get_environ()
+        environ['wsgi.input'] = UnreadableStream()
+        status, body = call_wsgi_app(application, environ)
+        assert status == '401 UNAUTHORIZED'
+        assert os.listdir(application.upload_dir) == []
+
+    def test_metrics(self):
+        # authorized users can get metrics
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        resp = client.post('/index.html', headers=headers, data={
+            'file': (BytesIO(b'Some Content'), 'sample.txt')})
+        resp = client.get('/metrics', headers=headers)
+        assert resp.status == '200 OK'
+        assert resp.headers['Content-Type'].startswith('text/plain')
+        body = resp.get_data(as_text=True)
+        assert 'dropafile_auth_seconds_count 2\n' in body
+        assert 'dropafile_upload_bytes_count 1\n' in body
+        assert 'dropafile_upload_write_seconds_count 1\n' in body
+
+    def test_send_file_logged(self, capsys, log_listener):
+        # received and rejected uploads are logged
+        application = DropAFileApplication(max_file_size=100)
+        client = Client(application, BaseResponse)
+        headers = get_basic_auth_headers(
+            username='somename', password=application.password)
+        client.post('/index.html', headers=headers, data={
+            'file': (BytesIO(b'Some Content'), 'sample.txt')})
+        client.post('/index.html', headers=headers, data={
+            'file': (BytesIO(b'Some Content' * 10), 'sample.txt'),
+            'other': (BytesIO(b'Other Content' * 10), 'other.txt')})
+        flush_log(log_listener)
+        out, err = capsys.readouterr()
+        path = os.path.join(application.upload_dir, 'sample.txt')
+        assert out == (
+            'RECEIVED: %s\n'
+            'REJECTED: 413 Request Entity Too Large\n' % path)
+
+    def test_metrics_unauthorized(self):
+        # metrics require authentication
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        resp = client.get('/metrics')
+        assert resp.status == '401 UNAUTHORIZED'
 
     def test_unauthorized_by_default(self):
         # By default we get an Unauthorized message
@@ -378,6 +2607,42 @@ class TestFunctional(object):
         header = resp.headers.get('WWW-Authenticate', None)
         assert header is not None
 
+    def test_page_password_hash(self):
+        # we can require a password given as hash
+        application = DropAFileApplication(
+            password_hash=hash_password('sosecret'))
+        client = Client(application, BaseResponse)
+        resp = client.get('/', headers=get_basic_auth_headers(
+            username='somename', password="sosecret"))
+        assert resp.status == '200 OK'
+        resp = client.get('/', headers=get_basic_auth_headers(
+            username='somename', password="wrong"))
+        assert resp.status == '401 UNAUTHORIZED'
+
+    def test_session(self):
+        # with sessions enabled, we can login once
+        application = DropAFileApplication(session_lifetime=60)
+        client = Client(application, BaseResponse)
+        base_url = 'https://localhost/'
+        resp = client.get('/', base_url=base_url)
+        assert resp.status == '401 UNAUTHORIZED'
+        assert 'Set-Cookie' not in resp.headers
+        resp = client.get('/', base_url=base_url, headers=(
+            get_basic_auth_headers(password=application.password)))
+        assert resp.status == '200 OK'
+        assert 'Set-Cookie' in resp.headers
+        resp = client.get('/dropzone.js', base_url=base_url)
+        assert resp.status == '200 OK'
+        assert 'Set-Cookie' not in resp.headers
+
+    def test_no_session_by_default(self):
+        # by default we send no session cookies
+        application = DropAFileApplication()
+        client = Client(application, BaseResponse)
+        resp = client.get('/', headers=get_basic_auth_headers(
+            password=application.password))
+        assert 'Set-Cookie' not in resp.headers
+
     def test_page_set_password(self):
         # we can get some HTML page for any path
         application = DropAFileApplication(password="sosecret")
@@ -0,0 +1,255 @@
+# tests for dropafile.objectstore module.
+import concurrent.futures
+import datetime
+import hashlib
+import os
+import pytest
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qsl, urlsplit
+from werkzeug.datastructures import MultiDict
+from werkzeug.test import Client, EnvironBuilder
+from werkzeug.wrappers import BaseResponse, Request
+from dropafile import DropAFileApplication
+from dropafile.objectstore import (
+    ObjectStorage, ObjectStoreClient, ObjectStoreError, get_signing_key,
+    sign_request)
+from test_dropafile import chunk_data, get_basic_auth_headers
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # a tiny S3 stand-in, keeping objects and parts in memory
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        key, query = parts.path, dict(parse_qsl(parts.query, True))
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.requests.append((self.command, key, query))
+        if server.fail:
+            return self.reply(500)
+        if self.command == 'POST' and 'uploads' in query:
+            upload_id = 'upload-%d' % len(server.uploads)
+            server.uploads[upload_id] = dict()
+            return self.reply(200, (
+                '<InitiateMultipartUploadResult xmlns="http://s3.amazonaws'
+                '.com/doc/2006-03-01/"><UploadId>%s</UploadId>'
+                '</InitiateMultipartUploadResult>' % upload_id).encode())
+        if self.command == 'PUT' and 'partNumber' in query:
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            server.uploads[query['uploadId']][etag] = (
+                int(query['partNumber']), body)
+            return self.reply(200, headers={'ETag': etag})
+        if self.command == 'POST' and 'uploadId' in query:
+            parts = server.uploads.pop(query['uploadId'])
+            server.objects[key] = b''.join(
+                [data for num, data in sorted(parts.values())])
+            return self.reply(200, b'<CompleteMultipartUploadResult/>')
+        if self.command == 'DELETE' and 'uploadId' in query:
+            server.uploads.pop(query['uploadId'])
+            return self.reply(204)
+        if self.command == 'PUT':
+            server.objects[key] = body
+            return self.reply(200)
+        self.reply(400)
+
+    do_POST = do_PUT = do_DELETE = handle_request
+
+
+@pytest.fixture
+def stand_in():
+    # an S3 stand-in server, running in background
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.lock = threading.Lock()
+    server.requests, server.objects, server.uploads = [], {}, {}
+    server.fail = False
+    server.url = 'http://127.0.0.1:%s/bucket' % server.server_port
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestHelpers(object):
+
+    def test_get_signing_key(self):
+        # we derive keys like documented by AWS
+        key = get_signing_key(
+            'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY', '20120215',
+            'us-east-1', 'iam')
+        assert key.hex() == (
+            'f4780e2d9f65fa895f9c67b32ce1baf0'
+            'b0d8a43505a000a1a9e090d414db404d')
+
+    def test_sign_request(self):
+        # requests get signature version 4 headers
+        headers = sign_request(
+            'PUT', '/bucket/key', [('uploadId', 'x')], {'host': 'example'},
+            'AKID', 'secret', 'eu-west-1',
+            now=datetime.datetime(2020, 1, 2, 3, 4, 5))
+        assert headers['x-amz-date'] == '20200102T030405Z'
+        assert headers['x-amz-content-sha256'] == 'UNSIGNED-PAYLOAD'
+        assert headers['authorization'].startswith(
+            'AWS4-HMAC-SHA256 Credential=AKID/20200102/eu-west-1/s3/'
+            'aws4_request, SignedHeaders=host;x-amz-content-sha256;'
+            'x-amz-date, Signature=')
+        other = sign_request(
+            'PUT', '/bucket/key', [('uploadId', 'y')], {'host': 'example'},
+            'AKID', 'secret', 'eu-west-1',
+            now=datetime.datetime(2020, 1, 2, 3, 4, 5))
+        assert other['authorization'] != headers['authorization']
+
+
+class TestObjectStoreClient(object):
+
+    def test_invalid_url(self):
+        # we need HTTP(S) URLs
+        with pytest.raises(ValueError):
+            ObjectStoreClient('ftp://example.com/bucket')
+
+    def test_put_object(self, stand_in):
+        # we can store objects in a single request
+        client = ObjectStoreClient(stand_in.url, 'AKID', 'secret')
+        client.put_object('some key', b'foo')
+        assert stand_in.objects == {'/bucket/some%20key': b'foo'}
+        assert client.get_url('some key') == stand_in.url + '/some%20key'
+
+    def test_errors(self, stand_in):
+        # failed requests raise ObjectStoreError
+        client = ObjectStoreClient(stand_in.url)
+        stand_in.fail = True
+        with pytest.raises(ObjectStoreError):
+            client.put_object('key', b'foo')
+        stand_in.shutdown()
+        stand_in.server_close()
+        with pytest.raises(ObjectStoreError):
+            client.put_object('key', b'foo')
+
+
+class TestObjectStorage(object):
+
+    def test_small_file(self, stand_in):
+        # files smaller than a part are sent in one request
+        storage = ObjectStorage(stand_in.url)
+        writer = storage.open_write('test.txt')
+        writer.write(b'foo')
+        stored_file = storage.commit(writer, storage.allocate('test.txt'))
+        assert stored_file.path == '%s/%s' % (stand_in.url, writer.key)
+        assert stored_file.size == 3
+        assert list(stand_in.objects.values()) == [b'foo']
+        assert [method for method, key, query in stand_in.requests] == [
+            'PUT']
+
+    def test_parts_sent_while_writing(self, stand_in):
+        # parts are sent before the upload is complete
+        storage = ObjectStorage(stand_in.url, part_size=10, max_pending=2)
+        writer = storage.open_write('test.txt')
+        for num in range(5):
+            writer.write(b'%d' % num * 7)
+        concurrent.futures.wait(writer.parts)
+        assert len(writer.parts) == 3
+        assert stand_in.objects == {}
+        assert len(list(stand_in.uploads.values())[0]) == 3
+        storage.commit(writer, 'test.txt')
+        assert list(stand_in.objects.values()) == [
+            b'0000000111111122222223333333' b'4444444']
+        assert stand_in.uploads == {}
+
+    def test_abort(self, stand_in):
+        # aborted uploads are dropped
+        storage = ObjectStorage(stand_in.url, part_size=10)
+        writer = storage.open_write('test.txt')
+        writer.write(b'x' * 25)
+        storage.abort(writer)
+        storage.abort(writer)
+        assert stand_in.objects == {}
+        assert stand_in.uploads == {}
+        assert stand_in.requests[-1][0] == 'DELETE'
+
+    def test_read_back(self, stand_in):
+        # data not sent yet can be read back
+        storage = ObjectStorage(stand_in.url, part_size=10)
+        writer = storage.open_write('test.txt')
+        writer.write(b'foobar')
+        writer.seek(0)
+        assert writer.read(4) == b'foob'
+        assert writer.read() == b'ar'
+        writer.write(b'x' * 10)
+        with pytest.raises(ObjectStoreError):
+            writer.read()
+        storage.abort(writer)
+
+    def test_store(self, stand_in):
+        # local files and file objects can be stored
+        storage = ObjectStorage(stand_in.url, part_size=4)
+        path = os.path.join(storage.directory, '.chunks-foo')
+        with open(path, 'wb') as fd:
+            fd.write(b'Some Content')
+        stored_file = storage.store('test.txt', path)
+        assert stored_file.digest == hashlib.sha256(
+            b'Some Content').hexdigest()
+        assert stored_file.size == 12
+        assert not os.path.exists(path)
+        stored_file = storage.store('test.txt', BytesIO(b'foo'), 'known')
+        assert stored_file.digest == 'known'
+        assert sorted(stand_in.objects.values()) == [b'Some Content', b'foo']
+
+
+class TestApp(object):
+
+    def test_send_files(self, stand_in):
+        # uploads are streamed into the object store
+        app = DropAFileApplication(
+            storage=ObjectStorage(stand_in.url, part_size=1000))
+        client = Client(app, BaseResponse)
+        headers = get_basic_auth_headers(password=app.password)
+        resp = client.post('/index.html', headers=headers, data=MultiDict([
+            ('file', (BytesIO(b'foo' * 1000), 'foo.txt')),
+            ('file', (BytesIO(b'bar'), 'bar.txt')),
+            ('other', (BytesIO(b'baz'), 'baz.txt'))]))
+        assert resp.status_code == 200
+        assert resp.headers.getlist('X-Upload-Digest') == [
+            'sha256=%s' % hashlib.sha256(b'foo' * 1000).hexdigest(),
+            'sha256=%s' % hashlib.sha256(b'bar').hexdigest()]
+        assert sorted(stand_in.objects.values()) == [b'bar', b'foo' * 1000]
+        assert sorted(key.split('/')[-1] for key in stand_in.objects) == [
+            'bar.txt', 'foo.txt']
+        assert stand_in.uploads == {}
+        assert os.listdir(app.upload_dir) == []
+
+    def test_send_file_chunked(self, stand_in):
+        # chunks are collected locally and sent when complete
+        app = DropAFileApplication(storage=ObjectStorage(stand_in.url))
+        for num in range(3):
+            builder = EnvironBuilder(
+                method='POST', data=chunk_data(b'0123456789', num))
+            app.handle_uploaded_files(Request(builder.get_environ()))
+        assert list(stand_in.objects.values()) == [b'0123456789']
+        assert os.listdir(app.upload_dir) == ['.chunks-some-uuid.done']
+
+    def test_send_file_failing(self, stand_in):
+        # failed uploads are aborted
+        app = DropAFileApplication(
+            storage=ObjectStorage(stand_in.url, part_size=10))
+        client = Client(app, BaseResponse)
+        headers = get_basic_auth_headers(password=app.password)
+        stand_in.fail = True
+        with pytest.raises(ObjectStoreError):
+            client.post('/index.html', headers=headers, data={
+                'file': (BytesIO(b'foo'), 'foo.txt')})
+        assert stand_in.objects == {}